@@ -0,0 +1,169 @@
+"""Hit rate and latency of the answer cache.
+
+Fills the cache of one assistant with synthetic lecture questions, then looks
+up three kinds of questions:
+
+- repeats: the cached questions as other students would type them (case,
+  punctuation, spacing, greetings, typos), which should hit;
+- near misses: the same questions about another exercise or topic, which
+  should not hit since their answer differs;
+- unrelated questions, which should not hit.
+
+For each threshold it reports the hit rate of each kind and the time per
+lookup and per insertion.
+
+    python -m benchmarks.answer_cache
+    python -m benchmarks.answer_cache --entries 1000 --thresholds 0.8 0.85 0.9 0.95
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import statistics
+import time
+
+# src.constants reads these at import time
+for key, value in {
+    "OPENAI_API_KEY": "sk-benchmark",
+    "DISCORD_BOT_TOKEN": "benchmark",
+    "DISCORD_CLIENT_ID": "1",
+    "ALLOWED_SERVER_IDS": "1",
+    "DEFAULT_MODEL": "gpt-4",
+    "LOG_LEVEL": "WARNING",
+}.items():
+    os.environ.setdefault(key, value)
+
+TEMPLATES = [
+    "What is the answer to exercise {n} of chapter {m}?",
+    "Can you explain the definition of {topic} from lecture {n}?",
+    "How do I solve problem {n} in homework {m}?",
+    "What is the difference between {topic} and {other}?",
+    "Why does the proof of theorem {n}.{m} work?",
+    "演習{m}の問題{n}の答えを教えてください",
+    "{topic}の定義を説明してください（第{n}回）",
+]
+TOPICS = [
+    "a monad", "a functor", "recursion", "a closure", "big O notation", "a hash table", "a binary heap",
+    "dynamic programming", "a linked list", "garbage collection", "a mutex", "a deadlock", "tail calls",
+    "type inference", "a B-tree", "a bloom filter", "memoization", "a race condition",
+]
+GREETINGS = ["", "hi, ", "hello! ", "question: ", "sorry, ", "quick question - "]
+
+
+def make_question(rng: random.Random) -> dict:
+    return {
+        "template": rng.choice(TEMPLATES),
+        "n": rng.randint(1, 40),
+        "m": rng.randint(1, 15),
+        "topic": rng.choice(TOPICS),
+        "other": rng.choice(TOPICS),
+    }
+
+
+def render(question: dict) -> str:
+    return question["template"].format(**question)
+
+
+def retype(text: str, rng: random.Random) -> str:
+    """The same question as typed by another student"""
+    if rng.random() < 0.5:
+        text = text.lower()
+    if rng.random() < 0.5:
+        text = text.rstrip("?？") + rng.choice(["", "??", " ?", "?!"])
+    if rng.random() < 0.3:
+        text = text.replace(" ", "  ", 1)
+    if rng.random() < 0.3 and len(text) > 10:
+        # swap two adjacent characters
+        i = rng.randrange(1, len(text) - 2)
+        text = text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    return rng.choice(GREETINGS) + text
+
+
+def near_miss(question: dict, rng: random.Random) -> dict:
+    """The same question about another exercise or topic"""
+    changed = dict(question)
+    if "{topic}" in question["template"] and rng.random() < 0.5:
+        changed["topic"] = rng.choice([t for t in TOPICS if t != question["topic"]])
+    else:
+        changed["n"] = question["n"] % 40 + 1
+    return changed
+
+
+def run(entries: int, lookups: int, threshold: float, seed: int) -> dict:
+    from src.answer_cache import AnswerCache
+
+    rng = random.Random(seed)
+    cache = AnswerCache(max_entries=entries, threshold=threshold)
+    cached = []
+    seen = set()
+    while len(cached) < entries:
+        question = make_question(rng)
+        if render(question) not in seen:
+            seen.add(render(question))
+            cached.append(question)
+
+    add_times = []
+    for i, question in enumerate(cached):
+        started = time.perf_counter()
+        cache.add("asst_benchmark", render(question), f"answer {i}")
+        add_times.append(time.perf_counter() - started)
+    answers = {render(q): f"answer {i}" for i, q in enumerate(cached)}
+
+    results = {}
+    lookup_times = []
+    for kind in ("repeats", "near_misses", "unrelated"):
+        hits = correct = n = 0
+        while n < lookups:
+            question = rng.choice(cached)
+            if kind == "repeats":
+                text = retype(render(question), rng)
+            elif kind == "near_misses":
+                changed = near_miss(question, rng)
+                if render(changed) in seen:
+                    continue
+                text = render(changed)
+            else:
+                text = rng.choice(["What time is the exam?", "Is the lecture recorded?",
+                                   "Where is room 305?", "レポートの締め切りはいつですか"])
+            n += 1
+            started = time.perf_counter()
+            answer = cache.lookup("asst_benchmark", text)
+            lookup_times.append(time.perf_counter() - started)
+            if answer is not None:
+                hits += 1
+                correct += answer == answers[render(question)]
+        # for repeats, the hits returning the answer of another question
+        results[kind] = {"hit_rate": hits / lookups, "wrong_hits": hits - correct}
+
+    return {
+        **results,
+        "lookup_us": {
+            "p50": statistics.median(lookup_times) * 1e6,
+            "p99": sorted(lookup_times)[int(len(lookup_times) * 0.99)] * 1e6,
+        },
+        "add_us": statistics.median(add_times) * 1e6,
+        "matrix_mib": cache._assistants["asst_benchmark"].vectors.nbytes / 2**20,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=500, help="questions in the cache")
+    parser.add_argument("--lookups", type=int, default=1000, help="lookups per kind of question")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.8, 0.85, 0.9, 0.95])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'threshold':>9} {'repeats':>8} {'wrong':>6} {'near miss':>10} {'unrelated':>10} "
+          f"{'lookup p50':>11} {'lookup p99':>11} {'add':>8} {'matrix':>8}")
+    for threshold in args.thresholds:
+        result = run(args.entries, args.lookups, threshold, args.seed)
+        print(f"{threshold:>9.2f} {result['repeats']['hit_rate']:>8.1%} {result['repeats']['wrong_hits']:>6} "
+              f"{result['near_misses']['hit_rate']:>10.1%} {result['unrelated']['hit_rate']:>10.1%} "
+              f"{result['lookup_us']['p50']:>9.0f}us {result['lookup_us']['p99']:>9.0f}us "
+              f"{result['add_us']:>6.0f}us {result['matrix_mib']:>6.1f}MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""A synthetic Discord gateway and REST layer for driving the real cogs offline.
+
+The REST side is a local aiohttp server: discord.py's HTTP client is pointed
+at it by overriding `discord.http.Route.BASE`, so every REST call the cogs
+make (typing, sends, fetching the starter message, command sync) goes
+through the library as usual. The gateway side builds guild/thread/message
+payloads and feeds them to the client's ConnectionState parsers, which
+dispatch `on_message` exactly like a real MESSAGE_CREATE event.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import discord
+from aiohttp import web
+
+BOT_USER_ID = 100000000000000001
+APPLICATION_ID = 100000000000000002
+
+
+def _timestamp() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _json(data, status: int = 200) -> web.Response:
+    # discord.py only decodes bodies whose content type is exactly application/json
+    return web.Response(body=json.dumps(data).encode(), status=status, content_type="application/json")
+
+
+def _user(id: int, name: str, bot: bool = False) -> dict:
+    return {"id": str(id), "username": name, "discriminator": "0000", "avatar": None,
+            "global_name": name, "bot": bot}
+
+
+class FakeDiscordREST:
+    def __init__(self, api_latency: float = 0.0):
+        self.api_latency = api_latency
+        self.calls: Counter[str] = Counter()
+        self._ids = itertools.count(200000000000000000)
+        self.messages: dict[int, dict[int, dict]] = defaultdict(dict)
+        self.commands: list[dict] = []
+        # data of the attachments of the user messages, by file name
+        self.attachments: dict[str, bytes] = {}
+        # futures resolved with (time, payload) on the next message the bot posts in a channel
+        self._waiters: dict[int, list[asyncio.Future]] = defaultdict(list)
+        self.base_url = ""
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware], client_max_size=64 * 1024 ** 2)
+        r = app.router
+        r.add_get("/api/v10/users/@me", self.get_me)
+        r.add_get("/api/v10/oauth2/applications/@me", self.get_application)
+        r.add_put("/api/v10/applications/{app}/commands", self.put_commands)
+        r.add_get("/api/v10/applications/{app}/commands", self.get_commands)
+        r.add_post("/api/v10/channels/{channel}/typing", self.typing)
+        r.add_get("/api/v10/channels/{channel}/messages/{message}", self.get_message)
+        r.add_get("/api/v10/channels/{channel}/messages", self.list_messages)
+        r.add_post("/api/v10/channels/{channel}/messages", self.create_message)
+        r.add_patch("/api/v10/channels/{channel}/messages/{message}", self.edit_message)
+        r.add_delete("/api/v10/channels/{channel}/messages/{message}", self.delete_message)
+        r.add_get("/api/v10/attachments/{filename}", self.get_attachment)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = request.match_info.route.resource
+        self.calls[f"{request.method} {route.canonical if route else request.path}"] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        return await handler(request)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}/api/v10"
+        discord.http.Route.BASE = self.base_url
+        return runner
+
+    def wait_for_reply(self, channel_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[channel_id].append(future)
+        return future
+
+    # -- handlers --------------------------------------------------------
+
+    async def get_me(self, request: web.Request) -> web.Response:
+        return _json(dict(_user(BOT_USER_ID, "gpt-bot", bot=True), flags=0, mfa_enabled=False,
+                                      verified=True))
+
+    async def get_application(self, request: web.Request) -> web.Response:
+        return _json({
+            "id": str(APPLICATION_ID), "name": "gpt-bot", "description": "", "icon": None,
+            "rpc_origins": [], "bot_public": False, "bot_require_code_grant": False,
+            "owner": _user(1, "owner"), "verify_key": "0" * 64, "flags": 0, "summary": "",
+        })
+
+    async def put_commands(self, request: web.Request) -> web.Response:
+        commands = await request.json()
+        for command in commands:
+            command.setdefault("id", str(self.next_id()))
+            command.setdefault("application_id", str(APPLICATION_ID))
+            command.setdefault("version", "1")
+            command.setdefault("default_member_permissions", None)
+        self.commands = commands
+        return _json(commands)
+
+    async def get_commands(self, request: web.Request) -> web.Response:
+        return _json(self.commands)
+
+    async def typing(self, request: web.Request) -> web.Response:
+        return web.Response(status=204)
+
+    async def get_message(self, request: web.Request) -> web.Response:
+        channel_id, message_id = int(request.match_info["channel"]), int(request.match_info["message"])
+        message = self.messages[channel_id].get(message_id)
+        if message is None:
+            return _json({"message": "Unknown Message", "code": 10008}, status=404)
+        return _json(message)
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        channel_id = int(request.match_info["channel"])
+        limit = int(request.query.get("limit", 50))
+        messages = sorted(self.messages[channel_id].values(), key=lambda m: int(m["id"]), reverse=True)
+        return _json(messages[:limit])
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        channel_id = int(request.match_info["channel"])
+        if request.content_type.startswith("multipart/"):
+            body, attachments = {}, []
+            reader = await request.multipart()
+            async for part in reader:
+                if part.name == "payload_json":
+                    body = json.loads(await part.text())
+                else:
+                    data = await part.read()
+                    attachments.append({
+                        "id": str(self.next_id()), "filename": part.filename, "size": len(data),
+                        "url": f"{self.base_url}/attachments/{part.filename}",
+                        "proxy_url": f"{self.base_url}/attachments/{part.filename}",
+                    })
+        else:
+            body, attachments = await request.json(), []
+        message = self.make_message(
+            channel_id=channel_id,
+            author=_user(BOT_USER_ID, "gpt-bot", bot=True),
+            content=body.get("content") or "",
+            embeds=body.get("embeds") or [],
+            attachments=attachments,
+        )
+        self.messages[channel_id][int(message["id"])] = message
+        received_at = time.monotonic()
+        for future in self._waiters.pop(channel_id, []):
+            if not future.done():
+                future.set_result((received_at, message))
+        return _json(message)
+
+    async def edit_message(self, request: web.Request) -> web.Response:
+        channel_id, message_id = int(request.match_info["channel"]), int(request.match_info["message"])
+        message = self.messages[channel_id].get(message_id)
+        if message is None:
+            return _json({"message": "Unknown Message", "code": 10008}, status=404)
+        message.update({k: v for k, v in (await request.json()).items() if k in ("content", "embeds")})
+        return _json(message)
+
+    async def delete_message(self, request: web.Request) -> web.Response:
+        channel_id, message_id = int(request.match_info["channel"]), int(request.match_info["message"])
+        self.messages[channel_id].pop(message_id, None)
+        return web.Response(status=204)
+
+    async def get_attachment(self, request: web.Request) -> web.Response:
+        data = self.attachments.get(request.match_info["filename"])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data, content_type="application/octet-stream")
+
+    # -- payloads --------------------------------------------------------
+
+    def make_attachment(self, filename: str, data: bytes, content_type: str) -> dict:
+        """An attachment served by the fake CDN, read by Attachment.read()"""
+        id = self.next_id()
+        name = f"{id}_{filename}"
+        self.attachments[name] = data
+        return {
+            "id": str(id), "filename": filename, "size": len(data), "content_type": content_type,
+            "url": f"{self.base_url}/attachments/{name}", "proxy_url": f"{self.base_url}/attachments/{name}",
+        }
+
+    def make_message(self, channel_id: int, author: dict, content: str, guild_id: int | None = None,
+                     embeds: list | None = None, attachments: list | None = None,
+                     id: int | None = None) -> dict:
+        message = {
+            "id": str(id or self.next_id()),
+            "channel_id": str(channel_id),
+            "author": author,
+            "content": content,
+            "timestamp": _timestamp(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": attachments or [],
+            "embeds": embeds or [],
+            "pinned": False,
+            "type": 0,
+            "flags": 0,
+        }
+        if guild_id is not None:
+            message["guild_id"] = str(guild_id)
+        return message
+
+
+class SyntheticGateway:
+    """Create guilds and threads in the client's cache and dispatch user messages"""
+
+    def __init__(self, client: discord.Client, rest: FakeDiscordREST):
+        self.client = client
+        self.rest = rest
+        self.state = client._connection
+
+    def create_guild(self, guild_id: int, channel_id: int) -> discord.Guild:
+        data = {
+            "id": str(guild_id),
+            "name": "benchmark",
+            "owner_id": "1",
+            "icon": None,
+            "features": [],
+            "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0,
+                       "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+            "emojis": [],
+            "stickers": [],
+            "channels": [{"id": str(channel_id), "type": 0, "name": "general", "position": 0,
+                          "guild_id": str(guild_id), "permission_overwrites": [], "nsfw": False,
+                          "parent_id": None, "rate_limit_per_user": 0}],
+            "threads": [],
+            "members": [],
+            "member_count": 1,
+            "verification_level": 0,
+            "default_message_notifications": 0,
+            "explicit_content_filter": 0,
+            "mfa_level": 0,
+            "premium_tier": 0,
+            "preferred_locale": "en-US",
+            "nsfw_level": 0,
+        }
+        return self.state._add_guild_from_data(data)
+
+    def create_chat_thread(self, guild: discord.Guild, channel_id: int, name: str,
+                           openai_thread_id: str, assistant_id: str) -> discord.Thread:
+        """Create a chat thread as /chat would: a starter embed in the channel and a thread on it"""
+        starter = self.rest.make_message(
+            channel_id=channel_id,
+            guild_id=guild.id,
+            author=_user(BOT_USER_ID, "gpt-bot", bot=True),
+            content="",
+            embeds=[{
+                "type": "rich",
+                "description": "benchmark wants to chat! 🤖💬",
+                "fields": [
+                    {"name": "thread_id", "value": openai_thread_id, "inline": True},
+                    {"name": "assistant_id", "value": assistant_id, "inline": True},
+                    {"name": "name", "value": "benchmark", "inline": True},
+                ],
+            }],
+        )
+        thread_id = int(starter["id"])
+        self.rest.messages[channel_id][thread_id] = starter
+        data = {
+            "id": str(thread_id),
+            "guild_id": str(guild.id),
+            "parent_id": str(channel_id),
+            "owner_id": str(BOT_USER_ID),
+            "name": name,
+            "type": 11,
+            "last_message_id": None,
+            "rate_limit_per_user": 0,
+            "message_count": 0,
+            "member_count": 1,
+            "flags": 0,
+            "thread_metadata": {"archived": False, "auto_archive_duration": 60,
+                                "archive_timestamp": _timestamp(), "locked": False},
+        }
+        thread = discord.Thread(guild=guild, state=self.state, data=data)
+        guild._add_thread(thread)
+        return thread
+
+    def send_user_message(self, thread: discord.Thread, user_id: int, user_name: str, content: str,
+                          attachments: list | None = None) -> dict:
+        message = self.rest.make_message(
+            channel_id=thread.id,
+            guild_id=thread.guild.id,
+            author=_user(user_id, user_name),
+            content=content,
+            attachments=attachments,
+        )
+        self.rest.messages[thread.id][int(message["id"])] = message
+        self.state.parse_message_create(message)
+        return message
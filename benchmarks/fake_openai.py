@@ -0,0 +1,615 @@
+"""A local stand-in for the OpenAI Assistants API.
+
+Implements the subset of endpoints the bot uses (assistants, threads,
+messages, runs with `requires_action` tool calls, files and vector stores)
+with configurable latencies, so load tests and evaluations can run without
+network access or API credit. Point the bot at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+    python -m benchmarks.fake_openai --port 8787 --run-latency 2
+    python -m benchmarks.fake_openai --port 8787 --assistant asst_ci --rate-limit-rate 0.1
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from aiohttp import web
+
+
+@dataclass
+class FakeOpenAIConfig:
+    # seconds a run stays queued, then in_progress
+    queued_latency: float = 0.2
+    run_latency: float = 1.0
+    # probability that a run asks for a function tool call before completing
+    tool_call_rate: float = 0.0
+    tool_name: str = "get_wikipedia_summary"
+    # seconds a run stays in_progress after the tool outputs are submitted
+    tool_followup_latency: float = 0.3
+    # added to every request
+    api_latency: float = 0.01
+    # length of the generated answers
+    answer_chars: int = 600
+    # seconds for a vector store file batch to finish indexing
+    indexing_latency: float = 0.5
+    # probability that a run fails with the rate_limit_exceeded error
+    rate_limit_rate: float = 0.0
+    # assistants that exist from the start, with these ids
+    assistant_ids: tuple[str, ...] = ()
+    seed: int = 0
+
+
+def _now() -> int:
+    return int(time.time())
+
+
+def _page(items: list[dict], request: web.Request) -> dict:
+    """Paginate like the OpenAI list endpoints (limit/order/after/before)"""
+    limit = int(request.query.get("limit", 20))
+    order = request.query.get("order", "desc")
+    items = sorted(items, key=lambda x: (x["created_at"], x["id"]), reverse=order == "desc")
+    if "after" in request.query:
+        ids = [x["id"] for x in items]
+        after = request.query["after"]
+        items = items[ids.index(after) + 1:] if after in ids else []
+    if "before" in request.query:
+        ids = [x["id"] for x in items]
+        before = request.query["before"]
+        items = items[:ids.index(before)] if before in ids else items
+    data = items[:limit]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": len(items) > limit,
+    }
+
+
+class FakeOpenAI:
+    def __init__(self, config: FakeOpenAIConfig | None = None):
+        self.config = config or FakeOpenAIConfig()
+        self.random = random.Random(self.config.seed)
+        self.calls: Counter[str] = Counter()
+        # tool outputs submitted without a result, e.g. when the tool raised
+        self.empty_tool_outputs = 0
+        self._ids = itertools.count(1)
+        self.assistants: dict[str, dict] = {}
+        self.threads: dict[str, dict] = {}
+        self.messages: dict[str, list[dict]] = {}
+        self.runs: dict[str, dict] = {}
+        self.files: dict[str, tuple[dict, bytes]] = {}
+        self.vector_stores: dict[str, dict] = {}
+        self.file_batches: dict[str, dict] = {}
+        for assistant_id in self.config.assistant_ids:
+            self._add_assistant({"name": assistant_id}, assistant_id)
+
+    def _id(self, prefix: str) -> str:
+        return f"{prefix}_{next(self._ids):08d}"
+
+    # -- app -------------------------------------------------------------
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware], client_max_size=512 * 1024 ** 2)
+        r = app.router
+        r.add_get("/_stats", self.stats)
+        r.add_post("/v1/assistants", self.create_assistant)
+        r.add_get("/v1/assistants", self.list_assistants)
+        r.add_get("/v1/assistants/{id}", self.get_assistant)
+        r.add_post("/v1/assistants/{id}", self.update_assistant)
+        r.add_delete("/v1/assistants/{id}", self.delete_assistant)
+        r.add_post("/v1/threads", self.create_thread)
+        r.add_get("/v1/threads/{id}", self.get_thread)
+        r.add_delete("/v1/threads/{id}", self.delete_thread)
+        r.add_post("/v1/threads/{id}/messages", self.create_message)
+        r.add_get("/v1/threads/{id}/messages", self.list_messages)
+        r.add_post("/v1/threads/{id}/runs", self.create_run)
+        r.add_get("/v1/threads/{id}/runs/{run_id}", self.get_run)
+        r.add_post("/v1/threads/{id}/runs/{run_id}/submit_tool_outputs", self.submit_tool_outputs)
+        r.add_post("/v1/threads/{id}/runs/{run_id}/cancel", self.cancel_run)
+        r.add_post("/v1/files", self.create_file)
+        r.add_get("/v1/files/{id}", self.get_file)
+        r.add_get("/v1/files/{id}/content", self.get_file_content)
+        r.add_post("/v1/vector_stores", self.create_vector_store)
+        r.add_get("/v1/vector_stores/{id}", self.get_vector_store)
+        r.add_post("/v1/vector_stores/{id}/files", self.create_vector_store_file)
+        r.add_post("/v1/vector_stores/{id}/file_batches", self.create_file_batch)
+        r.add_get("/v1/vector_stores/{id}/file_batches/{batch_id}", self.get_file_batch)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = request.match_info.route.resource
+        self.calls[f"{request.method} {route.canonical if route else request.path}"] += 1
+        if self.config.api_latency:
+            await asyncio.sleep(self.config.api_latency)
+        return await handler(request)
+
+    @staticmethod
+    def _error(status: int, message: str) -> web.Response:
+        return web.json_response(
+            {"error": {"message": message, "type": "invalid_request_error", "param": None, "code": None}},
+            status=status,
+        )
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "calls": dict(self.calls), "total": sum(self.calls.values()), "empty_tool_outputs": self.empty_tool_outputs,
+        })
+
+    # -- assistants ------------------------------------------------------
+
+    async def create_assistant(self, request: web.Request) -> web.Response:
+        return web.json_response(self._add_assistant(await request.json(), self._id("asst")))
+
+    def _add_assistant(self, body: dict, assistant_id: str) -> dict:
+        assistant = {
+            "id": assistant_id,
+            "object": "assistant",
+            "created_at": _now(),
+            "name": body.get("name"),
+            "description": body.get("description"),
+            "model": body.get("model", "gpt-4"),
+            "instructions": body.get("instructions"),
+            "tools": body.get("tools", []),
+            "tool_resources": body.get("tool_resources") or {},
+            "metadata": body.get("metadata") or {},
+            "temperature": 1.0,
+            "top_p": 1.0,
+            "response_format": "auto",
+        }
+        self.assistants[assistant["id"]] = assistant
+        return assistant
+
+    async def list_assistants(self, request: web.Request) -> web.Response:
+        return web.json_response(_page(list(self.assistants.values()), request))
+
+    async def get_assistant(self, request: web.Request) -> web.Response:
+        assistant = self.assistants.get(request.match_info["id"])
+        if assistant is None:
+            return self._error(404, "No assistant found")
+        return web.json_response(assistant)
+
+    async def update_assistant(self, request: web.Request) -> web.Response:
+        assistant = self.assistants.get(request.match_info["id"])
+        if assistant is None:
+            return self._error(404, "No assistant found")
+        assistant.update(await request.json())
+        return web.json_response(assistant)
+
+    async def delete_assistant(self, request: web.Request) -> web.Response:
+        id = request.match_info["id"]
+        deleted = self.assistants.pop(id, None) is not None
+        return web.json_response({"id": id, "object": "assistant.deleted", "deleted": deleted})
+
+    # -- threads and messages --------------------------------------------
+
+    async def create_thread(self, request: web.Request) -> web.Response:
+        body = await request.json() if request.can_read_body else {}
+        thread = {
+            "id": self._id("thread"),
+            "object": "thread",
+            "created_at": _now(),
+            "metadata": body.get("metadata") or {},
+            "tool_resources": body.get("tool_resources"),
+        }
+        self.threads[thread["id"]] = thread
+        self.messages[thread["id"]] = []
+        for message in body.get("messages") or []:
+            self._add_message(thread["id"], message.get("role", "user"), message["content"],
+                              attachments=message.get("attachments"))
+        return web.json_response(thread)
+
+    async def get_thread(self, request: web.Request) -> web.Response:
+        thread = self.threads.get(request.match_info["id"])
+        if thread is None:
+            return self._error(404, "No thread found")
+        return web.json_response(thread)
+
+    async def delete_thread(self, request: web.Request) -> web.Response:
+        id = request.match_info["id"]
+        deleted = self.threads.pop(id, None) is not None
+        self.messages.pop(id, None)
+        return web.json_response({"id": id, "object": "thread.deleted", "deleted": deleted})
+
+    def _add_message(self, thread_id: str, role: str, content, attachments=None,
+                     assistant_id: str | None = None, run_id: str | None = None) -> dict:
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        blocks = []
+        for block in content:
+            if block["type"] == "text":
+                text = block["text"]
+                blocks.append({"type": "text", "text": {"value": text, "annotations": []}})
+            else:
+                blocks.append(block)
+        created_at = _now()
+        message = {
+            "id": self._id("msg"),
+            "object": "thread.message",
+            "created_at": created_at,
+            "thread_id": thread_id,
+            "role": role,
+            "content": blocks,
+            "assistant_id": assistant_id,
+            "run_id": run_id,
+            "attachments": attachments or [],
+            "metadata": {},
+            "status": "completed",
+            "completed_at": created_at,
+            "incomplete_at": None,
+            "incomplete_details": None,
+        }
+        self.messages[thread_id].append(message)
+        return message
+
+    def _active_run(self, thread_id: str) -> dict | None:
+        for run in self.runs.values():
+            if run["thread_id"] == thread_id:
+                self._advance(run)
+                if run["status"] in ("queued", "in_progress", "requires_action", "cancelling"):
+                    return run
+        return None
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        thread_id = request.match_info["id"]
+        if thread_id not in self.threads:
+            return self._error(404, "No thread found")
+        active = self._active_run(thread_id)
+        if active is not None:
+            return self._error(400, f"Can't add messages to {thread_id} while a run {active['id']} is active.")
+        body = await request.json()
+        message = self._add_message(thread_id, body.get("role", "user"), body["content"],
+                                    attachments=body.get("attachments"))
+        return web.json_response(message)
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        thread_id = request.match_info["id"]
+        if thread_id not in self.threads:
+            return self._error(404, "No thread found")
+        # messages are kept in insertion order, which breaks ties within the same second
+        messages = list(self.messages[thread_id])
+        order = request.query.get("order", "desc")
+        if order == "desc":
+            messages.reverse()
+        limit = int(request.query.get("limit", 20))
+        ids = [m["id"] for m in messages]
+        if "after" in request.query and request.query["after"] in ids:
+            messages = messages[ids.index(request.query["after"]) + 1:]
+        data = messages[:limit]
+        return web.json_response({
+            "object": "list",
+            "data": data,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None,
+            "has_more": len(messages) > limit,
+        })
+
+    # -- runs ------------------------------------------------------------
+
+    async def create_run(self, request: web.Request) -> web.Response:
+        thread_id = request.match_info["id"]
+        if thread_id not in self.threads:
+            return self._error(404, "No thread found")
+        if self._active_run(thread_id) is not None:
+            return self._error(400, f"Thread {thread_id} already has an active run.")
+        body = await request.json()
+        assistant = self.assistants.get(body["assistant_id"])
+        if assistant is None:
+            return self._error(404, "No assistant found")
+        created = time.monotonic()
+        run = {
+            "id": self._id("run"),
+            "object": "thread.run",
+            "created_at": _now(),
+            "thread_id": thread_id,
+            "assistant_id": assistant["id"],
+            "status": "queued",
+            "required_action": None,
+            "last_error": None,
+            "expires_at": _now() + 600,
+            "started_at": None,
+            "cancelled_at": None,
+            "failed_at": None,
+            "completed_at": None,
+            "incomplete_details": None,
+            "model": assistant["model"],
+            "instructions": body.get("instructions") or assistant["instructions"] or "",
+            "tools": assistant["tools"],
+            "metadata": {},
+            "usage": None,
+            "temperature": 1.0,
+            "top_p": 1.0,
+            "max_prompt_tokens": body.get("max_prompt_tokens"),
+            "max_completion_tokens": body.get("max_completion_tokens"),
+            "truncation_strategy": body.get("truncation_strategy") or {"type": "auto", "last_messages": None},
+            "tool_choice": "auto",
+            "response_format": "auto",
+            "parallel_tool_calls": True,
+            # private scheduling state, stripped from responses
+            "_created": created,
+            "_done_at": created + self.config.queued_latency + self.config.run_latency,
+            "_tool_call": self.random.random() < self.config.tool_call_rate,
+            "_rate_limited": self.random.random() < self.config.rate_limit_rate,
+        }
+        self.runs[run["id"]] = run
+        return web.json_response(self._public(run))
+
+    @staticmethod
+    def _public(run: dict) -> dict:
+        return {k: v for k, v in run.items() if not k.startswith("_")}
+
+    def _advance(self, run: dict) -> None:
+        """Move the run along its lifecycle according to the elapsed time"""
+        if run["status"] in ("completed", "cancelled", "failed", "expired", "incomplete", "requires_action"):
+            return
+        now = time.monotonic()
+        if run["status"] == "cancelling":
+            run["status"] = "cancelled"
+            run["cancelled_at"] = _now()
+            return
+        if now - run["_created"] < self.config.queued_latency:
+            return
+        if run["_rate_limited"]:
+            run["status"] = "failed"
+            run["failed_at"] = _now()
+            run["last_error"] = {"code": "rate_limit_exceeded", "message": "Rate limit reached for requests"}
+            return
+        if run["status"] == "queued":
+            run["status"] = "in_progress"
+            run["started_at"] = _now()
+        if run["_tool_call"] and now >= run["_created"] + self.config.queued_latency + self.config.run_latency / 2:
+            run["_tool_call"] = False
+            run["status"] = "requires_action"
+            run["required_action"] = {
+                "type": "submit_tool_outputs",
+                "submit_tool_outputs": {
+                    "tool_calls": [{
+                        "id": self._id("call"),
+                        "type": "function",
+                        "function": {"name": self.config.tool_name, "arguments": json.dumps({"query": "benchmark"})},
+                    }]
+                },
+            }
+            return
+        if now >= run["_done_at"]:
+            self._complete(run)
+
+    def _complete(self, run: dict) -> None:
+        thread_messages = self.messages.get(run["thread_id"], [])
+        # the truncation strategy and token limits are applied as the API does
+        prompt_messages = thread_messages
+        if run["truncation_strategy"]["type"] == "last_messages" and run["truncation_strategy"]["last_messages"]:
+            prompt_messages = thread_messages[-run["truncation_strategy"]["last_messages"]:]
+        prompt_tokens = sum(
+            len(block["text"]["value"]) // 4
+            for message in prompt_messages for block in message["content"] if block["type"] == "text"
+        ) + len(run["instructions"]) // 4
+        if run["max_prompt_tokens"] is not None:
+            prompt_tokens = min(prompt_tokens, run["max_prompt_tokens"])
+        answer = self._answer(thread_messages)
+        run["status"] = "completed"
+        if run["max_completion_tokens"] is not None and len(answer) // 4 > run["max_completion_tokens"]:
+            answer = answer[:run["max_completion_tokens"] * 4]
+            run["status"] = "incomplete"
+            run["incomplete_details"] = {"reason": "max_completion_tokens"}
+        self._add_message(run["thread_id"], "assistant", answer,
+                          assistant_id=run["assistant_id"], run_id=run["id"])
+        completion_tokens = len(answer) // 4
+        run["completed_at"] = _now()
+        run["usage"] = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def _answer(self, thread_messages: list[dict]) -> str:
+        question = ""
+        for message in reversed(thread_messages):
+            if message["role"] == "user":
+                question = " ".join(
+                    b["text"]["value"] for b in message["content"] if b["type"] == "text"
+                )
+                break
+        words = ["assistant", "answer", "lecture", "example", "definition", "proof", "value", "step"]
+        body = " ".join(self.random.choice(words) for _ in range(self.config.answer_chars // 8))
+        return f"Re: {question[:80]}\n\n{body[:self.config.answer_chars]}"
+
+    async def get_run(self, request: web.Request) -> web.Response:
+        run = self.runs.get(request.match_info["run_id"])
+        if run is None:
+            return self._error(404, "No run found")
+        self._advance(run)
+        return web.json_response(self._public(run))
+
+    async def submit_tool_outputs(self, request: web.Request) -> web.Response:
+        run = self.runs.get(request.match_info["run_id"])
+        if run is None:
+            return self._error(404, "No run found")
+        if run["status"] != "requires_action":
+            return self._error(400, f"Runs in status {run['status']} do not accept tool outputs.")
+        body = await request.json()
+        self.empty_tool_outputs += sum(output["output"] == "No result" for output in body["tool_outputs"])
+        run["status"] = "in_progress"
+        run["required_action"] = None
+        run["_done_at"] = time.monotonic() + self.config.tool_followup_latency
+        return web.json_response(self._public(run))
+
+    async def cancel_run(self, request: web.Request) -> web.Response:
+        run = self.runs.get(request.match_info["run_id"])
+        if run is None:
+            return self._error(404, "No run found")
+        self._advance(run)
+        if run["status"] not in ("queued", "in_progress", "requires_action"):
+            return self._error(400, f"Cannot cancel run with status '{run['status']}'.")
+        run["status"] = "cancelling"
+        run["required_action"] = None
+        return web.json_response(self._public(run))
+
+    # -- files and vector stores -----------------------------------------
+
+    async def create_file(self, request: web.Request) -> web.Response:
+        reader = await request.multipart()
+        purpose, filename, data = "assistants", "file", b""
+        async for part in reader:
+            if part.name == "purpose":
+                purpose = (await part.read()).decode()
+            elif part.name == "file":
+                filename = part.filename or filename
+                data = await part.read()
+        file = {
+            "id": self._id("file"),
+            "object": "file",
+            "bytes": len(data),
+            "created_at": _now(),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        self.files[file["id"]] = (file, data)
+        return web.json_response(file)
+
+    async def get_file(self, request: web.Request) -> web.Response:
+        if request.match_info["id"] not in self.files:
+            return self._error(404, "No file found")
+        return web.json_response(self.files[request.match_info["id"]][0])
+
+    async def get_file_content(self, request: web.Request) -> web.Response:
+        if request.match_info["id"] not in self.files:
+            return self._error(404, "No file found")
+        return web.Response(body=self.files[request.match_info["id"]][1],
+                            content_type="application/octet-stream")
+
+    async def create_vector_store(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        file_ids = body.get("file_ids") or []
+        store = {
+            "id": self._id("vs"),
+            "object": "vector_store",
+            "created_at": _now(),
+            "name": body.get("name"),
+            "usage_bytes": 0,
+            "status": "completed",
+            "file_counts": {"in_progress": 0, "completed": len(file_ids), "failed": 0,
+                            "cancelled": 0, "total": len(file_ids)},
+            "metadata": {},
+            "last_active_at": _now(),
+            "_file_ids": list(file_ids),
+        }
+        self.vector_stores[store["id"]] = store
+        return web.json_response(self._public(store))
+
+    async def get_vector_store(self, request: web.Request) -> web.Response:
+        store = self.vector_stores.get(request.match_info["id"])
+        if store is None:
+            return self._error(404, "No vector store found")
+        return web.json_response(self._public(store))
+
+    async def create_vector_store_file(self, request: web.Request) -> web.Response:
+        store = self.vector_stores.get(request.match_info["id"])
+        if store is None:
+            return self._error(404, "No vector store found")
+        body = await request.json()
+        store["_file_ids"].append(body["file_id"])
+        store["file_counts"]["completed"] += 1
+        store["file_counts"]["total"] += 1
+        return web.json_response({
+            "id": body["file_id"],
+            "object": "vector_store.file",
+            "created_at": _now(),
+            "vector_store_id": store["id"],
+            "usage_bytes": 0,
+            "status": "completed",
+            "last_error": None,
+        })
+
+    async def create_file_batch(self, request: web.Request) -> web.Response:
+        store = self.vector_stores.get(request.match_info["id"])
+        if store is None:
+            return self._error(404, "No vector store found")
+        body = await request.json()
+        file_ids = body["file_ids"]
+        store["_file_ids"] += file_ids
+        batch = {
+            "id": self._id("vsfb"),
+            "object": "vector_store.files_batch",
+            "created_at": _now(),
+            "vector_store_id": store["id"],
+            "status": "in_progress",
+            "file_counts": {"in_progress": len(file_ids), "completed": 0, "failed": 0,
+                            "cancelled": 0, "total": len(file_ids)},
+            "_done_at": time.monotonic() + self.config.indexing_latency,
+        }
+        self.file_batches[batch["id"]] = batch
+        return web.json_response(self._public(batch))
+
+    async def get_file_batch(self, request: web.Request) -> web.Response:
+        batch = self.file_batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return self._error(404, "No file batch found")
+        counts = batch["file_counts"]
+        if batch["status"] == "in_progress":
+            remaining = batch["_done_at"] - time.monotonic()
+            total = counts["total"]
+            done = total if remaining <= 0 else int(total * (1 - remaining / self.config.indexing_latency))
+            counts["completed"], counts["in_progress"] = done, total - done
+            if done == total:
+                batch["status"] = "completed"
+                store = self.vector_stores[batch["vector_store_id"]]
+                store["file_counts"]["completed"] += total
+                store["file_counts"]["total"] += total
+        return web.json_response(self._public(batch))
+
+
+async def start_fake_openai(config: FakeOpenAIConfig | None = None, host: str = "127.0.0.1",
+                            port: int = 0) -> tuple[FakeOpenAI, web.AppRunner, str]:
+    """Start the fake server on the running loop; returns (server, runner, base_url)"""
+    fake = FakeOpenAI(config)
+    runner = web.AppRunner(fake.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return fake, runner, f"http://{host}:{port}/v1"
+
+
+def serve(config: FakeOpenAIConfig, host: str, port: int) -> None:
+    """Run the fake server until interrupted (used as a subprocess target)"""
+    web.run_app(FakeOpenAI(config).make_app(), host=host, port=port, access_log=None, print=None)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--queued-latency", type=float, default=FakeOpenAIConfig.queued_latency)
+    parser.add_argument("--run-latency", type=float, default=FakeOpenAIConfig.run_latency)
+    parser.add_argument("--tool-call-rate", type=float, default=FakeOpenAIConfig.tool_call_rate)
+    parser.add_argument("--api-latency", type=float, default=FakeOpenAIConfig.api_latency)
+    parser.add_argument("--answer-chars", type=int, default=FakeOpenAIConfig.answer_chars)
+    parser.add_argument("--rate-limit-rate", type=float, default=FakeOpenAIConfig.rate_limit_rate)
+    parser.add_argument("--assistant", action="append", default=[], dest="assistant_ids",
+                        help="id of an assistant created at startup (repeatable)")
+    args = parser.parse_args()
+    config = FakeOpenAIConfig(
+        queued_latency=args.queued_latency,
+        run_latency=args.run_latency,
+        tool_call_rate=args.tool_call_rate,
+        api_latency=args.api_latency,
+        answer_chars=args.answer_chars,
+        rate_limit_rate=args.rate_limit_rate,
+        assistant_ids=tuple(args.assistant_ids),
+    )
+    print(f"Fake OpenAI API on http://{args.host}:{args.port}/v1")
+    serve(config, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""Offline end-to-end load test of the bot.
+
+Runs the real `Chat` and `Assistant` cogs inside a real `GPTBot` against a
+fake Assistants API (in a separate process) and a synthetic Discord gateway
+and REST layer (in process). N scripted users each chat in their own thread
+and the harness reports message-to-reply latency percentiles, the number of
+OpenAI and Discord calls, and the peak memory of the bot process. Some
+messages carry a photo (--image-every), so the vision pipeline is exercised.
+
+    python -m benchmarks.load_test --threads 20 --messages 5 --run-latency 1
+    python -m benchmarks.load_test --threads 20 --json result.json --baseline baseline.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+from types import SimpleNamespace
+
+from benchmarks.fake_openai import FakeOpenAIConfig, serve
+
+GUILD_ID = 300000000000000001
+CHANNEL_ID = 300000000000000002
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_up(url: str, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def _get_json(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def configure_environment(openai_base_url: str, args: argparse.Namespace) -> None:
+    """Environment for src.constants and the OpenAI client; must run before importing src"""
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-benchmark",
+        "OPENAI_BASE_URL": openai_base_url,
+        "DISCORD_BOT_TOKEN": "benchmark",
+        "DISCORD_CLIENT_ID": "100000000000000002",
+        "ALLOWED_SERVER_IDS": str(GUILD_ID),
+        "DEFAULT_MODEL": "gpt-4",
+        "LOG_LEVEL": args.log_level,
+        "MAX_CONCURRENT_RUNS_PER_GUILD": str(args.max_runs_per_guild),
+        "MAX_CONCURRENT_RUNS_PER_CHANNEL": str(args.max_runs_per_guild),
+        "MAX_CONCURRENT_RUNS_PER_USER": "0",
+        "METRICS_PORT": "0",
+        # keep the fingerprint of the fake command tree out of the working directory
+        "COMMAND_TREE_FINGERPRINT_PATH": os.path.join(tempfile.gettempdir(), "load_test_command_tree"),
+        "RUN_JOURNAL_PATH": os.path.join(tempfile.mkdtemp(), "runs.db"),
+        "TRANSCRIPT_INDEX_PATH": os.path.join(tempfile.mkdtemp(), "transcripts.db"),
+        "DEAD_LETTER_PATH": os.path.join(tempfile.mkdtemp(), "dead_letters.db"),
+        "WIZARD_STORE_PATH": os.path.join(tempfile.mkdtemp(), "wizards.db"),
+    })
+    if args.workers:
+        # the bot only enqueues the messages, workers in this process answer them
+        os.environ["RUN_MODE"] = "gateway"
+        os.environ["JOB_QUEUE_PATH"] = os.path.join(tempfile.mkdtemp(), "jobs.db")
+
+
+def make_photo(width: int = 1600, height: int = 1200) -> bytes:
+    """A JPEG the size of a phone photo, prepared for vision before it is uploaded"""
+    from PIL import Image
+
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+async def run_load(args: argparse.Namespace, openai_base_url: str) -> dict:
+    import discord
+
+    from benchmarks.fake_discord import FakeDiscordREST, SyntheticGateway
+    from src.main import GPTBot
+    from src.metrics import RUN_TOKENS
+    from src.models.assistant import RunSettings
+    import mediawikiapi
+    from src.openai_api._client import get_client
+
+    # Stand-in for the Wikipedia API so that requires_action runs stay offline; the tool functions
+    # themselves run as in production
+    class FakePage:
+        def __init__(self, title: str):
+            self.summary = f"Summary of {title}"
+            self.content = f"Content of {title}"
+            self.url = f"https://ja.wikipedia.org/wiki/{title}"
+
+    class FakeMediaWikiAPI:
+        def __init__(self):
+            self.config = SimpleNamespace(language="en")
+
+        def search(self, query: str) -> list[str]:
+            assert self.config.language == "ja"
+            time.sleep(args.tool_latency)
+            return [query]
+
+        def page(self, title: str) -> FakePage:
+            return FakePage(title)
+
+    mediawikiapi.MediaWikiAPI = FakeMediaWikiAPI
+
+    rest = FakeDiscordREST(api_latency=args.discord_latency)
+    runner = await rest.start()
+
+    intents = discord.Intents.default()
+    intents.message_content = True
+    bot = GPTBot(intents=intents)
+    await bot.login("benchmark")  # runs setup_hook: loads the cogs and syncs the command tree
+    worker = None
+    if args.workers:
+        from src.worker import run_worker
+
+        worker = asyncio.create_task(run_worker(concurrency=args.workers))
+
+    openai_client = get_client()
+    gateway = SyntheticGateway(bot, rest)
+    guild = gateway.create_guild(GUILD_ID, CHANNEL_ID)
+    assistant = await openai_client.beta.assistants.create(
+        model="gpt-4", name="benchmark", instructions="You are a benchmark assistant.",
+        metadata={
+            **RunSettings(last_messages=args.last_messages or None).to_metadata(),
+            "answer_cache": "true" if args.answer_cache else "false",
+        },
+    )
+
+    threads = []
+    for i in range(args.threads):
+        openai_thread = await openai_client.beta.threads.create()
+        threads.append(gateway.create_chat_thread(
+            guild, CHANNEL_ID, name=f"💬✅ user{i}", openai_thread_id=openai_thread.id,
+            assistant_id=assistant.id,
+        ))
+
+    photo = make_photo() if args.image_every else b""
+    latencies: list[float] = []
+    failures = 0
+
+    async def scripted_user(i: int, thread: discord.Thread) -> None:
+        nonlocal failures
+        await asyncio.sleep(i * args.stagger)
+        for n in range(args.messages):
+            reply = rest.wait_for_reply(thread.id)
+            sent_at = time.monotonic()
+            # with the answer cache, the users ask the same questions, typed differently
+            content = (f"{'hi, ' if i % 2 else ''}what is the answer to exercise {n}?" if args.answer_cache
+                       else f"Question {n} from user {i}: what is a monad?")
+            # a photo with the first message of a thread, and every --image-every messages after it
+            attachments = None
+            if args.image_every and n % args.image_every == 0:
+                attachments = [rest.make_attachment(f"photo{i}_{n}.jpg", photo, "image/jpeg")]
+            gateway.send_user_message(thread, user_id=400000000000000000 + i, user_name=f"user{i}",
+                                      content=content, attachments=attachments)
+            try:
+                replied_at, reply_message = await asyncio.wait_for(reply, timeout=args.timeout)
+            except asyncio.TimeoutError:
+                failures += 1
+                continue
+            if any((embed.get("description") or "").startswith("**Error**") for embed in reply_message["embeds"]):
+                failures += 1
+                continue
+            latencies.append(replied_at - sent_at)
+            await asyncio.sleep(args.think_time)
+
+    started = time.monotonic()
+    await asyncio.gather(*(scripted_user(i, thread) for i, thread in enumerate(threads)))
+    elapsed = time.monotonic() - started
+    # let the remaining sends of multi-part replies finish
+    await asyncio.sleep(0.5)
+
+    if worker is not None:
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+    await bot.close()
+    await runner.cleanup()
+
+    openai_stats = _get_json(openai_base_url.rsplit("/v1", 1)[0] + "/_stats")
+    prompt_tokens = RUN_TOKENS.labels(kind="prompt")
+    return {
+        "threads": args.threads,
+        "messages_per_thread": args.messages,
+        "replies": len(latencies),
+        "failures": failures,
+        "elapsed_seconds": elapsed,
+        "throughput_replies_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_seconds": {
+            "mean": statistics.fmean(latencies) if latencies else float("nan"),
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else float("nan"),
+        },
+        "openai_calls": openai_stats["total"],
+        "empty_tool_outputs": openai_stats["empty_tool_outputs"],
+        "openai_calls_by_route": openai_stats["calls"],
+        "discord_calls": sum(rest.calls.values()),
+        "discord_calls_by_route": dict(rest.calls),
+        "prompt_tokens_per_run": prompt_tokens.sum / prompt_tokens.count if prompt_tokens.count else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_report(result: dict, baseline: dict | None = None) -> None:
+    def delta(key: str, value: float, path=()) -> str:
+        if baseline is None:
+            return ""
+        base = baseline
+        for p in path + (key,):
+            base = base.get(p, {}) if isinstance(base, dict) else {}
+        if not isinstance(base, (int, float)) or not base:
+            return ""
+        return f"  ({(value - base) / base:+.1%} vs baseline)"
+
+    latency = result["latency_seconds"]
+    print(f"threads x messages      {result['threads']} x {result['messages_per_thread']}")
+    print(f"replies / failures      {result['replies']} / {result['failures']}")
+    print(f"elapsed                 {result['elapsed_seconds']:.2f}s")
+    print(f"throughput              {result['throughput_replies_per_second']:.2f} replies/s"
+          + delta("throughput_replies_per_second", result["throughput_replies_per_second"]))
+    for key in ("mean", "p50", "p90", "p99", "max"):
+        print(f"latency {key:<15} {latency[key] * 1000:.0f} ms"
+              + delta(key, latency[key], ("latency_seconds",)))
+    print(f"tool outputs w/o result {result['empty_tool_outputs']}")
+    print(f"openai calls            {result['openai_calls']}" + delta("openai_calls", result["openai_calls"]))
+    print(f"discord calls           {result['discord_calls']}" + delta("discord_calls", result["discord_calls"]))
+    print(f"prompt tokens per run   {result['prompt_tokens_per_run']:.0f}"
+          + delta("prompt_tokens_per_run", result["prompt_tokens_per_run"]))
+    print(f"peak rss                {result['peak_rss_mb']:.1f} MB" + delta("peak_rss_mb", result["peak_rss_mb"]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=10, help="number of concurrent chat threads")
+    parser.add_argument("--messages", type=int, default=3, help="messages sent by the user of each thread")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds between a reply and the next message")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for each reply")
+    parser.add_argument("--queued-latency", type=float, default=0.2)
+    parser.add_argument("--run-latency", type=float, default=1.0)
+    parser.add_argument("--tool-call-rate", type=float, default=0.0)
+    parser.add_argument("--tool-latency", type=float, default=0.1)
+    parser.add_argument("--openai-latency", type=float, default=0.01, help="added to every OpenAI request")
+    parser.add_argument("--discord-latency", type=float, default=0.01, help="added to every Discord request")
+    parser.add_argument("--answer-chars", type=int, default=600)
+    parser.add_argument("--last-messages", type=int, default=0,
+                        help="truncation of the threads sent to the assistant (0 = no truncation)")
+    parser.add_argument("--answer-cache", action="store_true",
+                        help="enable the answer cache of the assistant (the users ask similar questions)")
+    parser.add_argument("--image-every", type=int, default=3,
+                        help="attach a photo to every Nth message of each user, from the first (0 = never)")
+    parser.add_argument("--stagger", type=float, default=0.0, help="seconds between the starts of the users")
+    parser.add_argument("--max-runs-per-guild", type=int, default=0, help="admission limit (0 = unlimited)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run in gateway mode with this many concurrent jobs in an in-process worker")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="write the result to this file")
+    parser.add_argument("--baseline", help="compare against a result written by --json")
+    args = parser.parse_args()
+
+    port = _free_port()
+    config = FakeOpenAIConfig(
+        queued_latency=args.queued_latency,
+        run_latency=args.run_latency,
+        tool_call_rate=args.tool_call_rate,
+        api_latency=args.openai_latency,
+        answer_chars=args.answer_chars,
+    )
+    server = multiprocessing.Process(target=serve, args=(config, "127.0.0.1", port), daemon=True)
+    server.start()
+    try:
+        _wait_until_up(f"http://127.0.0.1:{port}/_stats")
+        openai_base_url = f"http://127.0.0.1:{port}/v1"
+        configure_environment(openai_base_url, args)
+        result = asyncio.run(run_load(args, openai_base_url))
+    finally:
+        server.terminate()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if result["failures"] or result["empty_tool_outputs"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
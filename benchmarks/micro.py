@@ -0,0 +1,171 @@
+"""Micro-benchmarks for the per-message CPU path.
+
+Times the model conversions and rendering helpers on the recorded payloads
+in benchmarks/fixtures and reports, per call, the time and the memory
+allocated (peak and retained, measured with tracemalloc in a separate pass
+so it does not skew the timings).
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --json micro.json
+    python -m benchmarks.micro --baseline micro.json --max-regression 0.25   # exits 1 on regression
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+# src.constants reads these at import time
+for key, value in {
+    "OPENAI_API_KEY": "sk-benchmark",
+    "DISCORD_BOT_TOKEN": "benchmark",
+    "DISCORD_CLIENT_ID": "1",
+    "ALLOWED_SERVER_IDS": "1",
+    "DEFAULT_MODEL": "gpt-4",
+    "LOG_LEVEL": "WARNING",
+}.items():
+    os.environ.setdefault(key, value)
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def load_fixture(name: str) -> dict[str, Any]:
+    with open(FIXTURES / name, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_benchmarks() -> dict[str, Callable[[], Any]]:
+    from openai.types.beta.assistant import Assistant as OpenAIAssistant
+    from openai.types.beta.threads import Message as OpenAIThreadMessage
+
+    from src.discord_cogs._utils import split_into_shorter_messages
+    from src.models.assistant import Assistant
+    from src.models.message import ContentText, Message, MessageCreate
+
+    messages = {k: OpenAIThreadMessage.model_validate(v) for k, v in load_fixture("messages.json").items()}
+    assistants = {k: OpenAIAssistant.model_validate(v) for k, v in load_fixture("assistants.json").items()}
+    discord_messages = load_fixture("discord_messages.json")
+    loop = asyncio.new_event_loop()
+
+    benchmarks: dict[str, Callable[[], Any]] = {}
+
+    for name, kwargs in discord_messages.items():
+        benchmarks[f"MessageCreate.from_discord_message[{name}]"] = (
+            lambda kwargs=kwargs: MessageCreate.from_discord_message(thread_id="thread_abc123", **kwargs)
+        )
+        created = MessageCreate.from_discord_message(thread_id="thread_abc123", **kwargs)
+        benchmarks[f"MessageCreate.input_to_api_create[{name}]"] = created.input_to_api_create
+
+    for name, api_output in messages.items():
+        benchmarks[f"Message.from_api_output[{name}]"] = lambda m=api_output: Message.from_api_output(m)
+        # the content is converted lazily, so time the full conversion separately
+        benchmarks[f"Message.content[{name}]"] = lambda m=api_output: Message.from_api_output(m).content
+
+    for name, api_output in assistants.items():
+        benchmarks[f"Assistant.from_api_output[{name}]"] = lambda a=api_output: Assistant.from_api_output(a)
+        benchmarks[f"Assistant.from_api_output+input_to_api_update[{name}]"] = (
+            lambda a=api_output: Assistant.from_api_output(a).input_to_api_update()
+        )
+        assistant = Assistant.from_api_output(api_output)
+        benchmarks[f"Assistant.input_to_api_update[{name}]"] = assistant.input_to_api_update
+
+    # Rendering annotations downloads files, so only the text itself is rendered here
+    for name in ("short_answer", "long_answer"):
+        value = messages[name].content[0].text.value
+        content = ContentText(value=value, annotations=None)
+        benchmarks[f"ContentText.render[{name}]"] = lambda c=content: loop.run_until_complete(c.render())
+        benchmarks[f"split_into_shorter_messages[{name}]"] = lambda v=value: split_into_shorter_messages(v)
+
+    return benchmarks
+
+
+def time_per_call(fn: Callable[[], Any], min_time: float, repeats: int) -> dict[str, float]:
+    # calibrate the number of calls per sample so that a sample lasts ~min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start >= min_time / 10 or number >= 1 << 20:
+            break
+        number *= 2
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return {"min_us": min(samples) * 1e6, "median_us": statistics.median(samples) * 1e6}
+
+
+def allocations_per_call(fn: Callable[[], Any], calls: int = 20) -> dict[str, float]:
+    fn()  # warm caches (regex compilation, imports)
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(calls):
+            tracemalloc.clear_traces()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            result = fn()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(current - before)
+            del result
+    finally:
+        tracemalloc.stop()
+    return {"peak_kib": statistics.median(peaks) / 1024, "retained_kib": statistics.median(retained) / 1024}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per sample")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results written by --json")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="with --baseline, fail when a median time grows by more than this fraction")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<62} {'median':>10} {'min':>10} {'peak':>10} {'retained':>10}")
+    for name, fn in build_benchmarks().items():
+        if args.filter not in name:
+            continue
+        result = {**time_per_call(fn, args.min_time, args.repeats), **allocations_per_call(fn)}
+        results[name] = result
+        line = (f"{name:<62} {result['median_us']:>8.1f}us {result['min_us']:>8.1f}us "
+                f"{result['peak_kib']:>7.1f}KiB {result['retained_kib']:>7.1f}KiB")
+        if name in baseline:
+            change = result["median_us"] / baseline[name]["median_us"] - 1
+            line += f"  {change:+.1%}"
+            if change > args.max_regression:
+                regressions.append(name)
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.max_regression:.0%}:")
+        for name in regressions:
+            print(f"  {name}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
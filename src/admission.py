@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable
+
+from src.constants import (
+    MAX_CONCURRENT_RUNS_PER_CHANNEL,
+    MAX_CONCURRENT_RUNS_PER_GUILD,
+    MAX_CONCURRENT_RUNS_PER_USER,
+    MAX_QUEUED_RUNS,
+    TOKEN_BUDGET_PER_CHANNEL,
+    TOKEN_BUDGET_PER_GUILD,
+    TOKEN_BUDGET_PER_USER,
+    TOKEN_BUDGET_WINDOW_SECONDS,
+)
+from src.metrics import QUEUE_DEPTH
+from src.store import Store, store
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """The request was shed instead of queued"""
+
+
+@dataclass
+class Limits:
+    max_concurrent_runs: int = 0  # 0 = unlimited
+    token_budget: int = 0  # tokens per window, 0 = unlimited
+
+
+@dataclass
+class Ticket:
+    keys: tuple[tuple[str, int], ...]
+    admitted: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+    # total tokens used by the run, recorded against the budgets on release
+    tokens: int = 0
+
+
+class AdmissionController:
+    """Bound the number of concurrent runs and the tokens spent per guild, channel and user.
+
+    Requests over a concurrency limit wait in a FIFO queue. A waiting request
+    is admitted as soon as all of its own limits allow it, so a busy channel
+    does not hold back requests from other channels. Requests are shed when
+    the queue is full or a token budget is exhausted for the current window.
+
+    Concurrency is limited per process (a guild is always handled by the
+    same shard), while the token usage is kept in the shared store so that
+    the budgets hold across all the processes. With RUN_MODE=gateway, the
+    workers also only claim the jobs within the concurrency limits, counted
+    in the job queue, so the limits hold across the worker processes.
+    """
+
+    def __init__(self, limits: dict[str, Limits], max_queued: int, window: float, store: Store):
+        self.limits = limits
+        self.max_queued = max_queued
+        self.window = window
+        self.store = store
+        self._running: dict[tuple[str, int], int] = defaultdict(int)
+        self._waiting: deque[Ticket] = deque()
+
+    def _usage_key(self, key: tuple[str, int]) -> str:
+        # token usage is counted per fixed window
+        return f"tokens:{key[0]}:{key[1]}:{int(time.time() // self.window)}"
+
+    async def tokens_used(self, key: tuple[str, int]) -> int:
+        return await self.store.get(self._usage_key(key)) or 0
+
+    async def _check_budget(self, keys: tuple[tuple[str, int], ...]) -> None:
+        for scope, id in keys:
+            budget = self.limits[scope].token_budget
+            if budget and await self.tokens_used((scope, id)) >= budget:
+                raise AdmissionRejected(
+                    f"the token budget for this {scope} is used up, please try again later"
+                )
+
+    def _fits(self, keys: tuple[tuple[str, int], ...]) -> bool:
+        for scope, id in keys:
+            limit = self.limits[scope].max_concurrent_runs
+            if limit and self._running.get((scope, id), 0) >= limit:
+                return False
+        return True
+
+    def _start(self, ticket: Ticket) -> None:
+        for key in ticket.keys:
+            self._running[key] += 1
+        ticket.admitted.set_result(True)
+
+    def position(self, ticket: Ticket) -> int:
+        """1-based position of a waiting ticket in the queue"""
+        return self._waiting.index(ticket) + 1
+
+    async def acquire(
+        self,
+        guild_id: int,
+        channel_id: int,
+        user_id: int,
+        on_queued: Callable[[int], Awaitable[None]] | None = None,
+    ) -> Ticket:
+        keys = (("guild", guild_id), ("channel", channel_id), ("user", user_id))
+        await self._check_budget(keys)
+        ticket = Ticket(keys=keys)
+        if self._fits(keys):
+            self._start(ticket)
+            return ticket
+
+        if self.max_queued and len(self._waiting) >= self.max_queued:
+            raise AdmissionRejected("too many requests are waiting, please try again later")
+        self._waiting.append(ticket)
+        QUEUE_DEPTH.labels(queue="admission").set(len(self._waiting))
+        logger.info(f"Queued run for {keys} at position {len(self._waiting)}")
+        try:
+            if on_queued is not None:
+                await on_queued(self.position(ticket))
+            await ticket.admitted
+        except BaseException:
+            if ticket.admitted.done() and not ticket.admitted.cancelled():
+                self.release(ticket)
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+                QUEUE_DEPTH.labels(queue="admission").set(len(self._waiting))
+            raise
+        return ticket
+
+    async def record_usage(self, ticket: Ticket) -> None:
+        """Count the tokens used by the run against the budgets"""
+        if not ticket.tokens:
+            return
+        for scope, id in ticket.keys:
+            if self.limits[scope].token_budget:
+                try:
+                    await self.store.incr(self._usage_key((scope, id)), ticket.tokens, ttl=self.window)
+                except Exception as e:
+                    logger.warning(f"Failed to record the token usage of {scope} {id}: {e}")
+
+    def release(self, ticket: Ticket) -> None:
+        for key in ticket.keys:
+            self._running[key] -= 1
+            if self._running[key] <= 0:
+                del self._running[key]
+
+        # admit waiting requests whose limits now allow them, in FIFO order
+        for waiting in list(self._waiting):
+            if waiting.admitted.cancelled():
+                self._waiting.remove(waiting)
+            elif self._fits(waiting.keys):
+                self._waiting.remove(waiting)
+                self._start(waiting)
+        QUEUE_DEPTH.labels(queue="admission").set(len(self._waiting))
+
+    @asynccontextmanager
+    async def admit(self, **kwargs) -> AsyncIterator[Ticket]:
+        ticket = await self.acquire(**kwargs)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+            await self.record_usage(ticket)
+
+
+admission = AdmissionController(
+    limits={
+        "guild": Limits(MAX_CONCURRENT_RUNS_PER_GUILD, TOKEN_BUDGET_PER_GUILD),
+        "channel": Limits(MAX_CONCURRENT_RUNS_PER_CHANNEL, TOKEN_BUDGET_PER_CHANNEL),
+        "user": Limits(MAX_CONCURRENT_RUNS_PER_USER, TOKEN_BUDGET_PER_USER),
+    },
+    max_queued=MAX_QUEUED_RUNS,
+    window=TOKEN_BUDGET_WINDOW_SECONDS,
+    store=store,
+)
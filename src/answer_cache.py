@@ -0,0 +1,160 @@
+"""Answer cache for repeated questions to the same assistant.
+
+In a lecture many students ask an assistant nearly the same question. When
+the cache is enabled for an assistant (`answer_cache` in its metadata), the
+answer to a question is kept, and a later question whose text is close
+enough gets the same answer at once, without a run.
+
+Questions are compared as hashed character n-gram vectors: each question is
+normalized, its 2- and 3-grams (which also work for Japanese, without word
+boundaries) are hashed into a fixed number of buckets, and the vector is
+normalized to unit length. The vectors of an assistant are the columns of a
+bounded NumPy matrix, so a lookup is a single vector-matrix product. Since a
+question only has a few hundred n-grams, the product only reads the rows of
+these n-grams. When the matrix is full, the oldest entries are replaced. A number changes the
+question (exercise 3 is not exercise 4) while it barely changes the vector,
+so only the questions with the same numbers are compared.
+
+The cache is kept in memory per process, for at most
+ANSWER_CACHE_MAX_ASSISTANTS assistants: the matrix of an assistant can take
+DIMENSIONS * ANSWER_CACHE_MAX_ENTRIES floats (8 MB with 500 entries), so the
+entries of the assistant used least recently are dropped first. Each
+assistant has a generation counter in the shared store, incremented by
+update_assistant, and the entries of an older generation are dropped on the
+next lookup.
+"""
+from __future__ import annotations
+
+import re
+import unicodedata
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from src.constants import ANSWER_CACHE_MAX_ASSISTANTS, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_THRESHOLD
+
+DIMENSIONS = 4096
+NGRAM_SIZES = (2, 3)
+INITIAL_COLUMNS = 64
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+_NUMBER = re.compile(r"\d+")
+
+
+def normalize(text: str) -> str:
+    """Fold the case and the width of the characters and drop the punctuation"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def vectorize(text: str) -> np.ndarray | None:
+    """Unit vector of the hashed character n-grams of the normalized text, None if it is empty"""
+    text = normalize(text)
+    if not text:
+        return None
+    padded = f" {text} "
+    buckets = [
+        zlib.crc32(padded[i:i + n].encode()) % DIMENSIONS
+        for n in NGRAM_SIZES for i in range(len(padded) - n + 1)
+    ]
+    if not buckets:
+        return None
+    counts = np.bincount(buckets, minlength=DIMENSIONS).astype(np.float32)
+    # sublinear term frequency, so repeated words do not dominate
+    np.log1p(counts, out=counts)
+    return counts / np.linalg.norm(counts)
+
+
+def numbers_key(text: str) -> int:
+    """Hash of the numbers in the normalized text"""
+    return zlib.crc32(" ".join(_NUMBER.findall(normalize(text))).encode())
+
+
+class _Entries:
+    """The cached questions and answers of one assistant"""
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        # one column per question, grown by doubling up to the maximum number of entries
+        self.vectors = np.zeros((DIMENSIONS, INITIAL_COLUMNS), dtype=np.float32)
+        self.numbers = np.zeros(INITIAL_COLUMNS, dtype=np.int64)
+        self.answers: list[str] = []
+        # next column to replace once the matrix is full
+        self.next_column = 0
+
+    def lookup(self, vector: np.ndarray, numbers: int) -> tuple[str | None, float]:
+        count = len(self.answers)
+        if not count:
+            return None, 0.0
+        ngrams = np.flatnonzero(vector)
+        similarities = vector[ngrams] @ self.vectors[ngrams, :count]
+        similarities[self.numbers[:count] != numbers] = -1.0
+        best = int(np.argmax(similarities))
+        return self.answers[best], float(similarities[best])
+
+    def add(self, vector: np.ndarray, numbers: int, answer: str, max_entries: int) -> None:
+        count = len(self.answers)
+        if count < max_entries:
+            if count == self.vectors.shape[1]:
+                columns = min(2 * count, max_entries)
+                vectors = np.zeros((DIMENSIONS, columns), dtype=np.float32)
+                vectors[:, :count] = self.vectors
+                self.vectors = vectors
+                self.numbers = np.resize(self.numbers, columns)
+            self.vectors[:, count] = vector
+            self.numbers[count] = numbers
+            self.answers.append(answer)
+            return
+        self.vectors[:, self.next_column] = vector
+        self.numbers[self.next_column] = numbers
+        self.answers[self.next_column] = answer
+        self.next_column = (self.next_column + 1) % max_entries
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        max_assistants: int = ANSWER_CACHE_MAX_ASSISTANTS,
+    ):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.max_assistants = max_assistants
+        # least recently used first
+        self._assistants: OrderedDict[str, _Entries] = OrderedDict()
+
+    def _entries(self, assistant_id: str, generation: int) -> _Entries:
+        entries = self._assistants.get(assistant_id)
+        if entries is None or entries.generation != generation:
+            # first use, or the assistant was updated since the answers were cached
+            entries = self._assistants[assistant_id] = _Entries(generation)
+        self._assistants.move_to_end(assistant_id)
+        while len(self._assistants) > self.max_assistants:
+            self._assistants.popitem(last=False)
+        return entries
+
+    def lookup(self, assistant_id: str, question: str, generation: int = 0) -> str | None:
+        """The cached answer to the closest question, if it is similar enough"""
+        vector = vectorize(question)
+        if vector is None:
+            return None
+        answer, similarity = self._entries(assistant_id, generation).lookup(vector, numbers_key(question))
+        return answer if similarity >= self.threshold else None
+
+    def add(self, assistant_id: str, question: str, answer: str, generation: int = 0) -> None:
+        vector = vectorize(question)
+        if vector is not None:
+            self._entries(assistant_id, generation).add(vector, numbers_key(question), answer, self.max_entries)
+
+    def invalidate(self, assistant_id: str) -> None:
+        self._assistants.pop(assistant_id, None)
+
+    def __len__(self) -> int:
+        return sum(len(entries.answers) for entries in self._assistants.values())
+
+
+answer_cache = AnswerCache()
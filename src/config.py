@@ -0,0 +1,178 @@
+"""Settings that can be changed without restarting the bot.
+
+They are read from the environment, as the other constants, and from the
+YAML file at CONFIG_PATH if it exists, which can also override them per
+guild:
+
+    allowed_server_ids: [123456789012345678, 234567890123456789]
+    default_model: gpt-4-turbo
+    max_chars_per_reply_msg: 1500
+    max_assistant_list: 20
+    guilds:
+      234567890123456789:
+        default_model: gpt-4o
+        max_chars_per_reply_msg: 1800
+
+The file is checked every CONFIG_RELOAD_INTERVAL_SECONDS and reloaded when
+it changes, in the bot and in the workers, or at once with `/reload config`.
+A reload builds and validates new settings entirely, then replaces the
+current ones in one assignment: a reader sees either the old or the new
+settings, never a mix of both. An invalid file is logged and ignored.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field, fields, replace
+from types import MappingProxyType
+from typing import Any, Mapping
+
+import yaml
+
+from src.constants import (
+    ALLOWED_SERVER_IDS,
+    CONFIG_PATH,
+    CONFIG_RELOAD_INTERVAL_SECONDS,
+    DEFAULT_MODEL,
+    MAX_ASSISTANT_LIST,
+    MAX_CHARS_PER_REPLY_MSG,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class GuildSettings:
+    """The settings that can be overridden per guild"""
+
+    default_model: str = DEFAULT_MODEL
+    # discord has a 2k limit
+    max_chars_per_reply_msg: int = MAX_CHARS_PER_REPLY_MSG
+    max_assistant_list: int = MAX_ASSISTANT_LIST
+
+
+# valid range of the integer settings
+LIMITS = {
+    "max_chars_per_reply_msg": (100, 2000),
+    "max_assistant_list": (1, 100),
+}
+
+
+@dataclass(frozen=True)
+class Settings:
+    allowed_server_ids: frozenset[int] = frozenset(ALLOWED_SERVER_IDS)
+    defaults: GuildSettings = GuildSettings()
+    guilds: Mapping[int, GuildSettings] = field(default_factory=lambda: MappingProxyType({}))
+
+    def for_guild(self, guild_id: int | None) -> GuildSettings:
+        """The settings of the guild, the defaults with its overrides"""
+        return self.guilds.get(guild_id, self.defaults)
+
+
+def _guild_settings(base: GuildSettings, values: dict[str, Any], where: str) -> GuildSettings:
+    names = {f.name for f in fields(GuildSettings)}
+    overrides = {}
+    for name, value in values.items():
+        if name not in names:
+            raise ValueError(f"{where}: unknown setting `{name}`")
+        if name in LIMITS:
+            low, high = LIMITS[name]
+            if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+                raise ValueError(f"{where}: `{name}` must be an integer between {low} and {high}")
+        elif not isinstance(value, str) or not value:
+            raise ValueError(f"{where}: `{name}` must be a string")
+        overrides[name] = value
+    return replace(base, **overrides)
+
+
+def parse_settings(data: dict[str, Any] | None) -> Settings:
+    """Settings from the content of the config file, on top of the environment.
+    Raise ValueError if the content is invalid.
+    """
+    if data is not None and not isinstance(data, dict):
+        raise ValueError("the config must be a mapping")
+    data = dict(data or {})
+    allowed_server_ids = frozenset(ALLOWED_SERVER_IDS)
+    if "allowed_server_ids" in data:
+        ids = data.pop("allowed_server_ids")
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            raise ValueError("`allowed_server_ids` must be a list of guild ids")
+        allowed_server_ids = frozenset(ids)
+    guilds = data.pop("guilds", None) or {}
+    if not isinstance(guilds, dict):
+        raise ValueError("`guilds` must map guild ids to settings")
+
+    defaults = _guild_settings(GuildSettings(), data, "config")
+    overrides = {}
+    for guild_id, values in guilds.items():
+        if not isinstance(values, dict):
+            raise ValueError(f"guild {guild_id}: the settings must be a mapping")
+        overrides[int(guild_id)] = _guild_settings(defaults, values, f"guild {guild_id}")
+    return Settings(allowed_server_ids=allowed_server_ids, defaults=defaults, guilds=MappingProxyType(overrides))
+
+
+_settings: Settings | None = None
+# modification time of the config file the settings were read from, None if there was no file
+_mtime: float | None = None
+
+
+def _modification_time() -> float | None:
+    try:
+        return os.stat(CONFIG_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def reload_settings(force: bool = False) -> bool:
+    """Read the config file again if it changed since the last read, or always with `force`.
+    Return True if the settings changed. Raise ValueError if the file is invalid, the current
+    settings are then kept.
+    """
+    global _settings, _mtime
+    mtime = _modification_time()
+    if not force and _settings is not None and mtime == _mtime:
+        return False
+    data = None
+    if mtime is not None:
+        with open(CONFIG_PATH, encoding="utf-8") as f:
+            try:
+                data = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"invalid YAML: {e}") from e
+    settings = parse_settings(data)
+    changed = settings != _settings
+    _settings, _mtime = settings, mtime
+    if not changed:
+        return False
+    logger.info(
+        f"Loaded the settings from {CONFIG_PATH if mtime is not None else 'the environment'}: "
+        f"{len(settings.allowed_server_ids)} allowed servers, {len(settings.guilds)} guild overrides"
+    )
+    return True
+
+
+def _reload_or_keep() -> None:
+    global _settings, _mtime
+    try:
+        reload_settings()
+    except (OSError, ValueError) as e:
+        logger.error(f"Ignoring the invalid config file {CONFIG_PATH}: {e}")
+        # the settings of the environment until the file is fixed, and not read again until it changes
+        if _settings is None:
+            _settings = Settings()
+        _mtime = _modification_time()
+
+
+def get_settings() -> Settings:
+    """The current settings, read on first use"""
+    if _settings is None:
+        _reload_or_keep()
+    return _settings
+
+
+async def watch_config(interval: float = CONFIG_RELOAD_INTERVAL_SECONDS) -> None:
+    """Reload the settings whenever the config file changes"""
+    while True:
+        _reload_or_keep()
+        await asyncio.sleep(interval)
@@ -27,3 +27,114 @@ INACTIVATE_BUILD_THREAD_PREFIX = "🔨❌"
 MAX_CHARS_PER_REPLY_MSG = 1500  # discord has a 2k limit, we just break message into 1.5k
 
 MAX_ASSISTANT_LIST = 20  # must be between 1 and 100
+MAX_COMPARE_ASSISTANTS = 5  # assistants run at once by /compare
+
+# YAML file of the settings reloaded at runtime, with per-guild overrides (see src/config.py)
+CONFIG_PATH = os.environ.get("CONFIG_PATH", "config.yaml")
+CONFIG_RELOAD_INTERVAL_SECONDS = float(os.environ.get("CONFIG_RELOAD_INTERVAL_SECONDS", "5"))
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# Tracing: spans are exported to a local JSONL file and/or an OTLP/HTTP collector
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH")
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT")
+
+# Embedded HTTP server exposing /metrics, /healthz and /readyz (disabled when 0)
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# Admission control: concurrent runs and token budgets per guild, channel and user (0 = unlimited)
+MAX_CONCURRENT_RUNS_PER_GUILD = int(os.environ.get("MAX_CONCURRENT_RUNS_PER_GUILD", "0"))
+MAX_CONCURRENT_RUNS_PER_CHANNEL = int(os.environ.get("MAX_CONCURRENT_RUNS_PER_CHANNEL", "0"))
+MAX_CONCURRENT_RUNS_PER_USER = int(os.environ.get("MAX_CONCURRENT_RUNS_PER_USER", "0"))
+TOKEN_BUDGET_PER_GUILD = int(os.environ.get("TOKEN_BUDGET_PER_GUILD", "0"))
+TOKEN_BUDGET_PER_CHANNEL = int(os.environ.get("TOKEN_BUDGET_PER_CHANNEL", "0"))
+TOKEN_BUDGET_PER_USER = int(os.environ.get("TOKEN_BUDGET_PER_USER", "0"))
+TOKEN_BUDGET_WINDOW_SECONDS = int(os.environ.get("TOKEN_BUDGET_WINDOW_SECONDS", "3600"))
+MAX_QUEUED_RUNS = int(os.environ.get("MAX_QUEUED_RUNS", "0"))  # requests beyond this are shed (0 = no limit)
+
+# The command tree is only synced with Discord when its fingerprint differs from the stored one
+COMMAND_TREE_FINGERPRINT_PATH = os.environ.get("COMMAND_TREE_FINGERPRINT_PATH", ".command_tree_fingerprint")
+FORCE_COMMAND_SYNC = os.environ.get("FORCE_COMMAND_SYNC", "false").lower() in ("1", "true", "yes")
+
+
+def _parse_shard_ids(value: str) -> list[int] | None:
+    """Parse shard ids like "0-3,8" """
+    if not value:
+        return None
+    shard_ids = []
+    for part in value.split(","):
+        start, _, end = part.partition("-")
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return shard_ids
+
+
+# Sharding: SHARD_COUNT=auto uses the count recommended by Discord. Processes sharing
+# the load each set SHARD_IDS to their own range, e.g. "0-3" and "4-7" with SHARD_COUNT=8
+_shard_count = os.environ.get("SHARD_COUNT", "1")
+SHARD_COUNT: int | None = None if _shard_count == "auto" else int(_shard_count)
+SHARD_IDS = _parse_shard_ids(os.environ.get("SHARD_IDS", ""))
+
+# State shared between processes (thread mappings, token budgets):
+# memory://, sqlite:///path/to/store.db or http://host:port (python -m src.store)
+STORE_URL = os.environ.get("STORE_URL", "memory://")
+# How long the OpenAI thread and assistant of a Discord thread are remembered
+THREAD_MAPPING_TTL_SECONDS = int(os.environ.get("THREAD_MAPPING_TTL_SECONDS", str(7 * 24 * 3600)))
+# Replace the OpenAI thread of a chat by a new thread seeded with a summary once it reaches
+# this many messages or the prompt of a run reaches this many tokens (0 = never)
+COMPACT_THREAD_MESSAGES = int(os.environ.get("COMPACT_THREAD_MESSAGES", "0"))
+COMPACT_THREAD_PROMPT_TOKENS = int(os.environ.get("COMPACT_THREAD_PROMPT_TOKENS", "0"))
+# How long the metadata of an assistant (run settings, answer cache) is cached
+ASSISTANT_METADATA_TTL_SECONDS = int(os.environ.get("ASSISTANT_METADATA_TTL_SECONDS", "300"))
+# Answers kept per assistant with the answer cache enabled, and the similarity of the
+# questions (0-1) above which a cached answer is sent
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "500"))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.9"))
+# Assistants whose answers are cached at once per process, the least recently used dropped first
+ANSWER_CACHE_MAX_ASSISTANTS = int(os.environ.get("ANSWER_CACHE_MAX_ASSISTANTS", "16"))
+# Deadlines of a run, in seconds (0 = none): time spent queued, in progress and running the
+# function tools, and in total. A run over a deadline is cancelled and an error is sent.
+RUN_QUEUED_TIMEOUT_SECONDS = float(os.environ.get("RUN_QUEUED_TIMEOUT_SECONDS", "120"))
+RUN_IN_PROGRESS_TIMEOUT_SECONDS = float(os.environ.get("RUN_IN_PROGRESS_TIMEOUT_SECONDS", "300"))
+RUN_TOOL_TIMEOUT_SECONDS = float(os.environ.get("RUN_TOOL_TIMEOUT_SECONDS", "60"))
+RUN_TOTAL_TIMEOUT_SECONDS = float(os.environ.get("RUN_TOTAL_TIMEOUT_SECONDS", "600"))
+# Journal of the runs whose answer is not delivered yet, resumed after a restart. Unfinished
+# runs older than RUN_RESUME_MAX_AGE_SECONDS are cancelled instead.
+RUN_JOURNAL_PATH = os.environ.get("RUN_JOURNAL_PATH", "runs.db")
+RUN_RESUME_MAX_AGE_SECONDS = float(os.environ.get("RUN_RESUME_MAX_AGE_SECONDS", "900"))
+# Full-text index of the chat transcripts for /history search, empty to disable it
+TRANSCRIPT_INDEX_PATH = os.environ.get("TRANSCRIPT_INDEX_PATH", "transcripts.db")
+# Images sent to Discord are recompressed, or downscaled, above these budgets, in a pool of
+# MEDIA_PROCESS_WORKERS processes
+OUTGOING_IMAGE_MAX_BYTES = int(os.environ.get("OUTGOING_IMAGE_MAX_BYTES", str(8 * 1024 * 1024)))
+OUTGOING_IMAGE_MAX_PIXELS = int(os.environ.get("OUTGOING_IMAGE_MAX_PIXELS", str(2048 * 2048)))
+MEDIA_PROCESS_WORKERS = int(os.environ.get("MEDIA_PROCESS_WORKERS", "2"))
+# Calls failing with a transient error (connection error, timeout, 429, 5xx) are retried up to
+# RETRY_MAX_ATTEMPTS times in all, with an exponential backoff and jitter
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_INITIAL_DELAY_SECONDS = float(os.environ.get("RETRY_INITIAL_DELAY_SECONDS", "0.5"))
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get("RETRY_MAX_DELAY_SECONDS", "10"))
+# Ids of the thread messages remembered, to ignore the events replayed after a gateway reconnect
+PROCESSED_MESSAGES_MAX = int(os.environ.get("PROCESSED_MESSAGES_MAX", "10000"))
+# Replies that could not be delivered are kept in DEAD_LETTER_PATH and sent again every
+# DEAD_LETTER_RETRY_INTERVAL_SECONDS, until they are DEAD_LETTER_MAX_AGE_SECONDS old
+DEAD_LETTER_PATH = os.environ.get("DEAD_LETTER_PATH", "dead_letters.db")
+DEAD_LETTER_RETRY_INTERVAL_SECONDS = float(os.environ.get("DEAD_LETTER_RETRY_INTERVAL_SECONDS", "30"))
+DEAD_LETTER_MAX_AGE_SECONDS = float(os.environ.get("DEAD_LETTER_MAX_AGE_SECONDS", str(24 * 3600)))
+
+# all: handle the gateway and run the assistants in this process
+# gateway: only validate messages and enqueue them for the workers (python -m src.worker)
+# worker: run the workers (same as python -m src.worker)
+RUN_MODE = os.environ.get("RUN_MODE", "all")
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "jobs.db")
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "120"))  # extended while the job runs
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES") or os.cpu_count() or 1)
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "4"))  # jobs run at once per worker process
+
+# /build and /update wizards: time to answer each question, and how long an unfinished wizard is kept
+WIZARD_STEP_TIMEOUT_SECONDS = int(os.environ.get("WIZARD_STEP_TIMEOUT_SECONDS", "600"))
+WIZARD_STATE_TTL_SECONDS = int(os.environ.get("WIZARD_STATE_TTL_SECONDS", str(24 * 3600)))
+# With STORE_URL=memory://, the wizards are saved in this SQLite file instead, so they survive a
+# restart (empty = in memory too)
+WIZARD_STORE_PATH = os.environ.get("WIZARD_STORE_PATH", "wizards.db")
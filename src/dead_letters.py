@@ -0,0 +1,199 @@
+"""Store of the replies that could not be delivered to Discord.
+
+When a part of an answer still cannot be sent after its retries, e.g.
+during an outage of Discord, the parts not sent yet are kept as a dead
+letter, with their embeds and files, instead of being lost. The bot and
+the workers send the dead letters again in the background, each after an
+exponential backoff, and drop them once DEAD_LETTER_MAX_AGE_SECONDS old,
+or when their thread is gone.
+
+Dead letters are rows of a SQLite database shared by the processes of one
+host, like the job queue. A process claims the letters it sends for a
+while, so that two processes do not send the same letter.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any
+
+import discord
+
+from src.constants import DEAD_LETTER_PATH, DEAD_LETTER_RETRY_INTERVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# a letter being sent is not claimed by another process during this time
+CLAIM_SECONDS = 300
+MAX_REDELIVERY_DELAY = 3600
+
+
+@dataclass
+class DeadLetter:
+    id: int
+    discord_thread_id: int
+    guild_id: int | None
+    # keyword arguments of the sends left, in order
+    parts: list[dict[str, Any]]
+    attempts: int
+    # wall-clock time the first delivery failed
+    created_at: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+
+def redelivery_delay(attempts: int) -> float:
+    """Delay before sending a letter again after its attempts failed, doubled at each attempt"""
+    delay = min(DEAD_LETTER_RETRY_INTERVAL_SECONDS * 2 ** min(attempts, 16), MAX_REDELIVERY_DELAY)
+    # with jitter, so the letters of one outage are not all sent at once
+    return delay * random.uniform(0.5, 1.0)
+
+
+def encode_part(kwargs: dict[str, Any]) -> dict[str, Any]:
+    """The content, embeds and files of the keyword arguments of a send, as JSON"""
+    part: dict[str, Any] = {}
+    if kwargs.get("content"):
+        part["content"] = kwargs["content"]
+    embeds = kwargs.get("embeds") or ([kwargs["embed"]] if kwargs.get("embed") is not None else [])
+    if embeds:
+        part["embeds"] = [embed.to_dict() for embed in embeds]
+    files = kwargs.get("files") or ([kwargs["file"]] if kwargs.get("file") is not None else [])
+    if files:
+        part["files"] = []
+        for file in files:
+            file.reset()
+            part["files"].append({"filename": file.filename, "data": base64.b64encode(file.fp.read()).decode()})
+    return part
+
+
+def decode_part(part: dict[str, Any]) -> dict[str, Any]:
+    """The keyword arguments of the send of an encoded part"""
+    kwargs: dict[str, Any] = {}
+    if "content" in part:
+        kwargs["content"] = part["content"]
+    if "embeds" in part:
+        kwargs["embeds"] = [discord.Embed.from_dict(embed) for embed in part["embeds"]]
+    if "files" in part:
+        kwargs["files"] = [
+            discord.File(BytesIO(base64.b64decode(file["data"])), filename=file["filename"]) for file in part["files"]
+        ]
+    return kwargs
+
+
+class DeadLetterStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                discord_thread_id INTEGER NOT NULL,
+                guild_id INTEGER,
+                parts TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                error TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS dead_letters_available ON dead_letters (available_at)")
+        self._lock = threading.Lock()
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, parameters)
+
+    def _add(self, discord_thread_id: int, guild_id: int | None, parts: str, error: str, retry_delay: float) -> int:
+        now = time.time()
+        cursor = self._execute(
+            "INSERT INTO dead_letters (discord_thread_id, guild_id, parts, available_at, error, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (discord_thread_id, guild_id, parts, now + retry_delay, error, now),
+        )
+        return cursor.lastrowid
+
+    def _claim(self, limit: int) -> list[DeadLetter]:
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock, so two processes cannot claim the same letter
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, discord_thread_id, guild_id, parts, attempts, created_at FROM dead_letters"
+                    " WHERE available_at <= ? ORDER BY id LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE dead_letters SET available_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(now + CLAIM_SECONDS, row[0]) for row in rows],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [
+            DeadLetter(id, discord_thread_id, guild_id, json.loads(parts), attempts + 1, created_at)
+            for id, discord_thread_id, guild_id, parts, attempts, created_at in rows
+        ]
+
+    def _release(self, letter_id: int, parts: str, error: str, retry_delay: float) -> None:
+        self._execute(
+            "UPDATE dead_letters SET parts = ?, error = ?, available_at = ? WHERE id = ?",
+            (parts, error, time.time() + retry_delay, letter_id),
+        )
+
+    def _remove(self, letter_id: int) -> None:
+        self._execute("DELETE FROM dead_letters WHERE id = ?", (letter_id,))
+
+    def _depth(self) -> int:
+        return self._execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+
+    async def add(
+        self, discord_thread_id: int, guild_id: int | None, parts: list[dict[str, Any]], error: str,
+        retry_delay: float,
+    ) -> int:
+        """Keep the encoded parts of a reply, to send them again after `retry_delay` seconds"""
+        return await asyncio.to_thread(
+            self._add, discord_thread_id, guild_id, json.dumps(parts), error, retry_delay
+        )
+
+    async def claim(self, limit: int = 10) -> list[DeadLetter]:
+        """The letters due, oldest first, not claimed by another process"""
+        return await asyncio.to_thread(self._claim, limit)
+
+    async def release(self, letter: DeadLetter, error: str) -> None:
+        """Keep the parts of the letter left to send, to try again after a backoff"""
+        await asyncio.to_thread(
+            self._release, letter.id, json.dumps(letter.parts), error, redelivery_delay(letter.attempts)
+        )
+
+    async def remove(self, letter: DeadLetter) -> None:
+        await asyncio.to_thread(self._remove, letter.id)
+
+    async def depth(self) -> int:
+        return await asyncio.to_thread(self._depth)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+_dead_letters: DeadLetterStore | None = None
+
+
+def get_dead_letters() -> DeadLetterStore:
+    """Return the store at DEAD_LETTER_PATH, opened on first use"""
+    global _dead_letters
+    if _dead_letters is None:
+        _dead_letters = DeadLetterStore(DEAD_LETTER_PATH)
+    return _dead_letters
@@ -4,11 +4,8 @@ from typing import Optional
 import discord
 from discord import Message as DiscordMessage
 
-from src.constants import (
-    ALLOWED_SERVER_IDS,
-    MAX_ASSISTANT_LIST,
-    MAX_CHARS_PER_REPLY_MSG
-)
+from src.config import get_settings
+from src.constants import MAX_ASSISTANT_LIST
 from src.openai_api.assistants import list_assistants
 
 logger = logging.getLogger(__name__)
@@ -37,7 +34,10 @@ async def search_assistants(search: str = '', limit: int = MAX_ASSISTANT_LIST):
     return found
 
 
-def split_into_shorter_messages(text : str, limit=MAX_CHARS_PER_REPLY_MSG, code_block="```"):
+def split_into_shorter_messages(text : str, limit: int | None = None, code_block="```"):
+    if limit is None:
+        limit = get_settings().defaults.max_chars_per_reply_msg
+
     def split_at_boundary(s, boundary):
         parts = s.split(boundary)
         result = []
@@ -107,8 +107,34 @@ def should_block(guild: Optional[discord.Guild]) -> bool:
         logger.info(f"DM not supported")
         return True
 
-    if guild.id and guild.id not in ALLOWED_SERVER_IDS:
+    # a frozenset, replaced as a whole when the config is reloaded
+    if guild.id and guild.id not in get_settings().allowed_server_ids:
         # not allowed in this server
         logger.info(f"Guild {guild} not allowed")
         return True
     return False
+
+
+def channel_guild_id(channel: discord.abc.Messageable) -> Optional[int]:
+    """Guild id of a channel, also for the partial channels of the workers"""
+    guild_id = getattr(channel, "guild_id", None)
+    if guild_id is None and getattr(channel, "guild", None) is not None:
+        guild_id = channel.guild.id
+    return guild_id
+
+
+def get_embed_field(embed: discord.Embed, name: str) -> Optional[str]:
+    """Value of the field of the embed with this name, None if there is none"""
+    for field in embed.fields:
+        if field.name == name:
+            return field.value
+    return None
+
+
+def set_embed_field(embed: discord.Embed, name: str, value: str) -> None:
+    """Set the value of the field of the embed with this name, adding the field if missing"""
+    for i, field in enumerate(embed.fields):
+        if field.name == name:
+            embed.set_field_at(i, name=name, value=value, inline=field.inline)
+            return
+    embed.add_field(name=name, value=value)
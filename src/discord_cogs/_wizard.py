@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, TypeVar
+
+import discord
+from discord import Message as DiscordMessage
+
+from src.constants import STORE_URL, WIZARD_STATE_TTL_SECONDS, WIZARD_STEP_TIMEOUT_SECONDS, WIZARD_STORE_PATH
+from src.metrics import QUEUE_DEPTH
+from src.store import SQLiteStore, Store, store
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+KEY_PREFIX = "wizard:"
+
+
+class WizardTimeout(Exception):
+    """The user did not answer a question of the wizard in time"""
+
+
+class WizardSession:
+    """A /build or /update wizard run by one user in one thread.
+
+    Every answer is saved as soon as it is given. When a wizard is resumed
+    after a restart, the saved answers are replayed in order without asking
+    again, and the messages of the replayed steps are not sent again.
+    """
+
+    def __init__(
+        self,
+        dispatcher: WizardDispatcher,
+        kind: str,
+        thread: discord.Thread,
+        user_id: int,
+        params: dict[str, Any],
+        answers: dict[str, Any] | None = None,
+    ):
+        self.dispatcher = dispatcher
+        self.kind = kind
+        self.thread = thread
+        self.user_id = user_id
+        self.params = params
+        self.answers = answers or {}
+        # number of steps done, and number of saved answers to replay
+        self._steps = 0
+        self._saved = len(self.answers)
+        self._waiter: asyncio.Future | None = None
+
+    @property
+    def key(self) -> tuple[int, int]:
+        return (self.thread.id, self.user_id)
+
+    @property
+    def replaying(self) -> bool:
+        return self._steps < self._saved
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "thread_id": self.thread.id,
+            "user_id": self.user_id,
+            "params": self.params,
+            "answers": self.answers,
+            "updated_at": time.time(),
+        }
+
+    async def send(self, content: str | None = None, **kwargs) -> DiscordMessage | None:
+        """Send a message to the thread, unless the wizard is replaying saved answers"""
+        if self.replaying:
+            return None
+        return await self.thread.send(content, **kwargs)
+
+    async def wait_message(self, timeout: float | None = None) -> DiscordMessage:
+        """Wait for the next message of the user in the thread"""
+        self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(self._waiter, timeout=timeout or self.dispatcher.step_timeout)
+        except asyncio.TimeoutError:
+            raise WizardTimeout from None
+        finally:
+            self._waiter = None
+
+    async def step(self, name: str, run: Callable[[], Awaitable[T]]) -> T:
+        """Return the saved answer of the step, or run it and save its answer"""
+        if name in self.answers:
+            self._steps += 1
+            return self.answers[name]
+        answer = await run()
+        self._steps += 1
+        self.answers[name] = answer
+        await self.dispatcher.save(self)
+        return answer
+
+    async def ask(self, name: str, question: str) -> str:
+        """Ask a question and return the text of the answer"""
+        async def run() -> str:
+            await self.thread.send(question)
+            message = await self.wait_message()
+            return message.content
+
+        return await self.step(name, run)
+
+    async def choose(self, name: str, question: str, view: discord.ui.View, timeout: float,
+                     timeout_message: str) -> Any:
+        """Show a view whose `value` future resolves to the answer, False if not clicked in time"""
+        async def run() -> Any:
+            await self.thread.send(question, view=view)
+            try:
+                return await asyncio.wait_for(view.value, timeout=timeout)
+            except asyncio.TimeoutError:
+                await self.thread.send(timeout_message)
+                return False
+
+        return await self.step(name, run)
+
+
+class WizardDispatcher:
+    """Route the messages of the users to their running wizards.
+
+    Sessions are indexed by (thread id, user id), so routing a message is a
+    single dict lookup, and messages outside the wizard's thread are ignored.
+    The state of the sessions is saved in the shared store, with a ttl, so
+    unfinished wizards can be resumed after a restart and are forgotten
+    after WIZARD_STATE_TTL_SECONDS. When the shared store is in memory,
+    they are saved in a SQLite file at WIZARD_STORE_PATH instead.
+    """
+
+    def __init__(self, store: Store, step_timeout: float, ttl: float):
+        self.store = store
+        self.step_timeout = step_timeout
+        self.ttl = ttl
+        self._sessions: dict[tuple[int, int], WizardSession] = {}
+
+    @staticmethod
+    def _store_key(key: tuple[int, int]) -> str:
+        return f"{KEY_PREFIX}{key[0]}:{key[1]}"
+
+    def dispatch(self, message: DiscordMessage) -> bool:
+        """Hand the message to the wizard waiting for it, return True if there was one"""
+        session = self._sessions.get((message.channel.id, message.author.id))
+        if session is None or session._waiter is None or session._waiter.done():
+            return False
+        session._waiter.set_result(message)
+        return True
+
+    async def save(self, session: WizardSession) -> None:
+        if self._sessions.get(session.key) is not session:
+            # replaced by a newer session of the same user in the same thread
+            return
+        await self.store.set(self._store_key(session.key), session.to_dict(), ttl=self.ttl)
+
+    @asynccontextmanager
+    async def session(
+        self,
+        kind: str,
+        thread: discord.Thread,
+        user_id: int,
+        params: dict[str, Any],
+        answers: dict[str, Any] | None = None,
+    ) -> AsyncIterator[WizardSession]:
+        """Run a wizard session. Its saved state is removed when the wizard finishes, fails or
+        times out, and kept when the wizard is cancelled, e.g. when the bot shuts down.
+        """
+        session = WizardSession(self, kind, thread, user_id, params, answers)
+        previous = self._sessions.get(session.key)
+        if previous is not None and previous._waiter is not None:
+            previous._waiter.cancel()
+        self._sessions[session.key] = session
+        QUEUE_DEPTH.labels(queue="wizards").set(len(self._sessions))
+        await self.save(session)
+        keep_state = False
+        try:
+            yield session
+        except WizardTimeout:
+            await thread.send(f"Timed out waiting for your answer. Please run `/{kind}` again.")
+        except asyncio.CancelledError:
+            # cancelled on shutdown or replaced by a new session: the saved state stays
+            keep_state = True
+            raise
+        finally:
+            if self._sessions.get(session.key) is session:
+                del self._sessions[session.key]
+                if not keep_state:
+                    await self.store.delete(self._store_key(session.key))
+            QUEUE_DEPTH.labels(queue="wizards").set(len(self._sessions))
+
+    async def saved_sessions(self) -> list[dict[str, Any]]:
+        """The saved state of the unfinished wizards, to resume them"""
+        states = []
+        for key in await self.store.scan(KEY_PREFIX):
+            state = await self.store.get(key)
+            if state is not None:
+                states.append(state)
+        return states
+
+    async def forget(self, state: dict[str, Any]) -> None:
+        await self.store.delete(self._store_key((state["thread_id"], state["user_id"])))
+
+
+def open_wizard_store() -> Store:
+    """The shared store, or the file at WIZARD_STORE_PATH when the shared store is in memory"""
+    if STORE_URL == "memory://" and WIZARD_STORE_PATH:
+        return SQLiteStore(WIZARD_STORE_PATH)
+    return store
+
+
+wizards = WizardDispatcher(
+    store=open_wizard_store(), step_timeout=WIZARD_STEP_TIMEOUT_SECONDS, ttl=WIZARD_STATE_TTL_SECONDS
+)
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import logging
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+from src.config import reload_settings
+from src.discord_cogs._utils import should_block
+
+logger = logging.getLogger(__name__)
+
+COG_PACKAGE = "src.discord_cogs."
+
+
+class Admin(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    def loaded_cogs(self) -> list[str]:
+        return sorted(
+            name.removeprefix(COG_PACKAGE) for name in self.bot.extensions if name.startswith(COG_PACKAGE)
+        )
+
+    @app_commands.command(name="reload")
+    @app_commands.describe(target="`config` to read the config file again, or the name of a cog to reload")
+    @app_commands.default_permissions(administrator=True)
+    async def reload(self, int: discord.Interaction, target: str):
+        """Reload the config file or a cog without restarting the bot"""
+        if should_block(guild=int.guild):
+            return
+        await int.response.defer(ephemeral=True)
+
+        if target == "config":
+            try:
+                reloaded = reload_settings(force=True)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Config reload by {int.user} failed: {e}")
+                await int.followup.send(f"The config file is invalid, the settings are unchanged: {e}", ephemeral=True)
+                return
+            logger.info(f"Config reloaded by {int.user}")
+            await int.followup.send("Reloaded the config" if reloaded else "The config is unchanged", ephemeral=True)
+            return
+
+        if target not in self.loaded_cogs():
+            await int.followup.send(f"Unknown cog `{target}`", ephemeral=True)
+            return
+        try:
+            # the cog is replaced in place: the gateway connection and the command tree are kept
+            await self.bot.reload_extension(COG_PACKAGE + target)
+        except commands.ExtensionError as e:
+            logger.exception(f"Failed to reload cog {target}")
+            await int.followup.send(f"Failed to reload `{target}`, the previous version is kept: {e}", ephemeral=True)
+            return
+        logger.info(f"Cog {target} reloaded by {int.user}")
+        await int.followup.send(f"Reloaded `{target}`", ephemeral=True)
+
+    @reload.autocomplete("target")
+    async def reload_target_autocomplete(
+        self, int: discord.Interaction, current: str
+    ) -> list[app_commands.Choice[str]]:
+        return [
+            app_commands.Choice(name=name, value=name)
+            for name in ["config", *self.loaded_cogs()]
+            if current.lower() in name
+        ]
+
+
+async def setup(bot):
+    await bot.add_cog(Admin(bot))
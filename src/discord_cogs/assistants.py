@@ -1,25 +1,31 @@
 from __future__ import annotations
 
 import asyncio
+import re
+import time
 
 import logging
+from dataclasses import dataclass
 
 import discord
-import openai
+from discord import Message as DiscordMessage
 from discord import app_commands
 from discord.ext import commands
 
+from src.config import get_settings
 from src.constants import (
     ACTIVATE_BUILD_THREAD_PREFIX,
-    MAX_ASSISTANT_LIST,
-    MAX_CHARS_PER_REPLY_MSG,
+    MAX_COMPARE_ASSISTANTS,
 )
 from src.discord_cogs._utils import (
     search_assistants,
     should_block,
     split_into_shorter_messages,
 )
-from src.models.assistant import AssistantCreate
+from src.discord_cogs._wizard import WizardSession, wizards
+from src.models.api_response import ResponseData, ResponseStatus
+from src.models.assistant import Assistant as AssistantModel
+from src.models.assistant import AssistantCreate, RunSettings
 from src.models.message import function_tool_to_dict
 from src.discord_cogs.chat import FunctionSelectView
 from src.openai_api.assistants import (
@@ -30,14 +36,27 @@ from src.openai_api.assistants import (
     update_assistant,
 )
 from src.openai_api.files import (
-    upload_file,
+    add_files_to_vector_store,
     create_vector_store,
-    update_vector_store,
+    upload_files,
 )
 from src.openai_api.function_tools import get_available_functions
+from src.openai_api.thread_messages import generate_response_in_new_thread
 
 logger = logging.getLogger(__name__)
 
+# the prompt and the answers of /compare are cut to fit in an embed
+COMPARE_PROMPT_CHARS = 1000
+COMPARE_ANSWER_CHARS = 4096
+
+ANSWER_CACHE_QUESTION = (
+    "# Answer Cache\nAnswer the questions almost identical to a previous one with the same answer, at once."
+)
+IMAGE_DETAIL_QUESTION = (
+    "# Image Detail\nDetail of the images sent by the users. **Auto** uses low detail for small images and "
+    "high detail for the others, **Low** is faster and uses fewer tokens, **High** reads small text better."
+)
+
 
 class Assistant(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -74,152 +93,132 @@ class Assistant(commands.Cog):
                 auto_archive_duration=60,
             )
 
-            # Description
-            await thread.send("What is the description of your assistant?")
-            description = await self.bot.wait_for("message", check=lambda m: m.author == user)
+            async with wizards.session("build", thread, user.id, params={"name": name}) as session:
+                await self.build_wizard(session)
+
+        except Exception as e:
+            logger.exception(e)
+            await int.response.send_message(f"Failed to start chat {str(e)}", ephemeral=True)
+
+    async def build_wizard(self, session: WizardSession):
+        """Ask the user for the configuration of the new assistant and create it"""
+        thread = session.thread
+        name = session.params["name"]
 
-            # Instructions
-            await thread.send("What are the instructions for your assistant?")
-            instructions = await self.bot.wait_for("message", check=lambda m: m.author == user)
+        # Description
+        description = await session.ask("description", "What is the description of your assistant?")
 
-            # Tools
-            tools = []
-            await thread.send("What are the tools for your assistant?")
+        # Instructions
+        instructions = await session.ask("instructions", "What are the instructions for your assistant?")
 
-            # File search
-            retrieval_view = TrueFalseView()
-            await thread.send("# File Search", view=retrieval_view)
-            retrieval_value = False
-            try:
-                retrieval_value = await asyncio.wait_for(retrieval_view.value, timeout=180)
-                if retrieval_value:
-                    tools.append({"type": "file_search"})
-            except asyncio.TimeoutError:
-                await thread.send("Timed out waiting for button click")
-
-            # Code interpreter
-            code_interpreter_view = TrueFalseView()
-            await thread.send(
-                "# Code Interpreter", 
-                view=code_interpreter_view
-            )
-            code_interpreter_value = False
-            try:
-                code_interpreter_value = await asyncio.wait_for(code_interpreter_view.value, timeout=180)
-                if code_interpreter_value:
-                    tools.append({"type": "code_interpreter"})
-            except asyncio.TimeoutError:
-                await thread.send("Timed out waiting for button click")
-            
-            # Function Calling
-            # TODO: fix function selection
-            function_calling_view = TrueFalseView()
-            await thread.send("# Function Calling", view=function_calling_view)
-            function_calling_value = False
-            try:
-                function_calling_value = await asyncio.wait_for(function_calling_view.value, timeout=180)
-            except asyncio.TimeoutError:
-                await thread.send("Timed out waiting for button click")
-                
-            if function_calling_value:
-                view = FunctionSelectView(thread=thread)
-                available_functions = get_available_functions()
-                
-                for func in available_functions:
-                    view.selectMenu.add_option(
-                        label=func["function"]["name"],
-                        value=func["function"]["name"],
-                        description=func["function"]["description"][0:min([100, len(func["function"]["description"])])],
-                    )
+        # Run settings
+        run_settings = await ask_run_settings(session)
 
-                await thread.send("Select the function:", view=view)
-            
-                try:
-                    await asyncio.wait_for(view.wait(), timeout=180)
-                    if view.selected_function:
-                        func = next((f for f in available_functions if f["function"]["name"] == view.selected_function), None)
-                        if func:
-                            function_tool_dict = function_tool_to_dict(func)
-                            tools.append(function_tool_dict)
-                            await thread.send("Function was added to the assistant.")
-                    else:
-                        await thread.send("No function was added to the assistant.")
-                except asyncio.TimeoutError:
-                    await thread.send("Timed out waiting for function selection. No function was added to the assistant.")
-            
-            # File ids
-            file_ids = list() # Default value
-            # Upload the files if file search or code interpreter is enabled
-            if retrieval_value or code_interpreter_value:
-                file_upload_view = YesNoView(
+        # Tools
+        tools = []
+        await session.send("What are the tools for your assistant?")
+
+        # File search
+        retrieval_value = await session.choose(
+            "file_search", "# File Search", TrueFalseView(),
+            timeout=180, timeout_message="Timed out waiting for button click",
+        )
+        if retrieval_value:
+            tools.append({"type": "file_search"})
+
+        # Code interpreter
+        code_interpreter_value = await session.choose(
+            "code_interpreter", "# Code Interpreter", TrueFalseView(),
+            timeout=180, timeout_message="Timed out waiting for button click",
+        )
+        if code_interpreter_value:
+            tools.append({"type": "code_interpreter"})
+
+        # Function Calling
+        # TODO: fix function selection
+        function_calling_value = await session.choose(
+            "function_calling", "# Function Calling", TrueFalseView(),
+            timeout=180, timeout_message="Timed out waiting for button click",
+        )
+        if function_calling_value:
+            function_tool_dict = await session.step("function", lambda: select_function(thread))
+            if function_tool_dict is not None:
+                tools.append(function_tool_dict)
+
+        # Answer cache
+        metadata = run_settings.to_metadata()
+        if await session.choose(
+            "answer_cache", ANSWER_CACHE_QUESTION, TrueFalseView(),
+            timeout=180, timeout_message="Timed out waiting for button click. The answer cache was disabled.",
+        ):
+            metadata["answer_cache"] = "true"
+
+        # Image detail
+        metadata["image_detail"] = await session.choose(
+            "image_detail", IMAGE_DETAIL_QUESTION, ImageDetailView(),
+            timeout=180, timeout_message="Timed out waiting for button click. The image detail was set to auto.",
+        ) or "auto"
+
+        # File ids
+        file_ids = list() # Default value
+        # Upload the files if file search or code interpreter is enabled
+        if retrieval_value or code_interpreter_value:
+            file_upload_value = await session.choose(
+                "add_files",
+                "Would you like to add files to the assistant?",
+                YesNoView(
                     {
                         "yes":"Please upload the files to be added to the assistant\n Send them at once if you want to add multiple files.",
                         "no": "No files will be added to the assistant."
                     }
-                )
+                ),
+                timeout=180,
+                timeout_message="Timed out waiting for button click. No files will be added to the assistant.",
+            )
 
-                await thread.send(
-                    "Would you like to add files to the assistant?",
-                    view=file_upload_view
+            # Upload the files if the user wants to
+            if file_upload_value:
+                async def upload() -> list[str]:
+                    message = await session.wait_message()
+                    return await upload_attachments(message.attachments, ProgressMessage(thread))
+
+                file_ids = await session.step("file_ids", upload)
+
+        # Create Tool Resources if files are uploaded
+        tool_resources = None
+        if file_ids:
+            tool_resources = dict()
+            if retrieval_value:
+                tool_resources["file_search"] = dict(
+                    vector_store_ids=list()
                 )
-                
-                file_upload_value = False
-                try:
-                    file_upload_value = await asyncio.wait_for(file_upload_view.value, timeout=180)
-                except asyncio.TimeoutError:
-                    await thread.send("Timed out waiting for button click. No files will be added to the assistant.")
-
-
-                # Upload the files if the user wants to
-                if file_upload_value:
-                    message = await self.bot.wait_for("message", check=lambda m: m.author == user)
-                    if message.attachments:
-                        for attachment in message.attachments:
-                            pseudo_file = ( 
-                                attachment.filename, 
-                                await attachment.read(), 
-                                attachment.content_type
-                            )
-                            file_id = await upload_file(file=pseudo_file)
-                            file_ids.append(file_id)
-            else:
-                file_ids = list() # Reset file_ids
-
-            # Create Tool Resources if files are uploaded
-            tool_resources = None
-            if file_ids:
-                tool_resources = dict()
-                if retrieval_value:
-                    tool_resources["file_search"] = dict(
-                        vector_store_ids=list()
-                    )
-                    vector_store_name = f"{name} - Vector Store"
-                    vector_store_id = await create_vector_store(
-                        name=vector_store_name, 
-                        file_ids=file_ids
-                    )
-                    tool_resources["file_search"]["vector_store_ids"].append(vector_store_id)
-                if code_interpreter_value:
-                    tool_resources["code_interpreter"] = dict(
-                        file_ids=file_ids
-                    )
-
-            # Create the assistant
-            created = await create_assistant(
-                AssistantCreate(
-                    name=name,
-                    description=description.content,
-                    instructions=instructions.content,
-                    tools=tools,
-                    tool_resources=tool_resources
+                vector_store_name = f"{name} - Vector Store"
+                # returns once the files are indexed, so the first chats can search them
+                vector_store_id = await session.step("vector_store_id", lambda: create_vector_store(
+                    name=vector_store_name,
+                    file_ids=file_ids,
+                    on_progress=ProgressMessage(thread).update,
+                ))
+                tool_resources["file_search"]["vector_store_ids"].append(vector_store_id)
+            if code_interpreter_value:
+                tool_resources["code_interpreter"] = dict(
+                    file_ids=file_ids
                 )
-            )
 
-            return await thread.send(f"Created assistant `{created.id}` ")
+        # Create the assistant
+        created = await create_assistant(
+            AssistantCreate(
+                name=name,
+                model=get_settings().for_guild(thread.guild.id).default_model,
+                description=description,
+                instructions=instructions,
+                tools=tools,
+                tool_resources=tool_resources,
+                metadata=metadata or None,
+            )
+        )
 
-        except Exception as e:
-            logger.exception(e)
-            await int.response.send_message(f"Failed to start chat {str(e)}", ephemeral=True)
+        return await thread.send(f"Created assistant `{created.id}` ")
 
     @app_commands.command(name="update")
     async def update(self, int: discord.Interaction, assistant_id: str):
@@ -260,180 +259,197 @@ class Assistant(commands.Cog):
                     auto_archive_duration=60,
                 )
 
-            # Description
-            await thread.send("What is the new description of your assistant?")
-            description = await self.bot.wait_for("message", check=lambda m: m.author == user)
-            if description.content != ".":
-                assistant.description = description.content
-
-            # Instructions
-            await thread.send("What are the new instructions for your assistant?")
-            instructions = await self.bot.wait_for("message", check=lambda m: m.author == user)
-            if instructions.content != ".":
-                assistant.instructions = instructions.content
-
-            # Tools
-            await thread.send("What are the tools that your assistant can use?")
-            
-            tools = []
-
-            # File retrieval
-            retrieval_view = TrueFalseView()
-            await thread.send("# Files Search", view=retrieval_view)
-            retrieval_value = False
-            try:
-                retrieval_value = await asyncio.wait_for(retrieval_view.value, timeout=180)
-                if retrieval_value:
-                    tools.append({"type": "file_search"})
-            except asyncio.TimeoutError:
-                await thread.send("Timed out waiting for button click. Files was disabled.")
-
-            # Code interpreter
-            code_interpreter_view = TrueFalseView()
-            await thread.send(
-                "# Code Interpreter", 
-                view=code_interpreter_view
-            )
-            code_interpreter_value = False
-            try:
-                code_interpreter_value = await asyncio.wait_for(code_interpreter_view.value, timeout=180)
-                if code_interpreter_value:
-                    tools.append({"type": "code_interpreter"})
-            except asyncio.TimeoutError:
-                await thread.send("Timed out waiting for button click. Code interpreter was disabled.")
-            
-            # Function Calling
-            function_calling_view = TrueFalseView()
-            await thread.send("# Function Calling", view=function_calling_view)
-            function_calling_value = False
-            try:
-                function_calling_value = await asyncio.wait_for(function_calling_view.value, timeout=180)
-            except asyncio.TimeoutError:
-                await thread.send("Timed out waiting for button click")
-
-            if function_calling_value:
-                view = FunctionSelectView(thread=thread)
-                available_functions = get_available_functions()
-
-                for func in available_functions:
-                    view.selectMenu.add_option(
-                        label=func["function"]["name"],
-                        value=func["function"]["name"],
-                        description=func["function"]["description"][0:min([100, len(func["function"]["description"])])],
-                    )
+            async with wizards.session("update", thread, user.id, params={"assistant_id": assistant_id}) as session:
+                await self.update_wizard(session, assistant)
+
+        except Exception as e:
+            logger.exception(e)
+            await int.response.send_message(f"Failed to start chat {str(e)}", ephemeral=True)
+
+    async def update_wizard(self, session: WizardSession, assistant: AssistantModel | None = None):
+        """Ask the user for the new configuration of the assistant and update it"""
+        thread = session.thread
+        if assistant is None:
+            assistant = await get_assistant(session.params["assistant_id"])
 
-                await thread.send("Select the function:", view=view)
-
-                try:
-                    await asyncio.wait_for(view.wait(), timeout=180)
-                    if view.selected_function:
-                        func = next((f for f in available_functions if f["function"]["name"] == view.selected_function), None)
-                        if func:
-                            function_tool_dict = function_tool_to_dict(func)
-                            tools.append(function_tool_dict)
-                            await thread.send("Function was added to the assistant.")
-                    else:
-                        await thread.send("No function was added to the assistant.")
-                except asyncio.TimeoutError:
-                    await thread.send("Timed out waiting for function selection. No function was added to the assistant.")
-
-            assistant.tools = tools # Update tools
-            
-            # Add file_ids to the assistant only if file retrieval or code interpreter is enabled
-            if retrieval_value or code_interpreter_value:
-                # Check if the user wants to keep the existing files
-                keep_files_view = YesNoView(
+        # Description
+        description = await session.ask("description", "What is the new description of your assistant?")
+        if description != ".":
+            assistant.description = description
+
+        # Instructions
+        instructions = await session.ask("instructions", "What are the new instructions for your assistant?")
+        if instructions != ".":
+            assistant.instructions = instructions
+
+        # Run settings
+        run_settings = await ask_run_settings(session, current=assistant.run_settings)
+        if run_settings is not None:
+            assistant.run_settings = run_settings
+
+        # Tools
+        await session.send("What are the tools that your assistant can use?")
+
+        tools = []
+
+        # File retrieval
+        retrieval_value = await session.choose(
+            "file_search", "# Files Search", TrueFalseView(),
+            timeout=180, timeout_message="Timed out waiting for button click. Files was disabled.",
+        )
+        if retrieval_value:
+            tools.append({"type": "file_search"})
+
+        # Code interpreter
+        code_interpreter_value = await session.choose(
+            "code_interpreter", "# Code Interpreter", TrueFalseView(),
+            timeout=180, timeout_message="Timed out waiting for button click. Code interpreter was disabled.",
+        )
+        if code_interpreter_value:
+            tools.append({"type": "code_interpreter"})
+
+        # Function Calling
+        function_calling_value = await session.choose(
+            "function_calling", "# Function Calling", TrueFalseView(),
+            timeout=180, timeout_message="Timed out waiting for button click",
+        )
+        if function_calling_value:
+            function_tool_dict = await session.step("function", lambda: select_function(thread))
+            if function_tool_dict is not None:
+                tools.append(function_tool_dict)
+
+        assistant.tools = tools # Update tools
+
+        # Answer cache
+        assistant.answer_cache = await session.choose(
+            "answer_cache", ANSWER_CACHE_QUESTION, TrueFalseView(),
+            timeout=180, timeout_message="Timed out waiting for button click. The answer cache was disabled.",
+        )
+
+        # Image detail
+        assistant.image_detail = await session.choose(
+            "image_detail", IMAGE_DETAIL_QUESTION + f"\nCurrent: {assistant.image_detail}", ImageDetailView(),
+            timeout=180, timeout_message="Timed out waiting for button click. The image detail was kept.",
+        ) or assistant.image_detail
+
+        # Add file_ids to the assistant only if file retrieval or code interpreter is enabled
+        if retrieval_value or code_interpreter_value:
+            # Check if the user wants to keep the existing files
+            keep_files_value = await session.choose(
+                "keep_files",
+                "Would you like to **Keep** the files? If no, the existing files will be removed.",
+                YesNoView(
                     {
                         "yes": "The existing files were removed.",
                         "no": "The existing files were not removed."
                     }
-                )
-                await thread.send(
-                    "Would you like to **Keep** the files? If no, the existing files will be removed.", 
-                    view=keep_files_view
-                )
-                
-                keep_files_value = False
-                try:
-                    keep_files_value = await asyncio.wait_for(keep_files_view.value, timeout=180)
-                except asyncio.TimeoutError:
-                    await thread.send("Timed out waiting for button click. The existing files were not removed.")
-                
-                if keep_files_value:
-                    tool_resources = assistant.tool_resources
-                else:
-                    tool_resources = dict(
-                        file_search=None,
-                        code_interpreter=None
-                    )
-                
-                # Ask the user if they want to add more files
-                file_upload_view = YesNoView(
-                    {
-                        "yes":"Please upload the files to be added to the assistant and send them at once if you want to add multiple files.",
-                        "no": "No files will be added to the assistant."
-                    }
-                )
+                ),
+                timeout=180,
+                timeout_message="Timed out waiting for button click. The existing files were not removed.",
+            )
 
-                await thread.send(
-                    "Would you like to add files to the assistant?",
-                    view=file_upload_view
-                )
-                
-                file_upload_value = False
-                try:
-                    file_upload_value = await asyncio.wait_for(file_upload_view.value, timeout=180)
-                except asyncio.TimeoutError:
-                    await thread.send("Timed out waiting for button click. No files will be added to the assistant.")
-                
-                # Upload the files if the user wants to
-                if file_upload_value:
-                    message = await self.bot.wait_for("message", check=lambda m: m.author == user)
-                    if message.attachments:
-                        for attachment in message.attachments:
-                            pseudo_file = ( 
-                                attachment.filename, 
-                                await attachment.read(), 
-                                attachment.content_type
-                            )
-                            if retrieval_value:
-                                if tool_resources["file_search"] is None:
-                                    tool_resources["file_search"] = dict(
-                                        vector_store_ids=list()
-                                    )
-                                    tool_resources["file_search"]["vector_store_ids"].append(
-                                        await create_vector_store(
-                                            name=f"{assistant.name} - Vector Store"
-                                        )
-                                    )
-                                else:
-                                    vector_store_id = tool_resources["file_search"]["vector_store_ids"][-1]
-                                    _ = await update_vector_store(vector_store_id, pseudo_file)
-                                
-                            if code_interpreter_value:
-                                if tool_resources["code_interpreter"] is None:
-                                    tool_resources["code_interpreter"] = dict(
-                                        file_ids=list()
-                                    )
-                                file_id = await upload_file(file=pseudo_file)
-                                tool_resources["code_interpreter"]["file_ids"].append(file_id)
-            
-                assistant.tool_resources = tool_resources # Update tool_resources
+            if keep_files_value and assistant.tool_resources:
+                tool_resources = assistant.tool_resources
             else:
-                # Remove all file_ids if file retrieval and code interpreter are disabled
-                assistant.tool_resources = dict(
+                tool_resources = dict(
                     file_search=None,
                     code_interpreter=None
                 )
 
-            # Update the assistant
-            updated = await update_assistant(assistant)
+            # Ask the user if they want to add more files
+            file_upload_value = await session.choose(
+                "add_files",
+                "Would you like to add files to the assistant?",
+                YesNoView(
+                    {
+                        "yes":"Please upload the files to be added to the assistant and send them at once if you want to add multiple files.",
+                        "no": "No files will be added to the assistant."
+                    }
+                ),
+                timeout=180,
+                timeout_message="Timed out waiting for button click. No files will be added to the assistant.",
+            )
 
-            return await thread.send(f"Updated assistant `{updated.id}` ")
+            # Upload the files if the user wants to
+            if file_upload_value:
+                async def upload() -> dict:
+                    message = await session.wait_message()
+                    progress = ProgressMessage(thread)
+                    file_ids = await upload_attachments(message.attachments, progress)
+                    if not file_ids:
+                        return tool_resources
+                    if retrieval_value:
+                        vector_store_ids = (tool_resources.get("file_search") or {}).get("vector_store_ids") or []
+                        if vector_store_ids:
+                            await add_files_to_vector_store(vector_store_ids[-1], file_ids, on_progress=progress.update)
+                        else:
+                            vector_store_ids = [await create_vector_store(
+                                name=f"{assistant.name} - Vector Store",
+                                file_ids=file_ids,
+                                on_progress=progress.update,
+                            )]
+                        tool_resources["file_search"] = dict(vector_store_ids=vector_store_ids)
+
+                    if code_interpreter_value:
+                        existing_file_ids = (tool_resources.get("code_interpreter") or {}).get("file_ids") or []
+                        tool_resources["code_interpreter"] = dict(file_ids=existing_file_ids + file_ids)
+                    return tool_resources
+
+                # the uploads are saved with the resulting tool resources
+                tool_resources = await session.step("tool_resources", upload)
+
+            assistant.tool_resources = tool_resources # Update tool_resources
+        else:
+            # Remove all file_ids if file retrieval and code interpreter are disabled
+            assistant.tool_resources = dict(
+                file_search=None,
+                code_interpreter=None
+            )
 
+        # Update the assistant
+        updated = await update_assistant(assistant)
+
+        return await thread.send(f"Updated assistant `{updated.id}` ")
+
+    @commands.Cog.listener()
+    async def on_message(self, message: DiscordMessage):
+        # answers to the /build and /update wizards
+        wizards.dispatch(message)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready is also dispatched after reconnections, and after a reload of the cog the
+        # wizards of the previous instance are still running
+        if self.bot.wizards_resumed:
+            return
+        self.bot.wizards_resumed = True
+        for state in await wizards.saved_sessions():
+            asyncio.create_task(self.resume_wizard(state))
+
+    async def resume_wizard(self, state: dict):
+        """Continue a wizard that was interrupted by a restart"""
+        # threads of guilds handled by other shards are not in the cache, their process resumes them
+        thread = self.bot.get_channel(state["thread_id"])
+        if not isinstance(thread, discord.Thread):
+            return
+        if thread.archived or thread.locked:
+            await wizards.forget(state)
+            return
+
+        kind = state["kind"]
+        logger.info(f"Resuming /{kind} wizard in {thread.name} for user {state['user_id']}")
+        try:
+            await thread.send(f"<@{state['user_id']}> The bot restarted, let's continue where we left off.")
+            async with wizards.session(
+                kind, thread, state["user_id"], params=state["params"], answers=state["answers"]
+            ) as session:
+                if kind == "build":
+                    await self.build_wizard(session)
+                else:
+                    await self.update_wizard(session)
         except Exception as e:
             logger.exception(e)
-            await int.response.send_message(f"Failed to start chat {str(e)}", ephemeral=True)
+            await thread.send(f"Failed to resume `/{kind}` {str(e)}")
 
     @app_commands.command(name="show")
     async def show(self, int: discord.Interaction, assistant_id: str):
@@ -443,6 +459,9 @@ class Assistant(commands.Cog):
         s = f"```Name: {assistant.name}\n"
         s += f"Description: {assistant.description}\n"
         s += f"Instructions: {assistant.instructions}\n"
+        s += f"RunSettings: {assistant.run_settings.render()}\n"
+        s += f"AnswerCache: {assistant.answer_cache}\n"
+        s += f"ImageDetail: {assistant.image_detail}\n"
         s += f"Tools: {assistant.tools}\n"
         s += f"ToolResources: {assistant.tool_resources}```"
         responses = split_into_shorter_messages(s)
@@ -450,17 +469,61 @@ class Assistant(commands.Cog):
             if len(response) > 0:
                 await int.followup.send(content=response)
 
+    @app_commands.command(name="compare")
+    @app_commands.describe(
+        prompt="The message to send to every assistant",
+        assistant_ids=f"Up to {MAX_COMPARE_ASSISTANTS} assistant ids, separated by spaces or commas",
+    )
+    async def compare(self, int: discord.Interaction, prompt: str, assistant_ids: str):
+        """Send the same message to several assistants at once and show their answers"""
+        # block servers not in allow list
+        if should_block(guild=int.guild):
+            return
+
+        # unique ids, in the given order
+        ids = list(dict.fromkeys(id for id in re.split(r"[\s,]+", assistant_ids) if id))
+        if not ids or len(ids) > MAX_COMPARE_ASSISTANTS:
+            await int.response.send_message(
+                f"Give between 1 and {MAX_COMPARE_ASSISTANTS} assistant ids", ephemeral=True
+            )
+            return
+        await int.response.defer()
+        logger.info(f"Compare command by {int.user} with {len(ids)} assistants")
+
+        started = time.monotonic()
+        # each assistant answers in its own thread, all at once
+        comparisons = await asyncio.gather(
+            *(compare_assistant(assistant_id, int.user.display_name, prompt) for assistant_id in ids)
+        )
+        elapsed = time.monotonic() - started
+
+        embed = discord.Embed(
+            title="Comparison",
+            description=prompt[:COMPARE_PROMPT_CHARS],
+            color=discord.Color.blue(),
+        )
+        for comparison in comparisons:
+            embed.add_field(name=comparison.name[:256], value=comparison.render_stats(), inline=True)
+        total = sum(comparison.latency for comparison in comparisons)
+        embed.set_footer(text=f"Total {elapsed:.1f}s (sum of the runs {total:.1f}s)")
+        await int.followup.send(embed=embed)
+        for comparison in comparisons:
+            await int.followup.send(embed=comparison.render_answer())
+
     @app_commands.command(name="list")
     async def list(self, int: discord.Interaction, offset: int = 0,
-            max: int = MAX_ASSISTANT_LIST, search: str = ''):
-        """List available assistants with optional limit (default MAX_ASSISTANT_LIST)"""
+            max: int | None = None, search: str = ''):
+        """List available assistants with optional limit (default from the settings of the server)"""
         await int.response.defer()
+        guild_settings = get_settings().for_guild(int.guild_id)
+        if max is None:
+            max = guild_settings.max_assistant_list
         assistants = await search_assistants(search=search, limit=offset+max)
         assistants = assistants[offset:]
         s = "Available Assistants 🤖 `[assistant_id] name - description`\n"
         for assistant in assistants:
             s1 = f"```{assistant.render()}```"
-            if len(s + s1) > MAX_CHARS_PER_REPLY_MSG:
+            if len(s + s1) > guild_settings.max_chars_per_reply_msg:
                 await int.followup.send(content=s)
                 s = ''
             s = s + s1
@@ -499,7 +562,9 @@ class Assistant(commands.Cog):
             logger.info(f"Delete command by {user}")
 
         except Exception as e:
-            if isinstance(e, openai.NotFoundError):
+            from openai import NotFoundError
+
+            if isinstance(e, NotFoundError):
                 if e.status_code == 404:
                     await int.followup.send(
                         f"Failed to delete assistant. No assistant found with id `{assistant_id}`."
@@ -509,6 +574,151 @@ class Assistant(commands.Cog):
                 await int.followup.send(f"Failed to delete assistant. {str(e)}")
 
 
+@dataclass
+class Comparison:
+    """The answer of one assistant to the prompt of /compare"""
+
+    assistant_id: str
+    name: str
+    response_data: ResponseData
+    latency: float
+
+    def render_stats(self) -> str:
+        s = f"`{self.assistant_id}`\n⏱ {self.latency:.1f}s"
+        usage = self.response_data.usage
+        if usage:
+            s += f"\n🔢 {usage['prompt_tokens']} prompt + {usage['completion_tokens']} completion tokens"
+        if self.response_data.status is not ResponseStatus.OK:
+            s += "\n⚠️ failed"
+        return s
+
+    def render_answer(self) -> discord.Embed:
+        message = self.response_data.message
+        if self.response_data.status is ResponseStatus.OK and message is not None:
+            text = message.text or "(no text in the answer)"
+            color = discord.Color.green()
+        else:
+            text = f"**Error** - {self.response_data.status_text}"
+            color = discord.Color.yellow()
+        if len(text) > COMPARE_ANSWER_CHARS:
+            text = text[:COMPARE_ANSWER_CHARS - 1] + "…"
+        return discord.Embed(title=self.name[:256], description=text, color=color)
+
+
+async def compare_assistant(assistant_id: str, author_name: str, prompt: str) -> Comparison:
+    """Run one assistant of /compare, with its run settings, in a throwaway thread"""
+    started = time.monotonic()
+    try:
+        assistant = await get_assistant(assistant_id)
+    except Exception as e:
+        logger.warning(f"Assistant {assistant_id} not found for /compare: {e}")
+        response_data = ResponseData(status=ResponseStatus.ERROR, message=None, status_text="assistant not found")
+        return Comparison(assistant_id, assistant_id, response_data, 0.0)
+    try:
+        response_data = await generate_response_in_new_thread(
+            assistant_id, author_name=author_name, prompt=prompt, run_settings=assistant.run_settings
+        )
+    except Exception as e:
+        logger.exception(e)
+        response_data = ResponseData(status=ResponseStatus.ERROR, message=None, status_text=str(e))
+    return Comparison(assistant_id, assistant.name or assistant_id, response_data, time.monotonic() - started)
+
+
+class ProgressMessage:
+    """A message of the thread edited to show the progress of the file uploads and indexing"""
+
+    # seconds between two edits, to stay clear of the rate limits
+    MIN_INTERVAL = 1.0
+    LABELS = {"uploading": "Uploading files", "indexing": "Indexing files for file search"}
+
+    def __init__(self, thread: discord.Thread):
+        self.thread = thread
+        self.message: DiscordMessage | None = None
+        self.content: str | None = None
+        self.edited_at = 0.0
+        # the concurrent uploads report their progress at the same time
+        self._lock = asyncio.Lock()
+
+    async def update(self, phase: str, done: int, total: int) -> None:
+        content = f"{self.LABELS.get(phase, phase)}: {done}/{total}" + (" ✅" if done == total else " ⏳")
+        async with self._lock:
+            now = time.monotonic()
+            if content == self.content or (done < total and now - self.edited_at < self.MIN_INTERVAL):
+                return
+            self.content, self.edited_at = content, now
+            if self.message is None:
+                self.message = await self.thread.send(content)
+            else:
+                await self.message.edit(content=content)
+
+
+async def upload_attachments(attachments: list[discord.Attachment], progress: ProgressMessage) -> list[str]:
+    """Read the attachments and upload them concurrently, return the file ids"""
+    contents = await asyncio.gather(*(attachment.read() for attachment in attachments))
+    files = [
+        (attachment.filename, content, attachment.content_type)
+        for attachment, content in zip(attachments, contents)
+    ]
+    return await upload_files(files, on_progress=progress.update)
+
+
+async def ask_run_settings(session: WizardSession, current: RunSettings | None = None) -> RunSettings | None:
+    """Ask the limits applied to each run of the assistant.
+    When updating, the current settings are shown and None is returned to keep them.
+    """
+    question = (
+        "What are the limits for each run of your assistant? Send them as "
+        "`last_messages=20 max_prompt_tokens=8000 max_completion_tokens=1000`, any of them can be left out. "
+        "Send `none` for no limits."
+    )
+    if current is not None:
+        question += f"\nCurrent: `{current.render()}`. Send `.` to keep them."
+
+    async def run() -> dict | None:
+        await session.thread.send(question)
+        while True:
+            text = (await session.wait_message()).content.strip()
+            if current is not None and text == ".":
+                return None
+            if text.lower() == "none":
+                return {}
+            try:
+                return RunSettings.parse(text).asdict()
+            except ValueError as e:
+                await session.thread.send(f"{e}. Please try again.")
+
+    answer = await session.step("run_settings", run)
+    return RunSettings.from_dict(answer) if answer is not None else None
+
+
+async def select_function(thread: discord.Thread) -> dict | None:
+    """Let the user select one of the available functions, return its tool definition"""
+    view = FunctionSelectView(thread=thread)
+    available_functions = get_available_functions()
+
+    for func in available_functions:
+        view.selectMenu.add_option(
+            label=func["function"]["name"],
+            value=func["function"]["name"],
+            description=func["function"]["description"][0:min([100, len(func["function"]["description"])])],
+        )
+
+    await thread.send("Select the function:", view=view)
+
+    try:
+        await asyncio.wait_for(view.wait(), timeout=180)
+        if view.selected_function:
+            func = next((f for f in available_functions if f["function"]["name"] == view.selected_function), None)
+            if func:
+                await thread.send("Function was added to the assistant.")
+                return function_tool_to_dict(func)
+        else:
+            await thread.send("No function was added to the assistant.")
+    except asyncio.TimeoutError:
+        await thread.send("Timed out waiting for function selection. No function was added to the assistant.")
+    return None
+
+
 class DeleteConfirmView(discord.ui.View):
     def __init__(self, assistant: Assistant):
         super().__init__()
@@ -583,5 +793,27 @@ class YesNoView(discord.ui.View):
             item.disabled = True
         self.value.set_result(False)
 
+
+class ImageDetailView(discord.ui.View):
+    """Buttons to choose the detail of the images: auto, low or high"""
+
+    def __init__(self):
+        super().__init__()
+        self.value = asyncio.Future()
+        for detail in ("auto", "low", "high"):
+            button = discord.ui.Button(label=detail.capitalize(), style=discord.ButtonStyle.blurple)
+            button.callback = self._choose(detail)
+            self.add_item(button)
+
+    def _choose(self, detail: str):
+        async def callback(int: discord.Interaction):
+            await int.response.send_message(f"Image detail: {detail}", ephemeral=True)
+            self.stop()
+            # disable the buttons
+            for item in self.children:
+                item.disabled = True
+            self.value.set_result(detail)
+        return callback
+
 async def setup(bot):
     await bot.add_cog(Assistant(bot))
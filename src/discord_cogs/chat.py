@@ -4,6 +4,7 @@ import os
 
 import logging
 import asyncio
+import time
 
 import discord
 from discord import Message as DiscordMessage
@@ -11,18 +12,69 @@ from discord import app_commands
 from discord.ext import commands
 from discord.ui import Select, View
 
-from src.constants import ACTIVATE_CHAT_THREAD_PREFIX, MAX_ASSISTANT_LIST
+from src.admission import AdmissionRejected, admission
+from src.answer_cache import answer_cache
+from src.config import get_settings
+from src.constants import (
+    ACTIVATE_CHAT_THREAD_PREFIX,
+    INACTIVATE_CHAT_THREAD_PREFIX,
+    COMPACT_THREAD_MESSAGES,
+    COMPACT_THREAD_PROMPT_TOKENS,
+    DEAD_LETTER_MAX_AGE_SECONDS,
+    DEAD_LETTER_RETRY_INTERVAL_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    PROCESSED_MESSAGES_MAX,
+    RUN_MODE,
+    RUN_RESUME_MAX_AGE_SECONDS,
+    THREAD_MAPPING_TTL_SECONDS,
+)
 from src.discord_cogs._utils import (
+    channel_guild_id,
+    get_embed_field,
     is_last_message_stale,
     search_assistants,
+    set_embed_field,
     should_block,
     split_into_shorter_messages,
 )
+from src.dead_letters import DeadLetter, decode_part, encode_part, get_dead_letters
+from src.job_queue import get_job_queue
+from src.media import prepare_vision_image
+from src.metrics import (
+    CACHE_REQUESTS,
+    DEAD_LETTERS,
+    DUPLICATE_MESSAGES,
+    QUEUE_DEPTH,
+    RUNS_CANCELLED,
+    RUNS_RESUMED,
+    SHARD_MESSAGES,
+    THREAD_COMPACTIONS,
+    TIME_TO_FIRST_RESPONSE,
+)
 from src.models.api_response import ResponseData, ResponseStatus
-from src.models.message import MessageCreate
-from src.openai_api.assistants import list_assistants, get_assistant
-from src.openai_api.thread_messages import create_thread, generate_response
-from src.openai_api.files import upload_file
+from src.models.assistant import RunSettings
+from src.models.message import ContentText, MessageCreate
+from src.openai_api.assistants import (
+    get_answer_cache_generation,
+    get_assistant,
+    get_image_detail,
+    get_run_settings,
+    list_assistants,
+)
+from src.openai_api.thread_messages import (
+    add_cached_answer,
+    compact_thread,
+    create_thread,
+    generate_assistant_message_in_thread,
+    generate_response,
+)
+from src.openai_api.files import upload_file, upload_files
+from src.openai_api.runs import cancel_active_run, cancel_run, get_active_run
+from src.retry import RecentIds, is_transient, is_unsent, with_retries
+from src.run_journal import JournalEntry, get_run_journal
+from src.store import store
+from src.tracing import set_attribute, span
+from src.transcripts import Turn, get_transcript_index
 
 logger = logging.getLogger(__name__)
 
@@ -40,14 +92,46 @@ CODE_INTERPRETER_EXTENSION = [
     ".png", ".tar", ".xlsx", ".xml", ".zip"
 ]
 
+# a select menu has at most 25 options
+MAX_SELECT_OPTIONS = 25
+# a failed send may have been posted by Discord up to this many seconds before its failure
+SEND_TIMEOUT_MARGIN = 300
+
+# the thread messages already handled by this process
+processed_messages = RecentIds(PROCESSED_MESSAGES_MAX)
+
+
 class Chat(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self._redelivery: asyncio.Task | None = None
+
+    def start_redelivery(self) -> None:
+        # in gateway mode the workers send the replies, and their dead letters
+        if self._redelivery is None and RUN_MODE != "gateway":
+            self._redelivery = asyncio.create_task(redeliver_dead_letters(self.bot))
+
+    async def cog_load(self):
+        # reloaded by /reload: the bot is already ready and on_ready is not dispatched again
+        if self.bot.is_ready():
+            self.start_redelivery()
+
+    async def cog_unload(self):
+        if self._redelivery is not None:
+            self._redelivery.cancel()
 
     @app_commands.command(name="chat")
+    @app_commands.describe(
+        last_messages="Only send the last N messages of the thread to the assistant",
+        max_prompt_tokens="Maximum prompt tokens per run, at least 256",
+        max_completion_tokens="Maximum completion tokens per run, at least 256",
+    )
     async def chat(self, int: discord.Interaction,
             assistant_id: str = "Not selected",
-            thread_id: str = None, search: str = ''):
+            thread_id: str = None, search: str = '',
+            last_messages: app_commands.Range[int, 1, None] = None,
+            max_prompt_tokens: app_commands.Range[int, 256, None] = None,
+            max_completion_tokens: app_commands.Range[int, 256, None] = None):
         """Start a chat with the bot in a thread"""
         try:
             # only support creating thread in text channel
@@ -79,6 +163,10 @@ class Chat(commands.Cog):
             embed.add_field(name="thread_id", value=thread_id)
             embed.add_field(name="assistant_id", value=assistant_id)
             embed.add_field(name="name", value=name)
+            # overrides of the run settings of the assistant for this thread
+            run_settings = RunSettings(last_messages, max_prompt_tokens, max_completion_tokens)
+            for key, value in run_settings.asdict().items():
+                embed.add_field(name=key, value=str(value))
             await int.response.send_message(embed=embed)
 
             # create the thread
@@ -91,11 +179,15 @@ class Chat(commands.Cog):
             )
 
             if assistant_id != "Not selected":
+                await set_thread_mapping(
+                    thread.id, thread_id=thread_id, assistant_id=assistant_id, run_settings=run_settings
+                )
                 return
 
             # Show assistants as a select menu
             view = SelectView(thread=thread)
-            assistants = await search_assistants(search=search)
+            limit = min(get_settings().for_guild(int.guild.id).max_assistant_list, MAX_SELECT_OPTIONS)
+            assistants = await search_assistants(search=search, limit=limit)
             for assistant in assistants:
                 view.selectMenu.add_option(
                     label=assistant.name if assistant.name is not None else "Unknown",
@@ -109,6 +201,58 @@ class Chat(commands.Cog):
             logger.exception(e)
             await int.response.send_message(f"Failed to start chat {str(e)}", ephemeral=True)
 
+    @app_commands.command(name="stop")
+    async def stop(self, int: discord.Interaction):
+        """Stop the answer in progress in this chat thread"""
+        if should_block(guild=int.guild):
+            return
+        if not isinstance(int.channel, discord.Thread) or int.channel.owner_id != self.bot.user.id:
+            await int.response.send_message("Use /stop in a chat thread", ephemeral=True)
+            return
+        await int.response.defer(ephemeral=True)
+        stopped = await cancel_thread_run(int.channel.id, reason="stop")
+        await int.followup.send(
+            "Stopped the answer in progress" if stopped else "No answer in progress", ephemeral=True
+        )
+
+    @commands.Cog.listener()
+    async def on_thread_update(self, before: discord.Thread, after: discord.Thread):
+        """Cancel the answer in progress when a chat thread is archived, locked or deactivated"""
+        if should_block(guild=after.guild) or after.owner_id != self.bot.user.id:
+            return
+        closed = after.archived or after.locked or after.name.startswith(INACTIVATE_CHAT_THREAD_PREFIX)
+        was_closed = before.archived or before.locked or before.name.startswith(INACTIVATE_CHAT_THREAD_PREFIX)
+        if closed and not was_closed:
+            try:
+                await cancel_thread_run(after.id, reason="thread_closed")
+            except Exception as e:
+                logger.exception(e)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        """Cancel the answer in progress to a deleted message. The raw event is used since
+        the deleted message may not be in the message cache.
+        """
+        if payload.guild_id is None or should_block(guild=self.bot.get_guild(payload.guild_id)):
+            return
+        try:
+            await cancel_thread_run(payload.channel_id, reason="message_deleted", message_id=payload.message_id)
+        except Exception as e:
+            logger.exception(e)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready is also dispatched after reconnections; in gateway mode the workers resume their runs
+        self.start_redelivery()
+        # kept on the bot, not on the cog: a reloaded cog must not resume the runs this process is answering
+        if self.bot.runs_resumed or RUN_MODE == "gateway":
+            return
+        self.bot.runs_resumed = True
+        for entry in await get_run_journal().unfinished():
+            # the runs of guilds handled by other shards are resumed by their process
+            if self.bot.get_guild(entry.guild_id) is not None:
+                asyncio.create_task(resume_run(self.bot, entry))
+
     @commands.Cog.listener()
     async def on_message(self, message: DiscordMessage):
         try:
@@ -151,89 +295,273 @@ class Chat(commands.Cog):
             #         # there is another message, so ignore this one
             #         return
 
-            logger.info(
-                f"Thread message to process - {message.author}: {message.content[:50]} - {thread.name} {thread.jump_url}"
-            )
+            # the events replayed after a gateway reconnect are received again
+            if not processed_messages.add(message.id):
+                DUPLICATE_MESSAGES.inc()
+                logger.info(f"Ignoring message {message.id}, already processed")
+                return
+
+            SHARD_MESSAGES.labels(shard=message.guild.shard_id).inc()
+            # the answer to an older message of the thread would be discarded, so its run is stopped
+            # now, and waited for, since no message can be added to an OpenAI thread during a run
+            await cancel_thread_run(thread.id, reason="new_message", wait=True, newer_than=message.id)
+
+            if RUN_MODE == "gateway":
+                # the run is left to a worker process
+                await enqueue_reply(message=message, thread=thread)
+                return
+
+            with span(
+                "discord.on_message",
+                guild_id=message.guild.id,
+                shard_id=message.guild.shard_id,
+                discord_thread_id=thread.id,
+                message_id=message.id,
+            ):
+                received_at = time.monotonic()
+                logger.info(
+                    f"Thread message to process - {message.author}: {message.content[:50]} - {thread.name} {thread.jump_url}"
+                )
 
-            # Handle the message in the thread
-            async with thread.typing():
-                # get field of embed in the first message of thread
-                first_message = await thread.parent.fetch_message(thread.id)
-                openai_thread_id = first_message.embeds[0].fields[0].value
-                openai_assistant_id = first_message.embeds[0].fields[1].value
-                # TODO: appropriate error handling
-                if openai_assistant_id == "Not selected":
-                    await thread.send(
+                async def notify_queued(position: int) -> None:
+                    await send_to_thread(
+                        thread,
                         embed=discord.Embed(
-                            description=f"**Invalid response** - assistant not selected",
-                            color=discord.Color.yellow(),
+                            description=f"⏳ Busy - position in queue: **{position}**",
+                            color=discord.Color.light_grey(),
+                        ),
+                        delete_after=60,
+                    )
+
+                # the run stays in the journal until its answer is sent
+                async with get_run_journal().answering(message.id):
+                    try:
+                        async with admission.admit(
+                            guild_id=message.guild.id,
+                            channel_id=thread.parent_id,
+                            user_id=message.author.id,
+                            on_queued=notify_queued,
+                        ) as ticket:
+                            response_data = await generate_reply(message=message, thread=thread, parent=thread.parent)
+                            if response_data is not None and response_data.usage:
+                                ticket.tokens = response_data.usage["total_tokens"]
+                    except AdmissionRejected as e:
+                        await send_to_thread(
+                            thread,
+                            embed=discord.Embed(
+                                description=f"**Busy** - {e}",
+                                color=discord.Color.red(),
+                            )
                         )
+                        return
+
+                    if response_data is None:
+                        return
+
+                    if is_last_message_stale(
+                        interaction_message=message,
+                        last_message=thread.last_message,
+                        bot_id=self.bot.user.id,
+                    ):
+                        # there is another message and its not from us, so ignore this response
+                        return
+
+                    # send response
+                    await process_response(thread=thread, response_data=response_data, received_at=received_at)
+                    await compact_thread_if_needed(thread=thread, parent=thread.parent, response_data=response_data)
+        except Exception as e:
+            logger.exception(e)
+
+
+async def resume_run(client: discord.Client, entry: JournalEntry) -> None:
+    """Send the answer of a run interrupted by a restart, once it ends. A run still in
+    progress after RUN_RESUME_MAX_AGE_SECONDS is cancelled instead.
+    """
+    thread = client.get_partial_messageable(
+        entry.discord_thread_id, guild_id=entry.guild_id, type=discord.ChannelType.public_thread
+    )
+    parent = client.get_partial_messageable(entry.parent_id, guild_id=entry.guild_id, type=discord.ChannelType.text)
+    with span("discord.resume_run", discord_thread_id=entry.discord_thread_id, message_id=entry.message_id,
+              thread_id=entry.thread_id, run_id=entry.run_id):
+        try:
+            async with get_run_journal().answering(entry.message_id):
+                if entry.age > RUN_RESUME_MAX_AGE_SECONDS and await cancel_run(entry.thread_id, entry.run_id):
+                    RUNS_CANCELLED.labels(reason="resume_too_old").inc()
+                    RUNS_RESUMED.labels(result="cancelled").inc()
+                    logger.info(f"Cancelled run {entry.run_id} of message {entry.message_id} ({entry.age:.0f}s old)")
+                    await send_to_thread(
+                        thread,
+                        embed=discord.Embed(
+                            description="**Error** - the bot restarted while answering, please ask again",
+                            color=discord.Color.yellow(),
+                        ),
                     )
                     return
-                                
-                # Add the files to the thread when message has attachments
-                # TODO: Error handling when len(message.attachments) > 10 or size > 512MB
-                image_ids = list()
-                attachments = None
-                if message.attachments:
-                    image_ids = list()
-                    attachments = list()
-                    for attachment in message.attachments:
-                        # Handle the attachment
-                        # For Image files
-                        if os.path.splitext(attachment.filename)[1] in IMAGE_FILE_EXTENSION:
-                            pseudo_file = ( 
-                                attachment.filename, 
-                                await attachment.read(), 
-                                attachment.content_type
-                            )
-                            image_id = await upload_file(file=pseudo_file, purpose="vision")
-                            image_ids.append(image_id)
-                        
-                        # For Tools
-                        if (os.path.splitext(attachment.filename)[1] in FILE_SEARCH_EXTENSION 
-                            or os.path.splitext(attachment.filename)[1] in CODE_INTERPRETER_EXTENSION):
-                            pseudo_file = ( 
-                                attachment.filename, 
-                                await attachment.read(), 
-                                attachment.content_type
-                            )
-                            file_id = await upload_file(file=pseudo_file)
-                            attachment_obj = {
-                                "file_id": file_id,
-                                "tools": [],
-                            }
-                            if os.path.splitext(attachment.filename)[1] in FILE_SEARCH_EXTENSION:
-                                attachment_obj["tools"].append({"type": "file_search"})
-                            if os.path.splitext(attachment.filename)[1] in CODE_INTERPRETER_EXTENSION:
-                                attachment_obj["tools"].append({"type": "code_interpreter"})
-                            attachments.append(attachment_obj)
-
-                # Generate the response
-                response_data = await generate_response(
-                    thread_id=openai_thread_id,
-                    assistant_id=openai_assistant_id,
-                    new_message=MessageCreate.from_discord_message(
-                        thread_id=openai_thread_id,
-                        author_name=message.author.display_name,
-                        message=message.content,
-                        image_ids=image_ids,
-                        attachments=attachments,
-                    ),
+
+                logger.info(f"Resuming run {entry.run_id} of message {entry.message_id}")
+                response_data = await generate_assistant_message_in_thread(
+                    thread_id=entry.thread_id,
+                    assistant_id=entry.assistant_id,
+                    metadata={
+                        "discord_message_id": str(entry.message_id),
+                        "discord_thread_id": str(entry.discord_thread_id),
+                        "parent_id": str(entry.parent_id),
+                        "guild_id": str(entry.guild_id),
+                    },
+                    run_id=entry.run_id,
+                    run_age=entry.age,
+                )
+                message = await thread.fetch_message(entry.message_id)
+                last_message = None
+                async for last_message in thread.history(limit=1):
+                    pass
+                if is_last_message_stale(interaction_message=message, last_message=last_message,
+                                         bot_id=client.user.id):
+                    RUNS_RESUMED.labels(result="stale").inc()
+                    return
+                await process_response(thread=thread, response_data=response_data)
+                await compact_thread_if_needed(thread=thread, parent=parent, response_data=response_data)
+                RUNS_RESUMED.labels(result="delivered").inc()
+        except Exception:
+            RUNS_RESUMED.labels(result="error").inc()
+            logger.exception(f"Failed to resume run {entry.run_id} of message {entry.message_id}")
+
+
+async def enqueue_reply(message: DiscordMessage, thread: discord.Thread) -> None:
+    """Queue the reply to a thread message for the workers. The message id is the
+    idempotency key, so a message is only answered once even if the event is received twice.
+    """
+    job_queue = get_job_queue()
+    enqueued = await job_queue.enqueue(
+        idempotency_key=str(message.id),
+        payload={
+            "guild_id": message.guild.id,
+            "parent_id": thread.parent_id,
+            "discord_thread_id": thread.id,
+            "message_id": message.id,
+            "author_id": message.author.id,
+            "received_at": time.time(),
+        },
+        max_attempts=JOB_MAX_ATTEMPTS,
+    )
+    QUEUE_DEPTH.labels(queue="jobs").set(await job_queue.depth())
+    if not enqueued:
+        logger.info(f"Message {message.id} is already queued")
+
+
+async def generate_reply(
+    message: DiscordMessage, thread: discord.abc.Messageable, parent: discord.abc.Messageable
+) -> ResponseData | None:
+    """Send the user message to the OpenAI thread linked to the Discord thread and run the assistant.
+    `thread` may be a partial channel, as in the workers, so its parent channel is passed along.
+    """
+    async with thread.typing():
+        openai_thread_id, openai_assistant_id, run_settings = await get_thread_mapping(thread.id, parent)
+        set_attribute("thread_id", openai_thread_id)
+        set_attribute("assistant_id", openai_assistant_id)
+        # TODO: appropriate error handling
+        if openai_assistant_id == "Not selected":
+            await send_to_thread(
+                thread,
+                embed=discord.Embed(
+                    description=f"**Invalid response** - assistant not selected",
+                    color=discord.Color.yellow(),
+                )
+            )
+            return None
+        run_settings = (await get_run_settings(openai_assistant_id)).merge(run_settings)
+
+        # Add the files to the thread when message has attachments
+        # TODO: Error handling when len(message.attachments) > 10 or size > 512MB
+        image_ids = list()
+        image_details = list()
+        attachments = None
+        if message.attachments:
+            image_ids = list()
+            attachments = list()
+            # Images are downscaled and re-encoded in the media process pool, all at once
+            images = [
+                attachment for attachment in message.attachments
+                if os.path.splitext(attachment.filename)[1] in IMAGE_FILE_EXTENSION
+            ]
+            if images:
+                image_detail = await get_image_detail(openai_assistant_id)
+                datas = await asyncio.gather(*(attachment.read() for attachment in images))
+                prepared_images = await asyncio.gather(*(
+                    prepare_vision_image(data, attachment.filename, image_detail)
+                    for attachment, data in zip(images, datas)
+                ))
+                image_ids = await upload_files(
+                    [(filename, data) for data, filename, _ in prepared_images], purpose="vision"
                 )
+                image_details = [detail for _, _, detail in prepared_images]
+
+            for attachment in message.attachments:
+                # Handle the attachment
+
+                # For Tools
+                if (os.path.splitext(attachment.filename)[1] in FILE_SEARCH_EXTENSION 
+                    or os.path.splitext(attachment.filename)[1] in CODE_INTERPRETER_EXTENSION):
+                    pseudo_file = ( 
+                        attachment.filename, 
+                        await attachment.read(), 
+                        attachment.content_type
+                    )
+                    file_id = await upload_file(file=pseudo_file)
+                    attachment_obj = {
+                        "file_id": file_id,
+                        "tools": [],
+                    }
+                    if os.path.splitext(attachment.filename)[1] in FILE_SEARCH_EXTENSION:
+                        attachment_obj["tools"].append({"type": "file_search"})
+                    if os.path.splitext(attachment.filename)[1] in CODE_INTERPRETER_EXTENSION:
+                        attachment_obj["tools"].append({"type": "code_interpreter"})
+                    attachments.append(attachment_obj)
+
+        new_message = MessageCreate.from_discord_message(
+            thread_id=openai_thread_id,
+            author_name=message.author.display_name,
+            message=message.content,
+            image_ids=image_ids,
+            attachments=attachments,
+            image_details=image_details,
+        )
 
-            if is_last_message_stale(
-                interaction_message=message,
-                last_message=thread.last_message,
-                bot_id=self.bot.user.id,
-            ):
-                # there is another message and its not from us, so ignore this response
-                return
+        index_turn(thread, message, openai_assistant_id, role="user", content=message.content)
+
+        # Answer from the cache when the assistant has it enabled, only for text questions
+        generation = None
+        if not message.attachments:
+            generation = await get_answer_cache_generation(openai_assistant_id)
+        if generation is not None:
+            cached_answer = answer_cache.lookup(openai_assistant_id, message.content, generation)
+            CACHE_REQUESTS.labels(cache="answer", result="miss" if cached_answer is None else "hit").inc()
+            set_attribute("answer_cache", "miss" if cached_answer is None else "hit")
+            if cached_answer is not None:
+                return await add_cached_answer(new_message, cached_answer)
+
+        # Generate the response, the message id lets the run be cancelled if the message is deleted,
+        # and the run be resumed after a restart
+        response_data = await generate_response(
+            thread_id=openai_thread_id,
+            assistant_id=openai_assistant_id,
+            new_message=new_message,
+            run_settings=run_settings,
+            metadata={
+                "discord_message_id": str(message.id),
+                "discord_thread_id": str(thread.id),
+                "parent_id": str(parent.id),
+                # the messages fetched by the workers have no guild, their partial thread has its id
+                "guild_id": str(message.guild.id if message.guild is not None else thread.guild_id),
+            },
+        )
 
-            # send response
-            await process_response(thread=thread, response_data=response_data)
-        except Exception as e:
-            logger.exception(e)
+        # Only plain text answers are cached, files and images are specific to their run
+        answer = response_data.message
+        if generation is not None and response_data.status is ResponseStatus.OK and answer is not None \
+                and answer.text and all(isinstance(c, ContentText) and not c.annotations for c in answer.content):
+            answer_cache.add(openai_assistant_id, message.content, answer.text, generation)
+        return response_data
 
 
 class SelectView(View):
@@ -255,10 +583,16 @@ class SelectView(View):
         # modify the starter embed in the thread
         starter_message = await self.thread.parent.fetch_message(self.thread.id)
         embed = starter_message.embeds[0]
-        embed.set_field_at(-2, name="assistant_id", value=selected)
+        set_embed_field(embed, "assistant_id", selected)
         assistant = await get_assistant(selected)
-        embed.set_field_at(-1, name="name", value=assistant.name)
+        set_embed_field(embed, "name", assistant.name)
         await starter_message.edit(embed=embed)
+        await set_thread_mapping(
+            self.thread.id,
+            thread_id=get_embed_field(embed, "thread_id"),
+            assistant_id=selected,
+            run_settings=thread_run_settings(embed),
+        )
 
 class FunctionSelectView(View):
     def __init__(self, *, thread: discord.Thread = None):
@@ -284,40 +618,316 @@ class FunctionSelectView(View):
         await self.thread.starter_message.edit(embed=embed)
         self.stop()
 
+def thread_run_settings(embed: discord.Embed) -> RunSettings:
+    """The run settings overridden for a chat thread, read from its starter embed"""
+    return RunSettings.from_dict({
+        key: int(value) for key in RunSettings.__slots__ if (value := get_embed_field(embed, key)) is not None
+    })
+
+
+async def get_thread_mapping(
+    discord_thread_id: int, parent: discord.abc.Messageable
+) -> tuple[str, str, RunSettings]:
+    """Get the OpenAI thread id, assistant id and run settings overrides of a chat thread.
+    They are kept in the shared store, and read from the starter embed when missing.
+    """
+    mapping = await store.get(f"thread:{discord_thread_id}")
+    if mapping is not None:
+        CACHE_REQUESTS.labels(cache="thread_mapping", result="hit").inc()
+        return mapping["thread_id"], mapping["assistant_id"], RunSettings.from_dict(mapping.get("run_settings", {}))
+    CACHE_REQUESTS.labels(cache="thread_mapping", result="miss").inc()
+
+    # get fields of embed in the first message of thread
+    first_message = await parent.fetch_message(discord_thread_id)
+    embed = first_message.embeds[0]
+    openai_thread_id = get_embed_field(embed, "thread_id")
+    openai_assistant_id = get_embed_field(embed, "assistant_id")
+    run_settings = thread_run_settings(embed)
+    if openai_assistant_id != "Not selected":
+        await set_thread_mapping(
+            discord_thread_id, thread_id=openai_thread_id, assistant_id=openai_assistant_id, run_settings=run_settings
+        )
+    return openai_thread_id, openai_assistant_id, run_settings
+
+
+async def set_thread_mapping(
+    discord_thread_id: int, thread_id: str, assistant_id: str, run_settings: RunSettings | None = None
+) -> None:
+    await store.set(
+        f"thread:{discord_thread_id}",
+        {
+            "thread_id": thread_id,
+            "assistant_id": assistant_id,
+            "run_settings": run_settings.asdict() if run_settings is not None else {},
+        },
+        ttl=THREAD_MAPPING_TTL_SECONDS,
+    )
+
+
+async def cancel_thread_run(
+    discord_thread_id: int,
+    reason: str,
+    message_id: int | None = None,
+    wait: bool = False,
+    newer_than: int | None = None,
+) -> bool:
+    """Cancel the run in progress in the OpenAI thread of a chat thread, return True if one was cancelled.
+    With `message_id`, only the run answering this message is cancelled, and with `newer_than`,
+    only a run answering an older message. Only the threads in the shared store can have a run.
+    """
+    mapping = await store.get(f"thread:{discord_thread_id}")
+    if mapping is None:
+        return False
+    if newer_than is not None:
+        active = await get_active_run(mapping["thread_id"])
+        # message ids are snowflakes, which grow with time
+        if active is None or int(active["metadata"].get("discord_message_id", 0)) >= newer_than:
+            return False
+    return await cancel_active_run(mapping["thread_id"], reason=reason, message_id=message_id, wait=wait)
+
+
+async def compact_thread_if_needed(
+    thread: discord.abc.Messageable, parent: discord.abc.Messageable, response_data: ResponseData
+) -> None:
+    """Replace the OpenAI thread of a chat thread by a new thread seeded with a summary of the
+    conversation, once it has COMPACT_THREAD_MESSAGES messages or the prompt of its last run had
+    COMPACT_THREAD_PROMPT_TOKENS tokens. The previous thread ids are kept in the starter embed.
+    """
+    if response_data.status is not ResponseStatus.OK:
+        return
+    if not COMPACT_THREAD_MESSAGES and not COMPACT_THREAD_PROMPT_TOKENS:
+        return
+
+    openai_thread_id, openai_assistant_id, run_settings = await get_thread_mapping(thread.id, parent)
+    # the user message and the answer
+    n_messages = await store.incr(f"thread_messages:{openai_thread_id}", 2, ttl=THREAD_MAPPING_TTL_SECONDS)
+    prompt_tokens = (response_data.usage or {}).get("prompt_tokens", 0)
+    if COMPACT_THREAD_MESSAGES and n_messages >= COMPACT_THREAD_MESSAGES:
+        reason = "messages"
+    elif COMPACT_THREAD_PROMPT_TOKENS and prompt_tokens >= COMPACT_THREAD_PROMPT_TOKENS:
+        reason = "prompt_tokens"
+    else:
+        return
+    # only one process compacts a thread, the next answers trigger it again if it fails
+    if await store.incr(f"compacting:{openai_thread_id}", ttl=600) > 1:
+        return
+
+    with span("discord.compact_thread", discord_thread_id=thread.id, thread_id=openai_thread_id, reason=reason):
+        new_thread_id = await compact_thread(openai_thread_id, openai_assistant_id)
+        if new_thread_id is None:
+            await store.delete(f"compacting:{openai_thread_id}")
+            return
+
+        starter_message = await parent.fetch_message(thread.id)
+        embed = starter_message.embeds[0]
+        set_embed_field(embed, "thread_id", new_thread_id)
+        previous_thread_ids = (get_embed_field(embed, "previous_thread_ids") or "").split()
+        previous_thread_ids.append(openai_thread_id)
+        # the value of a field is limited to 1024 characters, the oldest ids are dropped
+        while len(" ".join(previous_thread_ids)) > 1024:
+            previous_thread_ids.pop(0)
+        set_embed_field(embed, "previous_thread_ids", " ".join(previous_thread_ids))
+        await starter_message.edit(embed=embed)
+        await set_thread_mapping(
+            thread.id, thread_id=new_thread_id, assistant_id=openai_assistant_id, run_settings=run_settings
+        )
+    await store.delete(f"thread_messages:{openai_thread_id}")
+    THREAD_COMPACTIONS.labels(reason=reason).inc()
+    logger.info(f"Compacted thread {openai_thread_id} into {new_thread_id} ({reason})")
+
+
+def index_turn(
+    thread: discord.abc.Messageable, message: DiscordMessage, assistant_id: str, role: str, content: str
+) -> None:
+    """Add a message of a chat thread to the transcript index, written in the background"""
+    index = get_transcript_index()
+    if index is None or message is None:
+        return
+    index.add(Turn(
+        message_id=message.id,
+        # the messages of the workers have no guild, their partial thread has its id
+        guild_id=message.guild.id if message.guild is not None else thread.guild_id,
+        discord_thread_id=thread.id,
+        assistant_id=assistant_id,
+        author_id=message.author.id,
+        author=message.author.display_name,
+        role=role,
+        content=content,
+        created_at=message.created_at.timestamp(),
+    ))
+
+
+async def send_to_thread(thread: discord.abc.Messageable, content: str | None = None, **kwargs) -> DiscordMessage:
+    """Send a message to the thread, recording a span for the Discord call. Only the failures that
+    surely did not post the message are retried, so that an answer is not posted twice.
+    """
+    files = kwargs.get("files") or ([kwargs["file"]] if kwargs.get("file") is not None else [])
+
+    async def send() -> DiscordMessage:
+        # a failed attempt may have read the files
+        for file in files:
+            file.reset()
+        return await thread.send(content, **kwargs)
+
+    with span("discord.send", discord_thread_id=thread.id, n_files=len(files)):
+        return await with_retries("discord.send", send, retry_if=is_unsent)
+
+
+async def deliver_reply(
+    thread: discord.abc.Messageable, parts: list[dict], received_at: float | None = None
+) -> DiscordMessage | None:
+    """Send the parts of a reply in order and return the first message sent. When a part still
+    cannot be sent after its retries, the parts left are kept as a dead letter, sent again later.
+    """
+    first_sent = None
+    for i, part in enumerate(parts):
+        try:
+            sent = await send_to_thread(thread, **part)
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            letter_id = await get_dead_letters().add(
+                thread.id,
+                channel_guild_id(thread),
+                [encode_part(left) for left in parts[i:]],
+                error=repr(e),
+                retry_delay=DEAD_LETTER_RETRY_INTERVAL_SECONDS,
+            )
+            DEAD_LETTERS.labels(action="stored").inc()
+            logger.error(
+                f"Failed to send {len(parts) - i} of {len(parts)} parts of a reply to thread {thread.id},"
+                f" kept as dead letter {letter_id}: {e!r}"
+            )
+            break
+        if received_at is not None:
+            TIME_TO_FIRST_RESPONSE.observe(time.monotonic() - received_at)
+            received_at = None
+        if first_sent is None:
+            first_sent = sent
+    return first_sent
+
+
+def is_part_of(message: DiscordMessage, part: dict) -> bool:
+    """Whether the message has the content, embeds and files of the encoded part"""
+    return (
+        message.content == part.get("content", "")
+        and [embed.description for embed in message.embeds]
+        == [embed.get("description") for embed in part.get("embeds", [])]
+        and [a.filename for a in message.attachments] == [file["filename"] for file in part.get("files", [])]
+    )
+
+
+async def was_posted(client: discord.Client, thread: discord.abc.Messageable, letter: DeadLetter) -> bool:
+    """Whether the first part left of the letter is in the thread: a send that timed out or got a 5xx
+    may have been posted by Discord anyway
+    """
+    async for message in thread.history(limit=50):
+        # the part cannot have been posted long before the letter's first failed send
+        if message.created_at.timestamp() < letter.created_at - SEND_TIMEOUT_MARGIN:
+            break
+        if message.author.id == client.user.id and is_part_of(message, letter.parts[0]):
+            return True
+    return False
+
+
+async def redeliver(client: discord.Client, letter: DeadLetter) -> None:
+    """Send the parts left of a dead letter, or keep them for later if Discord still fails"""
+    dead_letters = get_dead_letters()
+    if letter.age > DEAD_LETTER_MAX_AGE_SECONDS:
+        await dead_letters.remove(letter)
+        DEAD_LETTERS.labels(action="expired").inc()
+        logger.error(f"Dropped dead letter {letter.id} of thread {letter.discord_thread_id}, {letter.age:.0f}s old")
+        return
+    thread = client.get_partial_messageable(
+        letter.discord_thread_id, guild_id=letter.guild_id, type=discord.ChannelType.public_thread
+    )
+    with span("discord.redeliver", discord_thread_id=letter.discord_thread_id, dead_letter_id=letter.id,
+              attempts=letter.attempts):
+        # only the first part was sent and failed, the next ones were never sent
+        if await was_posted(client, thread, letter):
+            logger.info(f"First part of dead letter {letter.id} already in the thread, not sent again")
+            letter.parts.pop(0)
+        while letter.parts:
+            try:
+                await send_to_thread(thread, **decode_part(letter.parts[0]))
+            except Exception as e:
+                if is_transient(e):
+                    await dead_letters.release(letter, error=repr(e))
+                    logger.warning(f"Failed to redeliver dead letter {letter.id} (attempt {letter.attempts}): {e!r}")
+                else:
+                    # e.g. the thread was deleted or locked
+                    await dead_letters.remove(letter)
+                    DEAD_LETTERS.labels(action="dropped").inc()
+                    logger.error(f"Dropped dead letter {letter.id} of thread {letter.discord_thread_id}: {e!r}")
+                return
+            letter.parts.pop(0)
+    await dead_letters.remove(letter)
+    DEAD_LETTERS.labels(action="delivered").inc()
+    logger.info(f"Redelivered dead letter {letter.id} to thread {letter.discord_thread_id}")
+
+
+async def redeliver_dead_letters(client: discord.Client) -> None:
+    """Send the dead letters due, every DEAD_LETTER_RETRY_INTERVAL_SECONDS"""
+    dead_letters = get_dead_letters()
+    while True:
+        try:
+            for letter in await dead_letters.claim():
+                await redeliver(client, letter)
+            QUEUE_DEPTH.labels(queue="dead_letters").set(await dead_letters.depth())
+        except Exception:
+            logger.exception("Failed to redeliver the dead letters")
+        await asyncio.sleep(DEAD_LETTER_RETRY_INTERVAL_SECONDS)
+
+
 # TODO: remove unused args
-async def process_response(thread: discord.Thread, response_data: ResponseData) -> None:
+async def process_response(
+    thread: discord.abc.Messageable, response_data: ResponseData, received_at: float | None = None
+) -> None:
     status = response_data.status
     message = response_data.message
     status_text = response_data.status_text
 
-    if status is ResponseStatus.OK:
-        sent_message = None
+    # the keyword arguments of each message of the reply
+    parts = []
+    if status is ResponseStatus.CANCELLED:
+        # the answer is no longer wanted
+        return
+    elif status is ResponseStatus.OK:
         if not message:
-            sent_message = await thread.send(
+            parts.append(dict(
                 embed=discord.Embed(
                     description=f"**Invalid response** - empty response",
                     color=discord.Color.yellow(),
                 )
-            )
+            ))
         else:
+            max_chars = get_settings().for_guild(channel_guild_id(thread)).max_chars_per_reply_msg
             messages_rendered = await message.render()
             for message_rendered in messages_rendered:
-                shorter_response = split_into_shorter_messages(message_rendered.content)
+                shorter_response = split_into_shorter_messages(message_rendered.content, limit=max_chars)
                 for i, response in enumerate(shorter_response):
                     # Send attachments with last message
                     if i == len(shorter_response) - 1:
                         message_rendered.content = response
-                        sent_message = await thread.send(**message_rendered.asdict())
+                        parts.append(message_rendered.asdict())
                     else:
-                        sent_message = await thread.send(response)
-
+                        parts.append(dict(content=response))
     else:
-        await thread.send(
+        parts.append(dict(
             embed=discord.Embed(
                 description=f"**Error** - {status_text}",
                 color=discord.Color.yellow(),
             )
-        )
+        ))
+
+    first_sent = await deliver_reply(thread, parts, received_at=received_at)
+
+    if status is ResponseStatus.OK and message:
+        # the answer is indexed under its first Discord message, the cached answers have no assistant id
+        assistant_id = message.assistant_id
+        if assistant_id is None:
+            assistant_id = (await store.get(f"thread:{thread.id}") or {}).get("assistant_id", "")
+        index_turn(thread, first_sent, assistant_id, role="assistant", content=message.text)
 
 
 async def setup(bot):
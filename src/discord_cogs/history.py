@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import io
+import logging
+import time
+from typing import Literal
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+from src.discord_cogs._utils import get_embed_field, should_block
+from src.metrics import TRANSCRIPT_SEARCH_LATENCY
+from src.thread_export import WRITERS, export_threads
+from src.transcripts import SearchResult, get_transcript_index
+
+logger = logging.getLogger(__name__)
+
+MAX_SEARCH_RESULTS = 10
+# the value of an embed field is limited to 1024 characters
+RESULT_CHARS = 900
+
+
+class History(commands.Cog):
+    history = app_commands.Group(name="history", description="Search the past chat threads of this server")
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @history.command(name="search")
+    @app_commands.describe(
+        query="Words to search for, all of them must appear",
+        thread="Only search this chat thread",
+        assistant_id="Only search the chats with this assistant",
+        author="Only search the messages of this user",
+    )
+    async def search(
+        self,
+        int: discord.Interaction,
+        query: str,
+        thread: discord.Thread | None = None,
+        assistant_id: str | None = None,
+        author: discord.Member | None = None,
+    ):
+        """Search the messages and answers of the chat threads of this server"""
+        if should_block(guild=int.guild):
+            return
+        index = get_transcript_index()
+        if index is None:
+            await int.response.send_message("The transcript index is disabled", ephemeral=True)
+            return
+        if not query.split():
+            await int.response.send_message("Please give words to search for", ephemeral=True)
+            return
+        await int.response.defer(ephemeral=True)
+
+        started = time.perf_counter()
+        results = await index.search(
+            query,
+            guild_id=int.guild.id,
+            discord_thread_id=thread.id if thread is not None else None,
+            assistant_id=assistant_id,
+            author_id=author.id if author is not None else None,
+            limit=MAX_SEARCH_RESULTS,
+        )
+        elapsed = time.perf_counter() - started
+        TRANSCRIPT_SEARCH_LATENCY.observe(elapsed)
+        logger.info(f"History search by {int.user}: {len(results)} results in {elapsed * 1000:.1f}ms")
+
+        embed = discord.Embed(
+            title=f"History: {query}"[:256],
+            description=None if results else "No messages found",
+            color=discord.Color.blue(),
+        )
+        for result in results:
+            embed.add_field(name=render_title(result), value=render_result(result), inline=False)
+        embed.set_footer(text=f"{len(results)} results in {elapsed * 1000:.0f}ms")
+        await int.followup.send(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="export")
+    @app_commands.describe(
+        format="File format of the export",
+        include_files="Embed the images and files of the assistant, or only name them",
+    )
+    @app_commands.default_permissions(manage_threads=True)
+    async def export(
+        self,
+        int: discord.Interaction,
+        format: Literal["markdown", "html"] = "markdown",
+        include_files: bool = True,
+    ):
+        """Export the conversation of this chat thread as one file"""
+        if should_block(guild=int.guild):
+            return
+        thread = int.channel
+        if not isinstance(thread, discord.Thread) or thread.owner_id != self.bot.user.id:
+            await int.response.send_message("Use /export in a chat thread", ephemeral=True)
+            return
+        await int.response.defer(ephemeral=True, thinking=True)
+
+        try:
+            # the thread ids are kept in the starter embed, with the threads the chat was compacted from
+            starter_message = await thread.parent.fetch_message(thread.id)
+            embed = starter_message.embeds[0]
+            thread_ids = (get_embed_field(embed, "previous_thread_ids") or "").split()
+            thread_ids.append(get_embed_field(embed, "thread_id"))
+            started = time.perf_counter()
+            fp, n_messages = await export_threads(
+                thread_ids, title=thread.name, export_format=format, include_files=include_files
+            )
+        except Exception as e:
+            logger.exception(f"Failed to export thread {thread.id}")
+            await int.followup.send(f"Failed to export the thread: {e}", ephemeral=True)
+            return
+
+        with fp:
+            size = fp.seek(0, io.SEEK_END)
+            fp.seek(0)
+            logger.info(
+                f"Exported {n_messages} messages of thread {thread.id} ({size} bytes) "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+            if size > int.guild.filesize_limit:
+                await int.followup.send(
+                    f"The export is {size / 2**20:.1f} MiB, over the {int.guild.filesize_limit / 2**20:.0f} MiB "
+                    "limit of Discord"
+                    + (", please export it without the files" if include_files else ""),
+                    ephemeral=True,
+                )
+                return
+            extension = WRITERS[format].extension
+            await int.followup.send(
+                f"Exported {n_messages} messages",
+                file=discord.File(fp, filename=f"thread_{thread.id}.{extension}"),
+                ephemeral=True,
+            )
+
+
+def render_title(result: SearchResult) -> str:
+    turn = result.turn
+    return f"{turn.author} ({turn.role})"[:256]
+
+
+def render_result(result: SearchResult) -> str:
+    turn = result.turn
+    snippet = " ".join(result.snippet.split())
+    if len(snippet) > RESULT_CHARS:
+        snippet = snippet[:RESULT_CHARS] + "…"
+    return f"{snippet}\n<t:{int(turn.created_at)}:f> · <#{turn.discord_thread_id}> · [Jump]({result.jump_url})"
+
+
+async def setup(bot):
+    await bot.add_cog(History(bot))
@@ -0,0 +1,280 @@
+"""Evaluate assistants offline on a set of prompts.
+
+Reads a JSONL file of prompts and runs every prompt against every given
+assistant, each in a throwaway OpenAI thread with the run settings of the
+assistant, as /compare does. One row per assistant and prompt, with the
+answer, the latency and the tokens used, is written to a JSONL or CSV file
+(chosen by the extension of --output).
+
+    python -m src.evaluate prompts.jsonl --assistant asst_abc --assistant asst_def
+    python -m src.evaluate prompts.jsonl --assistant asst_abc --output results.csv --concurrency 8
+
+Each line of the prompt file is an object such as
+{"id": "q1", "prompt": "What is a monad?", "expected": ["functor", "bind"]}.
+`id` defaults to the line number, and `expected` is optional: an answer
+passes when it contains every expected keyword (case insensitive).
+
+The output file also records the progress: running the same command again
+skips the prompts already answered and runs the failed ones again. Runs
+failing with rate_limit_exceeded pause every worker with an exponential
+backoff and are retried. The exit status is 1 if a prompt failed or missed
+an expected keyword.
+
+Without network access, e.g. in CI, run it against the fake Assistants API:
+
+    python -m benchmarks.fake_openai --port 8787 --assistant asst_ci &
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 OPENAI_API_KEY=sk-ci \\
+        python -m src.evaluate prompts.jsonl --assistant asst_ci
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from dotenv import load_dotenv
+
+# src.constants requires the settings of the Discord bot, which are not used here
+load_dotenv()
+for key, value in {
+    "DISCORD_BOT_TOKEN": "unused",
+    "DISCORD_CLIENT_ID": "0",
+    "ALLOWED_SERVER_IDS": "0",
+    "DEFAULT_MODEL": "unused",
+}.items():
+    os.environ.setdefault(key, value)
+
+from src.constants import LOG_LEVEL
+from src.models.api_response import ResponseStatus
+from src.models.assistant import RunSettings
+from src.openai_api.assistants import get_run_settings
+from src.openai_api.thread_messages import generate_response_in_new_thread
+from src.tracing import setup_logging
+
+logger = logging.getLogger(__name__)
+
+FIELDS = [
+    "assistant_id", "prompt_id", "status", "passed", "missing", "latency_s", "attempts",
+    "prompt_tokens", "completion_tokens", "total_tokens", "prompt", "answer", "error",
+]
+BACKOFF_INITIAL_DELAY = 2.0
+BACKOFF_MAX_DELAY = 60.0
+
+
+@dataclass
+class Prompt:
+    id: str
+    prompt: str
+    expected: list[str] = field(default_factory=list)
+
+
+def load_prompts(path: Path) -> list[Prompt]:
+    prompts = []
+    with path.open(encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            prompts.append(Prompt(
+                id=str(item.get("id", line_number)),
+                prompt=item["prompt"],
+                expected=list(item.get("expected") or []),
+            ))
+    return prompts
+
+
+class ResultFile:
+    """Results appended as rows of a JSONL or CSV file, flushed one by one so that an
+    interrupted evaluation can be resumed
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.is_csv = path.suffix.lower() == ".csv"
+
+    def answered(self) -> set[tuple[str, str]]:
+        """(assistant id, prompt id) of the rows already answered"""
+        if not self.path.exists():
+            return set()
+        with self.path.open(encoding="utf-8", newline="") as f:
+            rows = csv.DictReader(f) if self.is_csv else (json.loads(line) for line in f if line.strip())
+            return {(row["assistant_id"], str(row["prompt_id"])) for row in rows if row["status"] == "ok"}
+
+    def append(self, row: dict[str, Any]) -> None:
+        new = not self.path.exists() or self.path.stat().st_size == 0
+        with self.path.open("a", encoding="utf-8", newline="") as f:
+            if self.is_csv:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                if new:
+                    writer.writeheader()
+                writer.writerow({**row, "missing": json.dumps(row["missing"], ensure_ascii=False)})
+            else:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+class Backoff:
+    """Pause shared by the workers: a rate limited run delays every next run"""
+
+    def __init__(self, initial: float = BACKOFF_INITIAL_DELAY, maximum: float = BACKOFF_MAX_DELAY):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = initial
+        self.resume_at = 0.0
+
+    async def wait(self) -> None:
+        while (remaining := self.resume_at - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+
+    def rate_limited(self) -> None:
+        # with jitter, so the workers do not retry all at once
+        delay = self.delay * random.uniform(1.0, 1.5)
+        self.resume_at = max(self.resume_at, time.monotonic() + delay)
+        self.delay = min(self.delay * 2, self.maximum)
+        logger.warning(f"Rate limited, pausing for {delay:.1f}s")
+
+    def succeeded(self) -> None:
+        self.delay = self.initial
+
+
+async def evaluate_prompt(
+    assistant_id: str, run_settings: RunSettings, prompt: Prompt, author: str, backoff: Backoff, max_attempts: int
+) -> dict[str, Any]:
+    for attempt in range(1, max_attempts + 1):
+        await backoff.wait()
+        started = time.monotonic()
+        response_data = await generate_response_in_new_thread(
+            assistant_id, author_name=author, prompt=prompt.prompt, run_settings=run_settings
+        )
+        latency = time.monotonic() - started
+        if response_data.error_code != "rate_limit_exceeded":
+            backoff.succeeded()
+            break
+        if attempt < max_attempts:
+            backoff.rate_limited()
+
+    ok = response_data.status is ResponseStatus.OK and response_data.message is not None
+    answer = response_data.message.text if ok else ""
+    missing = [keyword for keyword in prompt.expected if keyword.casefold() not in answer.casefold()]
+    usage = response_data.usage or {}
+    return {
+        "assistant_id": assistant_id,
+        "prompt_id": prompt.id,
+        "status": "ok" if ok else "error",
+        "passed": (ok and not missing) if prompt.expected else None,
+        "missing": missing,
+        "latency_s": round(latency, 3),
+        "attempts": attempt,
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "total_tokens": usage.get("total_tokens"),
+        "prompt": prompt.prompt,
+        "answer": answer,
+        "error": None if ok else (response_data.error_code or response_data.status_text),
+    }
+
+
+async def evaluate(
+    prompts: list[Prompt],
+    assistant_ids: list[str],
+    results: ResultFile,
+    concurrency: int,
+    author: str,
+    max_attempts: int,
+) -> list[dict[str, Any]]:
+    # fail early on a wrong assistant id
+    run_settings: dict[str, RunSettings] = {}
+    for assistant_id in assistant_ids:
+        try:
+            run_settings[assistant_id] = await get_run_settings(assistant_id)
+        except Exception as e:
+            raise SystemExit(f"Cannot evaluate assistant {assistant_id}: {e}")
+
+    answered = results.answered()
+    queue: asyncio.Queue[tuple[str, Prompt]] = asyncio.Queue()
+    for assistant_id in assistant_ids:
+        for prompt in prompts:
+            if (assistant_id, prompt.id) not in answered:
+                queue.put_nowait((assistant_id, prompt))
+    total = queue.qsize()
+    logger.info(f"{total} runs to do, {len(answered)} already answered in {results.path}")
+
+    backoff = Backoff()
+    rows: list[dict[str, Any]] = []
+
+    async def work() -> None:
+        while not queue.empty():
+            assistant_id, prompt = queue.get_nowait()
+            try:
+                row = await evaluate_prompt(
+                    assistant_id, run_settings[assistant_id], prompt, author, backoff, max_attempts
+                )
+            except Exception as e:
+                logger.exception(f"Failed to evaluate prompt {prompt.id} with {assistant_id}")
+                row = {
+                    "assistant_id": assistant_id, "prompt_id": prompt.id, "status": "error", "passed": None,
+                    "missing": [], "latency_s": None, "attempts": None, "prompt_tokens": None,
+                    "completion_tokens": None, "total_tokens": None, "prompt": prompt.prompt, "answer": "",
+                    "error": str(e),
+                }
+            results.append(row)
+            rows.append(row)
+            logger.info(
+                f"[{len(rows)}/{total}] {assistant_id} {prompt.id}: {row['status']}"
+                + (f", passed={row['passed']}" if row["passed"] is not None else "")
+                + (f" in {row['latency_s']:.1f}s" if row["latency_s"] is not None else "")
+            )
+
+    await asyncio.gather(*(work() for _ in range(concurrency)))
+    return rows
+
+
+def print_summary(rows: list[dict[str, Any]]) -> None:
+    print(f"{'assistant':<32} {'runs':>5} {'errors':>6} {'passed':>9} {'p50':>7} {'p90':>7} {'tokens/run':>10}")
+    for assistant_id in dict.fromkeys(row["assistant_id"] for row in rows):
+        own = [row for row in rows if row["assistant_id"] == assistant_id]
+        ok = [row for row in own if row["status"] == "ok"]
+        checked = [row for row in own if row["passed"] is not None]
+        latencies = sorted(row["latency_s"] for row in ok)
+        tokens = [row["total_tokens"] for row in ok if row["total_tokens"] is not None]
+        print(
+            f"{assistant_id:<32} {len(own):>5} {len(own) - len(ok):>6} "
+            f"{sum(row['passed'] for row in checked):>4}/{len(checked):<4} "
+            f"{statistics.median(latencies) if latencies else 0:>6.1f}s "
+            f"{latencies[int(len(latencies) * 0.9)] if latencies else 0:>6.1f}s "
+            f"{statistics.mean(tokens) if tokens else 0:>10.0f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("prompts", type=Path, help="JSONL file of prompts")
+    parser.add_argument("--assistant", action="append", required=True, dest="assistant_ids",
+                        help="assistant id to evaluate (repeatable)")
+    parser.add_argument("--output", type=Path, default=Path("results.jsonl"), help="results file (.jsonl or .csv)")
+    parser.add_argument("--concurrency", type=int, default=4, help="runs at once")
+    parser.add_argument("--author", default="evaluator", help="user name the prompts are sent as")
+    parser.add_argument("--max-attempts", type=int, default=5, help="attempts per prompt when rate limited")
+    args = parser.parse_args()
+
+    setup_logging(LOG_LEVEL)
+    prompts = load_prompts(args.prompts)
+    rows = asyncio.run(evaluate(
+        prompts, args.assistant_ids, ResultFile(args.output), args.concurrency, args.author, args.max_attempts
+    ))
+    print_summary(rows)
+    if any(row["status"] != "ok" or row["passed"] is False for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
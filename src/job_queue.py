@@ -0,0 +1,202 @@
+"""Durable job queue connecting the gateway process to the run workers.
+
+Jobs are rows of a SQLite database shared by the processes of one host. A
+worker claims a job with a lease: if the worker dies, the job becomes
+available again once the lease expires. Failed jobs are retried with a
+backoff until their attempts run out.
+
+A claim can be limited to the jobs whose payload fields (e.g. the guild)
+have fewer running jobs than a maximum. The running jobs are counted in the
+queue itself, so the limits hold across all the workers.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any
+
+from src.constants import JOB_QUEUE_PATH
+
+logger = logging.getLogger(__name__)
+
+# oldest available jobs looked at by a limited claim
+CLAIM_WINDOW = 100
+
+
+@dataclass
+class Job:
+    id: int
+    # jobs with the same idempotency key are only enqueued once
+    idempotency_key: str
+    payload: dict[str, Any]
+    attempts: int
+    max_attempts: int
+
+
+class JobQueue:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                available_at REAL NOT NULL,
+                lease_expires_at REAL,
+                worker TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at)")
+        self._lock = threading.Lock()
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, parameters)
+
+    def _enqueue(self, idempotency_key: str, payload: dict[str, Any], max_attempts: int) -> bool:
+        now = time.time()
+        cursor = self._execute(
+            "INSERT OR IGNORE INTO jobs (idempotency_key, payload, max_attempts, available_at, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (idempotency_key, json.dumps(payload), max_attempts, now, now, now),
+        )
+        return cursor.rowcount == 1
+
+    def _running_counts(self, fields: list[str], now: float) -> Counter[tuple[str, Any]]:
+        """Number of running jobs per value of each payload field"""
+        counts: Counter[tuple[str, Any]] = Counter()
+        for (payload,) in self._conn.execute(
+            "SELECT payload FROM jobs WHERE status = 'running' AND lease_expires_at > ?", (now,)
+        ):
+            payload = json.loads(payload)
+            for field in fields:
+                counts[field, payload.get(field)] += 1
+        return counts
+
+    @staticmethod
+    def _within_limits(payload: dict[str, Any], limits: dict[str, int], counts: Counter[tuple[str, Any]]) -> bool:
+        return all(counts[field, payload.get(field)] < limit for field, limit in limits.items())
+
+    def _claim(self, worker: str, lease: float, limits: dict[str, int] | None) -> Job | None:
+        now = time.time()
+        # a limit of 0 is no limit
+        limits = {field: limit for field, limit in (limits or {}).items() if limit}
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock, so two workers cannot claim the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, idempotency_key, payload, attempts, max_attempts FROM jobs"
+                    " WHERE (status = 'queued' AND available_at <= ?)"
+                    " OR (status = 'running' AND lease_expires_at <= ?)"
+                    " ORDER BY id LIMIT ?",
+                    (now, now, CLAIM_WINDOW if limits else 1),
+                ).fetchall()
+                row = rows[0] if rows else None
+                if limits and rows:
+                    # the oldest job within its limits, so a busy guild does not hold back the others
+                    counts = self._running_counts(list(limits), now)
+                    row = next((row for row in rows if self._within_limits(json.loads(row[2]), limits, counts)), None)
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?,"
+                        " lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                        (worker, now + lease, now, row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        id, idempotency_key, payload, attempts, max_attempts = row
+        return Job(id, idempotency_key, json.loads(payload), attempts + 1, max_attempts)
+
+    def _extend_lease(self, job_id: int, worker: str, lease: float) -> None:
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (now + lease, now, job_id, worker),
+        )
+
+    def _complete(self, job_id: int) -> None:
+        self._execute(
+            "UPDATE jobs SET status = 'done', lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+            (time.time(), job_id),
+        )
+
+    def _fail(self, job: Job, error: str, retry_delay: float) -> bool:
+        now = time.time()
+        retry = job.attempts < job.max_attempts
+        self._execute(
+            "UPDATE jobs SET status = ?, available_at = ?, lease_expires_at = NULL, error = ?, updated_at = ?"
+            " WHERE id = ?",
+            ("queued" if retry else "failed", now + retry_delay, error, now, job.id),
+        )
+        return retry
+
+    def _depth(self) -> int:
+        return self._execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def _purge(self, older_than: float) -> int:
+        cursor = self._execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (time.time() - older_than,),
+        )
+        return cursor.rowcount
+
+    async def enqueue(self, idempotency_key: str, payload: dict[str, Any], max_attempts: int = 3) -> bool:
+        """Add a job, return False if a job with the same idempotency key already exists"""
+        return await asyncio.to_thread(self._enqueue, idempotency_key, payload, max_attempts)
+
+    async def claim(self, worker: str, lease: float, limits: dict[str, int] | None = None) -> Job | None:
+        """Take the oldest available job, or a running job whose lease expired.
+        With `limits`, only a job whose payload fields have fewer running jobs than their limit is taken.
+        """
+        return await asyncio.to_thread(self._claim, worker, lease, limits)
+
+    async def extend_lease(self, job_id: int, worker: str, lease: float) -> None:
+        await asyncio.to_thread(self._extend_lease, job_id, worker, lease)
+
+    async def complete(self, job_id: int) -> None:
+        await asyncio.to_thread(self._complete, job_id)
+
+    async def fail(self, job: Job, error: str, retry_delay: float) -> bool:
+        """Record a failed attempt, return True if the job will be retried"""
+        return await asyncio.to_thread(self._fail, job, error, retry_delay)
+
+    async def depth(self) -> int:
+        """Number of jobs waiting or running"""
+        return await asyncio.to_thread(self._depth)
+
+    async def purge(self, older_than: float) -> int:
+        """Delete the finished jobs last updated more than `older_than` seconds ago"""
+        return await asyncio.to_thread(self._purge, older_than)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+_job_queue: JobQueue | None = None
+
+
+def get_job_queue() -> JobQueue:
+    """Return the queue at JOB_QUEUE_PATH, opened on first use"""
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue(JOB_QUEUE_PATH)
+    return _job_queue
@@ -1,40 +1,194 @@
+from __future__ import annotations
+
+import time
+
+_started = time.perf_counter()
+
+import asyncio
+import hashlib
+import json
 import logging
+import math
 from pathlib import Path
 
 import discord
 from discord.ext import commands
 
-from src.constants import BOT_INVITE_URL, DISCORD_BOT_TOKEN
-
-logging.basicConfig(
-    format="[%(asctime)s] [%(filename)s:%(lineno)d] %(message)s", level=logging.INFO
+from src.constants import (
+    BOT_INVITE_URL,
+    COMMAND_TREE_FINGERPRINT_PATH,
+    DISCORD_BOT_TOKEN,
+    FORCE_COMMAND_SYNC,
+    LOG_LEVEL,
+    METRICS_HOST,
+    METRICS_PORT,
+    RUN_MODE,
+    SHARD_COUNT,
+    SHARD_IDS,
+    TRACE_EXPORT_PATH,
+    TRACE_OTLP_ENDPOINT,
 )
+from src import media
+from src.config import watch_config
+from src.discord_cogs._wizard import wizards
+from src.metrics import DISCORD_ERRORS, DISCORD_REQUESTS, SHARD_GUILDS, SHARD_LATENCY, MetricsServer
+from src.store import purge_expired_keys, require_shared_store, store
+from src.tracing import setup_logging, setup_tracing
+from src.transcripts import close_transcript_index
+
+setup_logging(LOG_LEVEL)
+
+logger = logging.getLogger(__name__)
+
+
+def log_phase(phase: str, started: float) -> float:
+    """Log the duration of a startup phase and return the current time"""
+    now = time.perf_counter()
+    logger.info(f"Startup phase {phase} took {(now - started) * 1000:.0f} ms")
+    return now
+
+
+class GPTBot(commands.AutoShardedBot):
+    def __init__(
+        self,
+        intents: discord.Intents,
+        shard_count: int | None = SHARD_COUNT,
+        shard_ids: list[int] | None = SHARD_IDS,
+    ) -> None:
+        super().__init__(
+            command_prefix="/",
+            intents=intents,
+            help_command=None,
+            shard_count=shard_count,
+            shard_ids=shard_ids,
+        )
+        self.metrics_server = None
+        self.config_watcher: asyncio.Task | None = None
+        self.store_purgers: list[asyncio.Task] = []
+        self._ready_logged = False
+        # set by the Chat and Assistants cogs once the runs of the journal and the saved wizards
+        # are resumed, kept across cog reloads
+        self.runs_resumed = False
+        self.wizards_resumed = False
+        self._instrument_http()
+
+    def _instrument_http(self) -> None:
+        """Count every Discord REST request made through the HTTP client"""
+        request = self.http.request
 
+        async def instrumented_request(route, **kwargs):
+            DISCORD_REQUESTS.labels(method=route.method).inc()
+            try:
+                return await request(route, **kwargs)
+            except discord.HTTPException as e:
+                DISCORD_ERRORS.labels(status=e.status).inc()
+                raise
 
-class GPTBot(commands.Bot):
-    def __init__(self, intents: discord.Intents) -> None:
-        super().__init__(command_prefix="/", intents=intents, help_command=None)
+        self.http.request = instrumented_request
+
+    def command_tree_fingerprint(self) -> str:
+        """Hash of the serialized application commands, as they would be sent by sync"""
+        payload = [command.to_dict() for command in self.tree.get_commands()]
+        data = json.dumps([self.application_id, payload], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    async def sync_command_tree(self) -> None:
+        """Sync the command tree with Discord, only if the commands changed since the last sync.
+        The sync is a rate-limited global call, so it is skipped on plain restarts.
+        """
+        fingerprint = self.command_tree_fingerprint()
+        path = Path(COMMAND_TREE_FINGERPRINT_PATH)
+        try:
+            stored = path.read_text().strip()
+        except OSError:
+            stored = None
+        if stored == fingerprint and not FORCE_COMMAND_SYNC:
+            logger.info(f"Command tree unchanged ({fingerprint[:12]}), skipping sync")
+            return
+
+        await self.tree.sync()
+        try:
+            path.write_text(fingerprint)
+        except OSError as e:
+            logger.warning(f"Failed to store the command tree fingerprint: {e}")
+        logger.info(f"Synced the command tree ({fingerprint[:12]})")
 
     async def setup_hook(self):
+        started = log_phase("login", self._login_started)
+        if METRICS_PORT:
+            self.metrics_server = MetricsServer(self, host=METRICS_HOST, port=METRICS_PORT)
+            await self.metrics_server.start()
+            started = log_phase("metrics server", started)
+
+        # the settings are reloaded in the background when the config file changes
+        self.config_watcher = asyncio.create_task(watch_config())
+        # the keys that are never read again are only deleted by the purge
+        self.store_purgers = [
+            asyncio.create_task(purge_expired_keys(backend)) for backend in {store, wizards.store}
+        ]
+
         # Enable cogs in discord_cogs directory (except for files starting with _)
         cog_dir = Path(__file__).parent / "discord_cogs"
         for cog_path in cog_dir.glob("*.py"):
             cog_name = cog_path.stem
             if cog_name.startswith("_"):
                 continue
-            await bot.load_extension(f"src.discord_cogs.{cog_name}")
+            await self.load_extension(f"src.discord_cogs.{cog_name}")
+            started = log_phase(f"load {cog_name}", started)
+
+        await self.sync_command_tree()
+        log_phase("command tree sync", started)
 
-        await bot.tree.sync()
+    async def login(self, token: str) -> None:
+        self._login_started = time.perf_counter()
+        await super().login(token)
+
+    async def close(self):
+        if self.config_watcher is not None:
+            self.config_watcher.cancel()
+        for purger in self.store_purgers:
+            purger.cancel()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await super().close()
+        await store.close()
+        if wizards.store is not store:
+            await wizards.store.close()
+        await close_transcript_index()
+        media.shutdown()
+
+    async def on_shard_ready(self, shard_id: int):
+        shard = self.get_shard(shard_id)
+        SHARD_LATENCY.labels(shard=shard_id).set_function(
+            lambda: shard.latency if math.isfinite(shard.latency) else -1
+        )
+        SHARD_GUILDS.labels(shard=shard_id).set_function(
+            lambda: sum(1 for guild in self.guilds if guild.shard_id == shard_id)
+        )
+        logger.info(f"Shard {shard_id}/{shard.shard_count} ready, latency {shard.latency * 1000:.0f} ms")
 
     async def on_ready(self):
+        if not self._ready_logged:
+            self._ready_logged = True
+            log_phase("total until ready", _started)
         logging.info(f"We have logged in as {self.user}. Invite URL: {BOT_INVITE_URL}")
 
 
 if __name__ == "__main__":
-    # Define intents
-    intents = discord.Intents.default()
-    intents.message_content = True
+    log_phase("imports", _started)
+    require_shared_store(RUN_MODE)
+
+    if RUN_MODE == "worker":
+        from src.worker import run_workers
+
+        run_workers()
+    else:
+        # Define intents
+        intents = discord.Intents.default()
+        intents.message_content = True
+
+        setup_tracing(jsonl_path=TRACE_EXPORT_PATH, otlp_endpoint=TRACE_OTLP_ENDPOINT)
 
-    # Create bot instance and run
-    bot = GPTBot(intents=intents)
-    bot.run(DISCORD_BOT_TOKEN)
+        # Create bot instance and run
+        bot = GPTBot(intents=intents)
+        bot.run(DISCORD_BOT_TOKEN)
@@ -0,0 +1,246 @@
+"""Processing of the images exchanged with the assistants.
+
+The images sent by the users are prepared for the vision models before
+they are uploaded: rotated as their EXIF orientation says, downscaled to
+the resolution the model actually sees, and re-encoded without their
+metadata (e.g. the location of a phone photo), as JPEG or, for images with
+transparency, as PNG. The detail the model looks at them with is chosen by
+their size: an image that fits in the low detail resolution costs the same
+few tokens in both, so it is sent with `low`, larger ones with `high`.
+Assistants can force `low` or `high` with `image_detail` in their metadata.
+
+The files made by the code interpreter are sent to Discord as they are
+downloaded, with a name built from their id (or the name the assistant gave
+them) and the extension of their real format, read from their first bytes.
+An image over the pixel or byte budget is downscaled and recompressed,
+first as an optimized PNG, then as a JPEG of decreasing quality, until it
+fits. Decoding and encoding an image takes hundreds of milliseconds of CPU,
+so it is done in a pool of processes instead of blocking the event loop.
+Other files, e.g. a CSV, are sent as documents.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import posixpath
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from discord import File
+
+from src.constants import MEDIA_PROCESS_WORKERS, OUTGOING_IMAGE_MAX_BYTES, OUTGOING_IMAGE_MAX_PIXELS
+from src.metrics import INCOMING_IMAGE_BYTES_SAVED, INCOMING_IMAGES, MEDIA_PROCESSING_LATENCY, OUTGOING_FILES
+from src.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# the first bytes of each image format, and its extension
+IMAGE_SIGNATURES: tuple[tuple[bytes, str], ...] = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+JPEG_QUALITIES = (85, 70, 50)
+# the vision models fit an image in 2048x2048, then scale its short side down to 768 for the high
+# detail, and look at 512x512 for the low detail
+VISION_MAX_SIDE = 2048
+VISION_HIGH_SHORT_SIDE = 768
+VISION_LOW_SIDE = 512
+VISION_JPEG_QUALITY = 85
+IMAGE_DETAILS = ("auto", "low", "high")
+# factor applied to the sides of an image still over the byte budget at the lowest quality
+DOWNSCALE_STEP = 0.75
+MIN_SIDE = 64
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def image_format(data: bytes) -> str | None:
+    """Extension of the image format of the data, None if it is not an image"""
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def file_name(stem: str, data: bytes, default_extension: str = "bin") -> str:
+    """Name of the file with the extension of its real format"""
+    extension = image_format(data)
+    base, dot, current = stem.rpartition(".")
+    if not dot:
+        base, current = stem, ""
+    if extension is None:
+        return stem if current else f"{stem}.{default_extension}"
+    if current.lower() in (extension, "jpeg" if extension == "jpg" else extension):
+        return stem
+    return f"{base}.{extension}"
+
+
+def annotation_file_name(text: str | None, file_id: str) -> str:
+    """Name the assistant gave the file in its answer, e.g. sandbox:/mnt/data/result.csv"""
+    name = posixpath.basename(text or "")
+    return name or file_id
+
+
+def _fits(data: bytes, max_bytes: int, max_pixels: int) -> bool:
+    """Whether the image can be sent as it is, reading only its header"""
+    from PIL import Image
+
+    if len(data) > max_bytes:
+        return False
+    try:
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+    except Exception:
+        # not decodable, sent as it is
+        return True
+    return width * height <= max_pixels
+
+
+def _transcode(data: bytes, max_bytes: int, max_pixels: int) -> tuple[bytes, str]:
+    """Downscale and recompress the image to the budgets, return the data and its extension.
+    Run in the process pool.
+    """
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as image:
+        if getattr(image, "is_animated", False):
+            # downscaling the frames of an animation is not worth it
+            return data, image_format(data) or "gif"
+        image.load()
+        scale = min(1.0, (max_pixels / (image.width * image.height)) ** 0.5)
+        while True:
+            size = (max(int(image.width * scale), MIN_SIDE), max(int(image.height * scale), MIN_SIDE))
+            resized = image.resize(size, Image.LANCZOS) if scale < 1.0 else image
+
+            # charts and diagrams compress best as PNG, photos as JPEG
+            buffer = BytesIO()
+            resized.save(buffer, format="PNG", optimize=True)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue(), "png"
+            if resized.mode != "RGB":
+                rgba = resized.convert("RGBA")
+                flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+                flattened.paste(rgba, mask=rgba.getchannel("A"))
+                resized = flattened
+            for quality in JPEG_QUALITIES:
+                buffer = BytesIO()
+                resized.save(buffer, format="JPEG", quality=quality, optimize=True)
+                if buffer.tell() <= max_bytes:
+                    return buffer.getvalue(), "jpg"
+            if min(size) <= MIN_SIDE:
+                return buffer.getvalue(), "jpg"
+            scale *= DOWNSCALE_STEP
+
+
+def _vision_size(width: int, height: int, detail: str) -> tuple[int, int]:
+    """Size of the image as the model sees it with the detail"""
+    if detail == "low":
+        scale = min(1.0, VISION_LOW_SIDE / max(width, height))
+    else:
+        scale = min(1.0, VISION_MAX_SIDE / max(width, height), VISION_HIGH_SHORT_SIDE / min(width, height))
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def _prepare_vision_image(data: bytes, detail: str) -> tuple[bytes, str, str]:
+    """Orient, downscale and re-encode an image sent by a user, return the data, its extension and
+    the detail to send it with. Run in the process pool.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(data)) as image:
+        # the first frame of an animation
+        image = ImageOps.exif_transpose(image)
+        if detail == "auto":
+            detail = "low" if max(image.size) <= VISION_LOW_SIDE else "high"
+        size = _vision_size(image.width, image.height, detail)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+
+        # saved without the info and EXIF of the original
+        buffer = BytesIO()
+        if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+            image.convert("RGBA").save(buffer, format="PNG", optimize=True)
+            return buffer.getvalue(), "png", detail
+        image.convert("RGB").save(buffer, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+        return buffer.getvalue(), "jpg", detail
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, as the worker processes: forking the process of the bot would copy its event loop and sockets
+        _pool = ProcessPoolExecutor(
+            max_workers=MEDIA_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def fit_image(
+    data: bytes, max_bytes: int = OUTGOING_IMAGE_MAX_BYTES, max_pixels: int = OUTGOING_IMAGE_MAX_PIXELS
+) -> tuple[bytes, str | None]:
+    """The image within the budgets and its extension, the data unchanged if it already fits"""
+    if _fits(data, max_bytes, max_pixels):
+        return data, image_format(data)
+    started = time.perf_counter()
+    with span("media.transcode", size=len(data)) as transcode_span:
+        loop = asyncio.get_running_loop()
+        try:
+            transcoded, extension = await loop.run_in_executor(_get_pool(), _transcode, data, max_bytes, max_pixels)
+        except Exception:
+            logger.exception("Failed to transcode an image, sending it as it is")
+            return data, image_format(data)
+        transcode_span.set_attribute("transcoded_size", len(transcoded))
+    MEDIA_PROCESSING_LATENCY.observe(time.perf_counter() - started)
+    logger.debug(f"Transcoded an image of {len(data)} bytes into {len(transcoded)} bytes of {extension}")
+    return transcoded, extension
+
+
+async def prepare_vision_image(data: bytes, name: str, detail: str = "auto") -> tuple[bytes, str, str]:
+    """The image of a user ready to upload for vision: its data, its file name and the detail to
+    send it with. An image that cannot be decoded is uploaded as it is.
+    """
+    started = time.perf_counter()
+    with span("media.prepare_vision_image", size=len(data), detail=detail) as prepare_span:
+        loop = asyncio.get_running_loop()
+        try:
+            prepared, extension, detail = await loop.run_in_executor(
+                _get_pool(), _prepare_vision_image, data, detail
+            )
+        except Exception:
+            logger.warning(f"Failed to prepare the image {name}, uploading it as it is", exc_info=True)
+            INCOMING_IMAGES.labels(action="unchanged").inc()
+            return data, name, detail
+        prepare_span.set_attribute("prepared_size", len(prepared))
+        prepare_span.set_attribute("detail", detail)
+    MEDIA_PROCESSING_LATENCY.observe(time.perf_counter() - started)
+    INCOMING_IMAGES.labels(action="prepared").inc()
+    INCOMING_IMAGE_BYTES_SAVED.inc(max(len(data) - len(prepared), 0))
+    logger.debug(f"Prepared the image {name} from {len(data)} to {len(prepared)} bytes, detail {detail}")
+    return prepared, f"{name.rpartition('.')[0] or name}.{extension}", detail
+
+
+async def prepare_outgoing_file(data: bytes, name: str) -> File:
+    """The Discord file of a file made by an assistant: images are fitted to the budgets,
+    other files are sent as documents
+    """
+    if image_format(data) is None:
+        OUTGOING_FILES.labels(kind="document", action="sent").inc()
+        return File(fp=BytesIO(data), filename=file_name(name, data))
+
+    fitted, extension = await fit_image(data)
+    OUTGOING_FILES.labels(kind="image", action="sent" if fitted is data else "transcoded").inc()
+    stem = name.rpartition(".")[0] or name
+    return File(fp=BytesIO(fitted), filename=f"{stem}.{extension}" if extension else file_name(name, fitted))
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import threading
+from typing import Callable
+
+from aiohttp import web
+
+from src.tracing import Span, add_span_processor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple[str, ...], _Metric] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += self._samples()
+        return "\n".join(lines)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Callable[[], float] | None = None
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Compute the value at scrape time"""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"
+            for key, child in list(self._children.items())
+        ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.labels().set_function(function)
+
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {child.count}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+RUN_LATENCY = Histogram(
+    "gptbot_run_latency_seconds", "Duration of assistant runs by final status", ("status",)
+)
+TIME_TO_FIRST_RESPONSE = Histogram(
+    "gptbot_time_to_first_response_seconds", "Time from receiving a thread message to the first reply sent"
+)
+RUN_POLLS = Histogram(
+    "gptbot_run_polls", "Number of status polls per run", buckets=(1, 2, 3, 5, 10, 20, 30, 60, 120)
+)
+RUN_TOKENS = Histogram(
+    "gptbot_run_tokens", "Tokens used per run by kind (prompt/completion)", ("kind",),
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+RUN_TIMEOUTS = Counter(
+    "gptbot_run_timeouts_total", "Runs cancelled for going over a deadline, by phase", ("phase",)
+)
+RUNS_RESUMED = Counter(
+    "gptbot_runs_resumed_total",
+    "Runs of the journal resumed after a restart, by result (delivered/stale/cancelled/error)",
+    ("result",),
+)
+RUNS_CANCELLED = Counter(
+    "gptbot_runs_cancelled_total", "Runs cancelled because their answer was no longer wanted, by reason", ("reason",)
+)
+RUN_TOKENS_SAVED = Counter(
+    "gptbot_cancelled_run_tokens_saved_total",
+    "Estimated tokens saved by cancelling runs (tokens used by the previous run of their thread)",
+)
+OUTGOING_FILES = Counter(
+    "gptbot_outgoing_files_total",
+    "Files of the answers sent to Discord, by kind (image/document) and action (sent/transcoded)",
+    ("kind", "action"),
+)
+TRANSCRIPT_TURNS = Counter(
+    "gptbot_transcript_turns_total", "Chat turns added to the transcript index, by role", ("role",)
+)
+TRANSCRIPT_SEARCH_LATENCY = Histogram(
+    "gptbot_transcript_search_seconds",
+    "Time to search the transcript index",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0),
+)
+THREAD_EXPORTS = Counter("gptbot_thread_exports_total", "Chat threads exported with /export, by format", ("format",))
+INCOMING_IMAGES = Counter(
+    "gptbot_incoming_images_total",
+    "Images sent by the users for vision, by action (prepared, or unchanged when they could not be decoded)",
+    ("action",),
+)
+INCOMING_IMAGE_BYTES_SAVED = Counter(
+    "gptbot_incoming_image_bytes_saved_total", "Bytes not uploaded thanks to the preparation of the user images"
+)
+MEDIA_PROCESSING_LATENCY = Histogram(
+    "gptbot_media_processing_seconds", "Time to process an image in the media process pool"
+)
+RETRIES = Counter(
+    "gptbot_retries_total",
+    "Calls failing with a transient error, by operation and result (retried/recovered/exhausted)",
+    ("operation", "result"),
+)
+DUPLICATE_MESSAGES = Counter(
+    "gptbot_duplicate_messages_total", "Thread messages ignored because they were already processed"
+)
+DEAD_LETTERS = Counter(
+    "gptbot_dead_letters_total",
+    "Replies that could not be delivered, by action (stored/delivered/expired/dropped)",
+    ("action",),
+)
+THREAD_COMPACTIONS = Counter(
+    "gptbot_thread_compactions_total", "OpenAI threads replaced by a summarized thread, by reason", ("reason",)
+)
+TOOL_LATENCY = Histogram(
+    "gptbot_tool_latency_seconds", "Duration of function tool calls", ("tool",)
+)
+OPENAI_REQUESTS = Counter(
+    "gptbot_openai_requests_total", "Requests sent to the OpenAI API", ("method",)
+)
+OPENAI_ERRORS = Counter(
+    "gptbot_openai_errors_total", "OpenAI API responses with an error status", ("status",)
+)
+DISCORD_REQUESTS = Counter(
+    "gptbot_discord_requests_total", "Requests sent to the Discord REST API", ("method",)
+)
+DISCORD_ERRORS = Counter(
+    "gptbot_discord_errors_total", "Discord REST API requests that failed", ("status",)
+)
+ACTIVE_RUNS = Gauge("gptbot_active_runs", "Runs currently in progress")
+QUEUE_DEPTH = Gauge("gptbot_queue_depth", "Number of items waiting in internal queues", ("queue",))
+CACHE_REQUESTS = Counter(
+    "gptbot_cache_requests_total", "Cache lookups by cache and result (hit/miss)", ("cache", "result")
+)
+EVENT_LOOP_LAG = Gauge("gptbot_event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task")
+GATEWAY_LATENCY = Gauge("gptbot_gateway_latency_seconds", "Discord gateway heartbeat latency")
+SHARD_LATENCY = Gauge("gptbot_shard_latency_seconds", "Gateway heartbeat latency per shard", ("shard",))
+SHARD_GUILDS = Gauge("gptbot_shard_guilds", "Guilds handled per shard", ("shard",))
+SHARD_MESSAGES = Counter("gptbot_shard_messages_total", "Chat thread messages handled per shard", ("shard",))
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def _record_span(span_: Span) -> None:
+    if span_.name == "tool.call":
+        TOOL_LATENCY.labels(tool=span_.attributes.get("tool_name", "unknown")).observe(span_.duration)
+
+
+add_span_processor(_record_span)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    """Measure how late the event loop wakes up a task that sleeps for `interval`"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, loop.time() - start - interval))
+
+
+class MetricsServer:
+    """Embedded HTTP server exposing /metrics, /healthz and /readyz"""
+
+    def __init__(self, bot, host: str, port: int, max_loop_lag: float = 5.0):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.max_loop_lag = max_loop_lag
+        self._runner: web.AppRunner | None = None
+        self._lag_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        GATEWAY_LATENCY.set_function(lambda: self.bot.latency if math.isfinite(self.bot.latency) else -1)
+        self._lag_task = asyncio.create_task(monitor_event_loop_lag())
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        app.router.add_get("/healthz", self.healthz)
+        app.router.add_get("/readyz", self.readyz)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Metrics server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        """Liveness: the event loop is responsive"""
+        lag = EVENT_LOOP_LAG.labels().get()
+        if lag > self.max_loop_lag:
+            return web.Response(status=503, text=f"event loop lag {lag:.3f}s")
+        return web.Response(text="ok")
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        """Readiness: connected to the gateway and ready to handle events"""
+        if self.bot.is_closed() or not self.bot.is_ready() or not math.isfinite(self.bot.latency):
+            return web.Response(status=503, text="not ready")
+        return web.Response(text="ready")
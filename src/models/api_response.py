@@ -4,18 +4,16 @@ import logging
 from dataclasses import dataclass
 from enum import Enum
 
-from openai import AsyncOpenAI
-
 from src.models.message import Message
 
 logger = logging.getLogger(__name__)
 
-client = AsyncOpenAI()
-
 
 class ResponseStatus(Enum):
     OK = 0
     ERROR = 1
+    # the run was cancelled because its answer is no longer wanted, nothing is sent
+    CANCELLED = 2
 
 
 @dataclass
@@ -23,3 +21,7 @@ class ResponseData:
     status: ResponseStatus
     message: Message | None
     status_text: str | None
+    # token usage of the run (prompt_tokens, completion_tokens, total_tokens)
+    usage: dict[str, int] | None = None
+    # code of the error of a failed run or request, e.g. rate_limit_exceeded
+    error_code: str | None = None
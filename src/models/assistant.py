@@ -1,77 +1,254 @@
 from __future__ import annotations
 
 import logging
-from dataclasses import asdict, dataclass
-from pydantic import BaseModel
-from typing import Any
-import json
-
-from openai.types.beta.assistant import Assistant as OpenAIAssistant
+from typing import TYPE_CHECKING, Any
 
 from src.constants import DEFAULT_MODEL
 
+if TYPE_CHECKING:
+    from openai.types.beta.assistant import Assistant as OpenAIAssistant
+
 logger = logging.getLogger(__name__)
 
 
-@dataclass
 class AssistantCreate:
-    name: str
-    model: str = DEFAULT_MODEL
-    description: str | None = None
-    instructions: str | None = None
-    tools: list[dict[str, Any]] | None = None
-    tool_resources: dict[str, dict[str, list[str]]] | None = None
-    metadata: dict[str, str] | None = None
-
-    def input_to_api_create(self) -> dict[str, str]:
+    __slots__ = ("name", "model", "description", "instructions", "tools", "tool_resources", "metadata")
+
+    def __init__(
+        self,
+        name: str,
+        model: str = DEFAULT_MODEL,
+        description: str | None = None,
+        instructions: str | None = None,
+        tools: list[dict[str, Any]] | None = None,
+        tool_resources: dict[str, dict[str, list[str]]] | None = None,
+        metadata: dict[str, str] | None = None,
+    ):
+        self.name = name
+        self.model = model
+        self.description = description
+        self.instructions = instructions
+        self.tools = tools
+        self.tool_resources = tool_resources
+        self.metadata = metadata
+
+    def input_to_api_create(self) -> dict[str, Any]:
         """Convert the AssistantCreate object to dict for input to API create"""
-        data = asdict(self, dict_factory=lambda x: {k: v for (k, v) in x if v is not None})
+        return {k: v for k in self.__slots__ if (v := getattr(self, k)) is not None}
+
+
+class RunSettings:
+    """Limits applied to each run of an assistant, None meaning no limit.
+
+    They are kept as strings in the metadata of the assistant, and can be
+    overridden per chat thread with the options of /chat.
+    """
+
+    __slots__ = ("last_messages", "max_prompt_tokens", "max_completion_tokens")
+    # metadata key of each setting
+    METADATA_KEYS = {
+        "last_messages": "truncation_last_messages",
+        "max_prompt_tokens": "max_prompt_tokens",
+        "max_completion_tokens": "max_completion_tokens",
+    }
+    # the API rejects token limits lower than this
+    MIN_TOKENS = 256
+    TOKEN_SETTINGS = ("max_prompt_tokens", "max_completion_tokens")
+
+    def __init__(
+        self,
+        last_messages: int | None = None,
+        max_prompt_tokens: int | None = None,
+        max_completion_tokens: int | None = None,
+    ):
+        self.last_messages = last_messages
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_completion_tokens = max_completion_tokens
+
+    @classmethod
+    def from_dict(cls, data: dict[str, int | None]) -> RunSettings:
+        return cls(**{k: data.get(k) for k in cls.__slots__})
+
+    @classmethod
+    def from_metadata(cls, metadata: dict[str, str] | None) -> RunSettings:
+        """Read the settings from the metadata of an assistant, ignoring invalid values"""
+        settings = cls()
+        for name, key in cls.METADATA_KEYS.items():
+            value = (metadata or {}).get(key)
+            if not value:
+                continue
+            try:
+                setattr(settings, name, cls._check(name, int(value)))
+            except ValueError:
+                logger.warning(f"Ignoring invalid assistant metadata {key}={value!r}")
+        return settings
+
+    @classmethod
+    def parse(cls, text: str) -> RunSettings:
+        """Parse settings written as `last_messages=20 max_prompt_tokens=8000`.
+        Raise ValueError if a setting is unknown, not a positive integer, or a token limit under MIN_TOKENS.
+        """
+        settings = cls()
+        for item in text.split():
+            name, _, value = item.partition("=")
+            if name not in cls.__slots__:
+                raise ValueError(f"Unknown setting `{name}`, expected one of {', '.join(cls.__slots__)}")
+            if not value.isdigit():
+                raise ValueError(f"`{name}` must be a positive integer")
+            setattr(settings, name, cls._check(name, int(value)))
+        return settings
+
+    @classmethod
+    def _check(cls, name: str, value: int) -> int:
+        if value <= 0:
+            raise ValueError(f"`{name}` must be a positive integer")
+        if name in cls.TOKEN_SETTINGS and value < cls.MIN_TOKENS:
+            raise ValueError(f"`{name}` must be at least {cls.MIN_TOKENS}")
+        return value
+
+    def asdict(self) -> dict[str, int]:
+        return {k: v for k in self.__slots__ if (v := getattr(self, k)) is not None}
+
+    def to_metadata(self) -> dict[str, str]:
+        return {self.METADATA_KEYS[k]: str(v) for k, v in self.asdict().items()}
+
+    def merge(self, overrides: RunSettings) -> RunSettings:
+        """The settings with the values set in `overrides` replaced"""
+        return RunSettings.from_dict({**self.asdict(), **overrides.asdict()})
+
+    def input_to_api_create(self) -> dict[str, Any]:
+        """Convert the settings to the arguments of the API run create"""
+        data = {}
+        if self.last_messages is not None:
+            data["truncation_strategy"] = {"type": "last_messages", "last_messages": self.last_messages}
+        if self.max_prompt_tokens is not None:
+            data["max_prompt_tokens"] = self.max_prompt_tokens
+        if self.max_completion_tokens is not None:
+            data["max_completion_tokens"] = self.max_completion_tokens
         return data
 
+    def render(self) -> str:
+        return " ".join(f"{k}={v}" for k, v in self.asdict().items()) or "no limits"
+
+    def __repr__(self) -> str:
+        return f"RunSettings({self.render()})"
+
+
+class Assistant:
+    """An assistant as shown and edited by the bot.
+
+    When created from the API output, the SDK object is kept and `tools` and
+    `tool_resources` are converted to dicts on first access only.
+    """
+
+    __slots__ = (
+        "id", "created_at", "name", "description", "model", "instructions", "metadata",
+        "_tools", "_tool_resources", "_api_output",
+    )
+    # fields sent back on update, in addition to the assistant id
+    UPDATE_FIELDS = ("name", "description", "model", "instructions", "metadata", "tools", "tool_resources")
+
+    def __init__(
+        self,
+        id: str,
+        created_at: int | None = None,
+        name: str | None = None,
+        description: str | None = None,
+        model: str | None = None,
+        instructions: str | None = None,
+        metadata: dict[str, str] | None = None,
+        tools: list[dict[str, Any]] | None = None,
+        tool_resources: dict[str, dict[str, list[str|None]]|None] | None = None,
+    ):
+        self.id = id
+        self.created_at = created_at
+        self.name = name
+        self.description = description
+        self.model = model
+        self.instructions = instructions
+        self.metadata = metadata
+        self._tools = tools
+        self._tool_resources = tool_resources
+        self._api_output = None
+
+    @property
+    def tools(self) -> list[dict[str, Any]] | None:
+        if self._tools is None and self._api_output is not None:
+            self._tools = [tool.model_dump() for tool in self._api_output.tools]
+        return self._tools
+
+    @tools.setter
+    def tools(self, tools: list[dict[str, Any]] | None) -> None:
+        self._tools = tools
 
-@dataclass
-class Assistant(BaseModel):
-    id: str
-    created_at: int | None = None
-    name: str | None = None
-    description: str | None = None
-    model: str | None = None
-    instructions: str | None = None
-    tools: list[dict[str, Any]] | None = None
-    tool_resources: dict[str, dict[str, list[str|None]]|None] | None = None
+    @property
+    def tool_resources(self) -> dict[str, dict[str, list[str|None]]|None] | None:
+        if self._tool_resources is None and self._api_output is not None \
+                and self._api_output.tool_resources is not None:
+            self._tool_resources = self._api_output.tool_resources.model_dump()
+        return self._tool_resources
 
-    def input_to_api_update(self) -> dict[str, str]:
+    @tool_resources.setter
+    def tool_resources(self, tool_resources: dict[str, dict[str, list[str|None]]|None] | None) -> None:
+        self._tool_resources = tool_resources
+
+    @property
+    def run_settings(self) -> RunSettings:
+        return RunSettings.from_metadata(self.metadata)
+
+    @run_settings.setter
+    def run_settings(self, run_settings: RunSettings) -> None:
+        # other metadata keys are kept
+        metadata = {k: v for k, v in (self.metadata or {}).items() if k not in RunSettings.METADATA_KEYS.values()}
+        self.metadata = {**metadata, **run_settings.to_metadata()}
+
+    @property
+    def answer_cache(self) -> bool:
+        """Whether similar questions are answered from the answer cache"""
+        return (self.metadata or {}).get("answer_cache") == "true"
+
+    @answer_cache.setter
+    def answer_cache(self, enabled: bool) -> None:
+        self.metadata = {**(self.metadata or {}), "answer_cache": "true" if enabled else "false"}
+
+    @property
+    def image_detail(self) -> str:
+        """Detail of the images sent by the users: auto (chosen by their size), low or high"""
+        detail = (self.metadata or {}).get("image_detail")
+        return detail if detail in ("low", "high") else "auto"
+
+    @image_detail.setter
+    def image_detail(self, detail: str) -> None:
+        self.metadata = {**(self.metadata or {}), "image_detail": detail}
+
+    def input_to_api_update(self) -> dict[str, Any]:
         """Convert the Assistant object to dict for input to API update"""
-        tmp = asdict(self, dict_factory=lambda x: {k: v for (k, v) in x if v is not None})
         # id is required with the key "assistant_id" for update
-        tmp["assistant_id"] = tmp.pop("id")
-        # created_at is not needed for update
-        remove_keys = ["created_at"]
-        for key in remove_keys:
-            if key in tmp:
-                del tmp[key]
-        return tmp
+        data = {"assistant_id": self.id}
+        for key in self.UPDATE_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = value
+        return data
 
     def render(self) -> str:
         """Render the Assistant object to string to display in discord"""
         return f"[{self.id}] {self.name} - {self.description}"
 
+    def __repr__(self) -> str:
+        return f"Assistant(id={self.id!r}, name={self.name!r}, model={self.model!r})"
+
     @classmethod
-    def from_api_output(cls, api_output: OpenAIAssistant) -> None:
-        """Create an instance from the OpenAIAssistant object
-        - Convert the OpenAIAssistant object to dict
-        - Remove the key "object" from the dict
-        """
-        data = api_output.model_dump(exclude={
-            "object",
-            "top_p",
-            "tempreture", 
-            "metadata",
-            "response_format",
-        })
-        
-        # Convert the 'tools' to a list of dict
-        if 'tools' in data:
-            data['tools'] = json.loads(json.dumps(data['tools']))
-
-        return cls.model_validate(data)
+    def from_api_output(cls, api_output: OpenAIAssistant) -> Assistant:
+        """Create an instance wrapping the OpenAIAssistant object"""
+        assistant = cls(
+            id=api_output.id,
+            created_at=api_output.created_at,
+            name=api_output.name,
+            description=api_output.description,
+            model=api_output.model,
+            instructions=api_output.instructions,
+            metadata=dict(api_output.metadata) if api_output.metadata else None,
+        )
+        assistant._api_output = api_output
+        return assistant
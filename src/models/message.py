@@ -1,192 +1,258 @@
 from __future__ import annotations
 
 import logging
-from dataclasses import asdict, dataclass
-from typing import Any, List, Optional, Dict, TypedDict, Literal
-
-from openai.types.beta.threads import (
-    Message as OpenAIThreadMessage,
-)
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Literal, Optional, TypedDict
 
 from discord import (
     Embed, File, AllowedMentions
 )
 
-from src.openai_api.files import get_image_file
+from src.media import annotation_file_name, prepare_outgoing_file
+from src.openai_api.files import get_file_content
+from src.tracing import span
 
-from io import BytesIO
 import re
 
-# from openai.types.beta.threads.text_content_block_param import TextContentBlockParam
-# from openai.types.beta.threads.image_url_content_block_param import ImageURLContentBlockParam
-# from openai.types.beta.threads.image_file_content_block_param import ImageFileContentBlockParam
+if TYPE_CHECKING:
+    from openai.types.beta.threads import (
+        Message as OpenAIThreadMessage,
+    )
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+
 class DiscordMessage:
-    content: Optional[str] = None
-    tts: Optional[bool] = None
-    embed: Optional[Embed] = None
-    embeds: Optional[List[Embed]] = None
-    file: Optional[File] = None
-    files: Optional[List[File]] = None
-    nonce: Optional[int] = None
-    delete_after: Optional[float] = None
-    allowed_mentions: Optional[AllowedMentions] = None
-
-    def asdict(self) -> dict[str, str]:
-        """Convert the MessageCreate object to dict"""
-        return asdict(self, dict_factory=lambda x: {k: v for (k, v) in x if v is not None})
-
-@dataclass
+    """Keyword arguments for discord's `send`, None values are left out"""
+
+    __slots__ = (
+        "content", "tts", "embed", "embeds", "file", "files", "nonce", "delete_after", "allowed_mentions",
+    )
+
+    def __init__(
+        self,
+        content: Optional[str] = None,
+        tts: Optional[bool] = None,
+        embed: Optional[Embed] = None,
+        embeds: Optional[List[Embed]] = None,
+        file: Optional[File] = None,
+        files: Optional[List[File]] = None,
+        nonce: Optional[int] = None,
+        delete_after: Optional[float] = None,
+        allowed_mentions: Optional[AllowedMentions] = None,
+    ):
+        self.content = content
+        self.tts = tts
+        self.embed = embed
+        self.embeds = embeds
+        self.file = file
+        self.files = files
+        self.nonce = nonce
+        self.delete_after = delete_after
+        self.allowed_mentions = allowed_mentions
+
+    def asdict(self) -> dict[str, Any]:
+        """Convert the DiscordMessage object to dict"""
+        return {k: v for k in self.__slots__ if (v := getattr(self, k)) is not None}
+
+    def __repr__(self) -> str:
+        return f"DiscordMessage({self.asdict()!r})"
+
+
 class MessageCreate:
-    thread_id: str
-    content: str | List[dict[str, ContentText|str] | dict[str, ContentImageFile|str]]
-    role: str = "user"
-    attachments: list[dict[str, str|list[dict[str, str]]]] | None = None
-    metadata: dict[str, str] | None = None
+    __slots__ = ("thread_id", "content", "role", "attachments", "metadata")
+
+    def __init__(
+        self,
+        thread_id: str,
+        content: str | List[dict[str, Any]],
+        role: str = "user",
+        attachments: list[dict[str, str|list[dict[str, str]]]] | None = None,
+        metadata: dict[str, str] | None = None,
+    ):
+        self.thread_id = thread_id
+        self.content = content
+        self.role = role
+        self.attachments = attachments
+        self.metadata = metadata
 
     @classmethod
     def from_discord_message(
-        self, thread_id: str, author_name: str, message: str, image_ids: list[str], attachments: list[dict[str, str|list[dict[str, str]]]] | None = None
+        cls, thread_id: str, author_name: str, message: str, image_ids: list[str], attachments: list[dict[str, str|list[dict[str, str]]]] | None = None,
+        image_details: list[str] | None = None,
     ) -> MessageCreate:
-        """Create an instance from the discord message"""
-        message = f"{author_name}: {message}"
+        """Create an instance from the discord message, `image_details` is the detail of each image"""
         content = [
             {
                 "image_file" : 
                     {
                         "file_id" : image_id,
-                        "detail" : "auto"
+                        "detail" : image_details[i] if image_details else "auto"
                     },
                 "type" : "image_file"
-            } for image_id in image_ids
+            } for i, image_id in enumerate(image_ids)
         ] if image_ids else []
         content.append({
-            "text" : message,
+            "text" : f"{author_name}: {message}",
             "type" : "text"
         })
-        return self(thread_id=thread_id, content=content, attachments=attachments)
+        return cls(thread_id=thread_id, content=content, attachments=attachments)
 
-    def input_to_api_create(self) -> dict[str, str]:
-        """Convert the MessageCreate object to dict for input to API create"""
-        dict = asdict(self, dict_factory=lambda x: {k: v for (k, v) in x if v is not None})
-        print("[Deb]->MessageCreate: ", dict)
-        return asdict(self, dict_factory=lambda x: {k: v for (k, v) in x if v is not None})
+    def input_to_api_create(self) -> dict[str, Any]:
+        """Convert the MessageCreate object to dict for input to API create.
+        The content and attachments are passed by reference, not copied.
+        """
+        data = {"thread_id": self.thread_id, "content": self.content, "role": self.role}
+        if self.attachments is not None:
+            data["attachments"] = self.attachments
+        if self.metadata is not None:
+            data["metadata"] = self.metadata
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"MessageCreate thread_id={self.thread_id} n_content={len(self.content)} "
+                         f"n_attachments={len(self.attachments or [])}")
+        return data
 
 
-@dataclass
 class Message:
-    id: str | None = None
-    created_at: int | None = None
-    thread_id: str | None = None
-    role: str | None = None
-    content: list[ContentImageFile | ContentText] | None = None
-    assistant_id: str | None = None
-    run_id: str | None = None
-    file_ids: list[str] | None = None
-    attachments: list[dict[str, str|list[dict[str, str]]]] | None = None
+    """A thread message.
+
+    When created from the API output, the SDK object is kept and the content
+    is converted on first access only.
+    """
+
+    __slots__ = (
+        "id", "created_at", "thread_id", "role", "assistant_id", "run_id", "attachments",
+        "_content", "_api_output",
+    )
+
+    def __init__(
+        self,
+        id: str | None = None,
+        created_at: int | None = None,
+        thread_id: str | None = None,
+        role: str | None = None,
+        content: list[ContentImageFile | ContentText] | None = None,
+        assistant_id: str | None = None,
+        run_id: str | None = None,
+        attachments: list[Any] | None = None,
+    ):
+        self.id = id
+        self.created_at = created_at
+        self.thread_id = thread_id
+        self.role = role
+        self.assistant_id = assistant_id
+        self.run_id = run_id
+        self.attachments = attachments
+        self._content = content
+        self._api_output = None
 
     @classmethod
-    def from_api_output(cls, api_output: OpenAIThreadMessage) -> None:
-        """Create an instance from the OpenAIThreadMessage object
-        - Convert the OpenAIThreadMessage object to dict
-        - Remove the key "object" from the dict
-        """
-        dct = api_output.model_dump(exclude=[
-            "object", 
-            "completed_at", 
-            "incomplete_at", 
-            "incomplete_details", 
-            "status",
-            "metadata",
-        ])
-        print("[Deb]->Message: ", dct)
-        contents_dct = dct.pop("content")
-        contents_converted = []
-        for content_dct in contents_dct:
-            if content_dct["type"] == "text":
-                contents_converted.append(
-                    ContentText.from_api_output(content_dct["text"])
-                )
-            elif content_dct["type"] == "image_file":
-                contents_converted.append(
-                    ContentImageFile.from_api_output(content_dct["image_file"])
-                )
-            else:
-                logger.warning(f"Unknown content type: {content_dct['type']}")
-        print("[Deb]->contents_converted: ", contents_converted)
-
-        return cls(content=contents_converted, **dct)
+    def from_api_output(cls, api_output: OpenAIThreadMessage) -> Message:
+        """Create an instance wrapping the OpenAIThreadMessage object"""
+        message = cls(
+            id=api_output.id,
+            created_at=api_output.created_at,
+            thread_id=api_output.thread_id,
+            role=api_output.role,
+            assistant_id=api_output.assistant_id,
+            run_id=api_output.run_id,
+            attachments=api_output.attachments,
+        )
+        message._api_output = api_output
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Message id={message.id} thread_id={message.thread_id} role={message.role} "
+                         f"content_types={[c.type for c in api_output.content]}")
+        return message
+
+    @property
+    def content(self) -> list[ContentImageFile | ContentText]:
+        if self._content is None:
+            self._content = []
+            if self._api_output is not None:
+                for block in self._api_output.content:
+                    factory = CONTENT_TYPES.get(block.type)
+                    if factory is None:
+                        logger.warning(f"Unknown content type: {block.type}")
+                        continue
+                    self._content.append(factory(block))
+        return self._content
+
+    @content.setter
+    def content(self, content: list[ContentImageFile | ContentText]) -> None:
+        self._content = content
+
+    @property
+    def text(self) -> str:
+        """The text content of the message, without the images"""
+        return "\n".join(c.value for c in self.content if isinstance(c, ContentText) and c.value)
 
     async def render(self) -> list[DiscordMessage]:
         """
         Render the Message object to the list of DiscordMessage object
         """
-        # the list of DiscordMessage object to return
-        rendered = []
+        with span("message.render", message_id=self.id) as render_span:
+            # the list of DiscordMessage object to return
+            rendered = []
+
+            # Render the content based on the type
+            for content in self.content:
+                # Text content
+                if isinstance(content, ContentText):
+                    rendered += await content.render()
+                # Image content
+                elif isinstance(content, ContentImageFile):
+                    if rendered:
+                        message = await content.render()
+                        rendered[-1].files = (rendered[-1].files or []) + message.files
+                    else:
+                        rendered.append(await content.render())
+            render_span.set_attribute("n_rendered", len(rendered))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Rendered message id={self.id} into {len(rendered)} discord messages")
+            return rendered
+
+
+DISPLAY_FORMULA_PATTERN = re.compile(r'\\\[([\w\s\^_.,=+\-*/{}\[\]()<>!&#:;\|\'\\]+?)\\\]', flags=re.DOTALL)
+INLINE_FORMULA_PATTERN = re.compile(r'\\\(([\w\s\^_.,=+\-*/{}\[\]()<>!&#:;\|\'\\]+?)\\\)', flags=re.DOTALL)
+
+
+def _formula_body(match: re.Match) -> str:
+    return match.group(1).replace('\n', '').replace('\t', '').replace('\\\\', '\\\\\\\\')
 
-        # Render the content based on the type
-        for content in self.content:
-            # Text content
-            if type(content) == ContentText:
-                rendered += await content.render()
-            # Image content
-            elif type(content) == ContentImageFile:
-                if rendered:
-                    message = await content.render()
-                    rendered[-1].files += message.files
-                else:
-                    rendered.append(await content.render())
-        print("[Deb]->rendered message: ", str(rendered))
-        return rendered
 
-@dataclass
 class ContentText:
-    value: str | None = None
-    annotations: list[AnnotationFilePath] | None = None
+    __slots__ = ("value", "annotations")
+
+    def __init__(self, value: str | None = None, annotations: list[AnnotationFilePath] | None = None):
+        self.value = value
+        self.annotations = annotations
 
     @classmethod
-    def from_api_output(cls, api_output: dict[str, Any]) -> ContentText:
-        annotations_dct = api_output.pop("annotations")
+    def from_api_output(cls, api_output: Any) -> ContentText:
+        """Create an instance from a TextContentBlock of the SDK"""
+        text = api_output.text
         annotations = None
-        if annotations_dct is not None:
+        if text.annotations is not None:
             annotations = []
-            for annotation in annotations_dct:
-                if annotation["type"] == "file_path":
-                    annotations.append(
-                        AnnotationFilePath.from_api_output(annotation)
-                    )
-                    print("[Deb]->annotations: ", annotations)
-                else:
+            for annotation in text.annotations:
+                factory = ANNOTATION_TYPES.get(annotation.type)
+                if factory is None:
                     # TODO: handle another annotation type
-                    logger.warning(f"Unknown annotation type: {annotation['type']}")
-        return cls(value=api_output["value"], annotations=annotations)
+                    logger.warning(f"Unknown annotation type: {annotation.type}")
+                    continue
+                annotations.append(factory(annotation))
+        return cls(value=text.value, annotations=annotations)
 
     async def render(self) -> list[DiscordMessage]:
         """Render the ContentText object to list of DiscordMessage Object"""
         # TODO: fix render annotations
         rendered = []
-        
-        # Get the text        
-        processing_text = self.value
-        
-        # Replace display formulas
-        display_pattern = r'\\\[([\w\s\^_.,=+\-*/{}\[\]()<>!&#:;\|\'\\]+?)\\\]'
-        processing_text = re.sub(
-            display_pattern, 
-            lambda match: 
-                '$$' + match.group(1).replace('\n', '').replace('\t', '').replace('\\\\', '\\\\\\\\') 
-                + '$$', processing_text, flags=re.DOTALL
+
+        # Replace display and inline formulas
+        processing_text = DISPLAY_FORMULA_PATTERN.sub(
+            lambda match: '$$' + _formula_body(match) + '$$', self.value
         )
-        
-        # Replace inline formulas
-        inline_pattern = r'\\\(([\w\s\^_.,=+\-*/{}\[\]()<>!&#:;\|\'\\]+?)\\\)'
-        processing_text = re.sub(
-            inline_pattern, 
-            lambda match: '$' + match.group(1).replace('\n', '').replace('\t', '').replace('\\\\', '\\\\\\\\') 
-            + '$', processing_text, flags=re.DOTALL
+        processing_text = INLINE_FORMULA_PATTERN.sub(
+            lambda match: '$' + _formula_body(match) + '$', processing_text
         )
 
         # Create the discord message fpr the processing text
@@ -201,46 +267,63 @@ class ContentText:
                 message = await annotation.render()
                 rendered.append(message)
 
-        print(f'[Deb]->len(text.rendered): {len(rendered)}')
-
         return rendered
 
 
-@dataclass
 class AnnotationFilePath:
-    type: str | None = None
-    text: str | None = None
-    start_index: int | None = None
-    end_index: int | None = None
-    file_path: dict[str, str] | None = None
+    __slots__ = ("type", "text", "start_index", "end_index", "file_id")
+
+    def __init__(
+        self,
+        type: str | None = None,
+        text: str | None = None,
+        start_index: int | None = None,
+        end_index: int | None = None,
+        file_id: str | None = None,
+    ):
+        self.type = type
+        self.text = text
+        self.start_index = start_index
+        self.end_index = end_index
+        self.file_id = file_id
 
     @classmethod
-    def from_api_output(cls, api_output: dict[str, Any]) -> AnnotationFilePath:
-        return cls(**api_output)
+    def from_api_output(cls, api_output: Any) -> AnnotationFilePath:
+        """Create an instance from a FilePathAnnotation of the SDK"""
+        return cls(
+            type=api_output.type,
+            text=api_output.text,
+            start_index=api_output.start_index,
+            end_index=api_output.end_index,
+            file_id=api_output.file_path.file_id,
+        )
 
     async def render(self) -> DiscordMessage:
         """Render the ContentAnnotation object to string to display in discord"""
-        image_file = await get_image_file(self.file_path['file_id'])
+        data = await get_file_content(self.file_id)
         message = DiscordMessage(
-            content=f"",
-            files=[File(fp=BytesIO(image_file), filename="output_image.png")],
+            content="",
+            files=[await prepare_outgoing_file(data, annotation_file_name(self.text, self.file_id))],
         )
         return message
 
-@dataclass
+
 class ContentImageFile:
-    file_id: str | None = None
-    detail: str | None = None
+    __slots__ = ("file_id", "detail")
+
+    def __init__(self, file_id: str | None = None, detail: str | None = None):
+        self.file_id = file_id
+        self.detail = detail
 
     @classmethod
-    def from_api_output(cls, api_output: dict[str, Any]) -> ContentImageFile:
-        return cls(**api_output)
+    def from_api_output(cls, api_output: Any) -> ContentImageFile:
+        """Create an instance from an ImageFileContentBlock of the SDK"""
+        return cls(file_id=api_output.image_file.file_id, detail=api_output.image_file.detail)
 
     async def render(self) -> DiscordMessage:
         """Render the ContentImageFile object to DiscordMessage object"""
-        image_bytes = await get_image_file(self.file_id)
-        pseudo_file = BytesIO(image_bytes)
-        discord_file = File(fp=pseudo_file, filename="output_image.png")
+        image_bytes = await get_file_content(self.file_id)
+        discord_file = await prepare_outgoing_file(image_bytes, f"image_{self.file_id}")
         rendered = DiscordMessage(
             content="",
             files=[discord_file],
@@ -248,6 +331,16 @@ class ContentImageFile:
         return rendered
 
 
+# Conversion of the SDK content blocks and annotations, by their `type`
+CONTENT_TYPES: dict[str, Callable[[Any], ContentText | ContentImageFile]] = {
+    "text": ContentText.from_api_output,
+    "image_file": ContentImageFile.from_api_output,
+}
+ANNOTATION_TYPES: dict[str, Callable[[Any], AnnotationFilePath]] = {
+    "file_path": AnnotationFilePath.from_api_output,
+}
+
+
 class ParameterSchema(TypedDict):
     type: str
     description: str
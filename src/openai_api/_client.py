@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING
+
+from src.metrics import OPENAI_ERRORS, OPENAI_REQUESTS
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+_client: AsyncOpenAI | None = None
+
+
+async def _record_request(request: httpx.Request) -> None:
+    OPENAI_REQUESTS.labels(method=request.method).inc()
+
+
+async def _record_response(response: httpx.Response) -> None:
+    if response.status_code >= 400:
+        OPENAI_ERRORS.labels(status=response.status_code).inc()
+
+
+def get_client() -> AsyncOpenAI:
+    """Return the client shared by all openai_api modules, so that connections
+    are pooled and every request is counted.
+
+    The openai package is slow to import, so both the import and the client
+    are deferred until the first API call.
+    """
+    global _client
+    if _client is None:
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        _client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(
+                event_hooks={"request": [_record_request], "response": [_record_response]}
+            )
+        )
+        logger.info("Created the OpenAI client")
+    return _client
@@ -2,25 +2,27 @@ from __future__ import annotations
 
 import logging
 
-from openai import AsyncOpenAI
-
-from src.models.assistant import Assistant, AssistantCreate
+from src.answer_cache import answer_cache
+from src.constants import ASSISTANT_METADATA_TTL_SECONDS
+from src.metrics import CACHE_REQUESTS
+from src.models.assistant import Assistant, AssistantCreate, RunSettings
+from src.openai_api._client import get_client
+from src.store import store
 
 logger = logging.getLogger(__name__)
-client = AsyncOpenAI()
 
 
 async def create_assistant(cfg: AssistantCreate) -> Assistant:
-    response = await client.beta.assistants.create(**cfg.input_to_api_create())
+    response = await get_client().beta.assistants.create(**cfg.input_to_api_create())
     return Assistant.from_api_output(response)
 
 
 async def list_assistants(limit: int = "20", order: str = "desc",
         after: str = '') -> list[Assistant]:
     if after == '':
-        response = await client.beta.assistants.list(limit=limit, order=order)
+        response = await get_client().beta.assistants.list(limit=limit, order=order)
     else:
-        response = await client.beta.assistants.list(limit=limit, order=order,
+        response = await get_client().beta.assistants.list(limit=limit, order=order,
                 after=after)
     assistants = []
     for d in response.data:
@@ -30,18 +32,54 @@ async def list_assistants(limit: int = "20", order: str = "desc",
 
 async def get_assistant(id: str) -> Assistant:
     """Get an assistant. If the assistant is not found, raise openai.NotFoundError."""
-    response = await client.beta.assistants.retrieve(assistant_id=id)
+    response = await get_client().beta.assistants.retrieve(assistant_id=id)
     return Assistant.from_api_output(response)
 
 
 async def update_assistant(cfg: Assistant) -> Assistant:
-    response = await client.beta.assistants.update(**cfg.input_to_api_update())
+    response = await get_client().beta.assistants.update(**cfg.input_to_api_update())
+    await store.delete(f"assistant_metadata:{cfg.id}")
+    # the answers cached by every process were given by the previous version of the assistant
+    await store.incr(f"answer_cache_generation:{cfg.id}")
+    answer_cache.invalidate(cfg.id)
     return Assistant.from_api_output(response)
 
 
+async def get_assistant_metadata(assistant_id: str) -> dict[str, str]:
+    """Get the metadata of an assistant, cached in the shared store"""
+    key = f"assistant_metadata:{assistant_id}"
+    cached = await store.get(key)
+    if cached is not None:
+        CACHE_REQUESTS.labels(cache="assistant_metadata", result="hit").inc()
+        return cached
+    CACHE_REQUESTS.labels(cache="assistant_metadata", result="miss").inc()
+
+    metadata = (await get_assistant(assistant_id)).metadata or {}
+    await store.set(key, metadata, ttl=ASSISTANT_METADATA_TTL_SECONDS)
+    return metadata
+
+
+async def get_run_settings(assistant_id: str) -> RunSettings:
+    return RunSettings.from_metadata(await get_assistant_metadata(assistant_id))
+
+
+async def get_answer_cache_generation(assistant_id: str) -> int | None:
+    """The generation of the answers cached for the assistant, None if the cache is disabled"""
+    if not Assistant(id=assistant_id, metadata=await get_assistant_metadata(assistant_id)).answer_cache:
+        return None
+    return await store.get(f"answer_cache_generation:{assistant_id}") or 0
+
+
+async def get_image_detail(assistant_id: str) -> str:
+    """The detail of the images sent to the assistant: auto, low or high"""
+    return Assistant(id=assistant_id, metadata=await get_assistant_metadata(assistant_id)).image_detail
+
+
 async def delete_assistant(id: str) -> None:
     """Delete an assistant. If the assistant is not found, raise openai.NotFoundError."""
-    response = await client.beta.assistants.delete(assistant_id=id)
+    response = await get_client().beta.assistants.delete(assistant_id=id)
+    await store.delete(f"assistant_metadata:{id}")
+    answer_cache.invalidate(id)
     if response.deleted:
         logger.info(f"Deleted assistant {response.id}")
         return
@@ -1,39 +1,105 @@
-from openai import AsyncOpenAI
-from openai._types import FileTypes
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+from src.openai_api._client import get_client
 from src.openai_api.assistants import get_assistant
+from src.retry import with_retries
+from src.tracing import span
+
+if TYPE_CHECKING:
+    from openai._types import FileTypes
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPLOADS = 5
+# the status of a file batch is polled with an exponential backoff
+BATCH_POLL_INITIAL_DELAY = 0.5
+BATCH_POLL_MAX_DELAY = 5.0
+BATCH_TIMEOUT = 1800
+
+# called with the phase ("uploading" or "indexing"), the number of files done and the total
+ProgressCallback = Callable[[str, int, int], Awaitable[None]]
 
 
 async def upload_file(file:FileTypes, purpose: str = "assistants") -> str:
-    client = AsyncOpenAI()
-    openai_file = await client.files.create(
-        file=file,
-        purpose=purpose,
-    )
+    with span("openai.upload_file", purpose=purpose) as upload_span:
+        openai_file = await get_client().files.create(
+            file=file,
+            purpose=purpose,
+        )
+        upload_span.set_attribute("file_id", openai_file.id)
     return openai_file.id
 
-async def create_vector_store(name: str, file_ids:list[str]|None=None) -> str:
-    client = AsyncOpenAI()
-    if file_ids is None:
-        vector_store = await client.beta.vector_stores.create(
-            name=name,
-        )
-    else:
-        vector_store = await client.beta.vector_stores.create(
-            name=name,
-            file_ids=file_ids,
+
+async def upload_files(
+    files: list[FileTypes], purpose: str = "assistants", on_progress: ProgressCallback | None = None
+) -> list[str]:
+    """Upload the files concurrently, return their ids in the same order"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    done = 0
+
+    async def upload(file: FileTypes) -> str:
+        nonlocal done
+        async with semaphore:
+            file_id = await upload_file(file, purpose=purpose)
+        done += 1
+        if on_progress is not None:
+            await on_progress("uploading", done, len(files))
+        return file_id
+
+    with span("openai.upload_files", n_files=len(files)):
+        return list(await asyncio.gather(*(upload(file) for file in files)))
+
+
+async def add_files_to_vector_store(
+    vector_store_id: str, file_ids: list[str], on_progress: ProgressCallback | None = None
+) -> int:
+    """Add the files to the vector store in one batch and wait until they are indexed.
+    Return the number of files that failed.
+    """
+    with span("openai.vector_store.add_files", vector_store_id=vector_store_id, n_files=len(file_ids)) as batch_span:
+        batch = await get_client().beta.vector_stores.file_batches.create(
+            vector_store_id=vector_store_id, file_ids=file_ids
         )
-    return vector_store.id
+        deadline = time.monotonic() + BATCH_TIMEOUT
+        delay = BATCH_POLL_INITIAL_DELAY
+        while batch.status == "in_progress":
+            if on_progress is not None:
+                await on_progress("indexing", batch.file_counts.completed + batch.file_counts.failed, len(file_ids))
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Files of vector store {vector_store_id} still indexing after {BATCH_TIMEOUT}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+            batch = await get_client().beta.vector_stores.file_batches.retrieve(
+                batch_id=batch.id, vector_store_id=vector_store_id
+            )
+        batch_span.set_attribute("batch_status", batch.status)
+        failed = batch.file_counts.failed + batch.file_counts.cancelled
+        if failed:
+            logger.warning(f"{failed} of {len(file_ids)} files could not be added to vector store {vector_store_id}")
+        if on_progress is not None:
+            await on_progress("indexing", len(file_ids), len(file_ids))
+        return failed
 
-async def update_vector_store(vector_store_id: str, file:FileTypes) -> str:
-    client = AsyncOpenAI()
-    vector_store = await client.beta.vector_stores.files.upload(
-        vector_store_id=vector_store_id,
-        file=file,
+
+async def create_vector_store(
+    name: str, file_ids: list[str] | None = None, on_progress: ProgressCallback | None = None
+) -> str:
+    """Create a vector store and return its id once the files are indexed"""
+    vector_store = await get_client().beta.vector_stores.create(
+        name=name,
     )
+    if file_ids:
+        await add_files_to_vector_store(vector_store.id, file_ids, on_progress=on_progress)
     return vector_store.id
 
-async def get_image_file(file_id: str) -> bytes:
-    client = AsyncOpenAI()
-    image_data = await client.files.content(file_id=file_id)
-    image_data_bytes = image_data.read()
-    return image_data_bytes
\ No newline at end of file
+
+async def get_file_content(file_id: str) -> bytes:
+    """Download a file, e.g. an image or a CSV made by the code interpreter"""
+    with span("openai.file_content", file_id=file_id):
+        content = await with_retries("openai.file_content", lambda: get_client().files.content(file_id=file_id))
+        return content.read()
@@ -3,38 +3,47 @@ from src.openai_api.functions import (
     get_wikipedia_summary_function,
     get_wikipedia_page_content_function,
 )
+from src.tracing import span
 import json
 
 
 def get_function_tool_outputs(tool_calls):
     tool_outputs = []
     for tool in tool_calls:
-        function_dict = tool.function.dict()
-        argumants_dict = json.loads(function_dict["arguments"])
+        with span("tool.call", tool_name=tool.function.name, tool_call_id=tool.id):
+            function_dict = tool.function.dict()
+            argumants_dict = json.loads(function_dict["arguments"])
 
-        if tool.function.name == "get_wikipedia_summary":
-            query = argumants_dict["query"]
-            summary = get_wikipedia_summary_function(query)
+            if tool.function.name == "get_wikipedia_summary":
+                query = argumants_dict["query"]
+                summary = get_wikipedia_summary_function(query)
 
-            if summary:
-                tool_outputs.append(
-                    {
-                        "tool_call_id": tool.id,
-                        "output": summary,
-                    }
-                )
+                if summary:
+                    tool_outputs.append(
+                        {
+                            "tool_call_id": tool.id,
+                            "output": summary,
+                        }
+                    )
 
-        if tool.function.name == "get_wikipedia_page_content":
-            query = argumants_dict["query"]
-            content = get_wikipedia_page_content_function(query)
+            if tool.function.name == "get_wikipedia_page_content":
+                query = argumants_dict["query"]
+                content = get_wikipedia_page_content_function(query)
 
-            if content:
-                tool_outputs.append(
-                    {
-                        "tool_call_id": tool.id,
-                        "output": content,
-                    }
-                )
+                if content:
+                    tool_outputs.append(
+                        {
+                            "tool_call_id": tool.id,
+                            "output": content,
+                        }
+                    )
+
+    # every tool call needs an output for the run to continue, including unknown
+    # functions and searches without result
+    answered = {output["tool_call_id"] for output in tool_outputs}
+    for tool in tool_calls:
+        if tool.id not in answered:
+            tool_outputs.append({"tool_call_id": tool.id, "output": "No result"})
 
     return tool_outputs
 
@@ -1,9 +1,22 @@
-from mediawikiapi import MediaWikiAPI
+from __future__ import annotations
 
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from mediawikiapi import MediaWikiAPI
+
+
+def _mediawiki() -> MediaWikiAPI:
+    # mediawikiapi is only needed once a tool is called, so it is imported lazily
+    from mediawikiapi import MediaWikiAPI
 
-def get_wikipedia_summary_function(query: str) -> str | None:
     mw = MediaWikiAPI()
     mw.config.language = "ja"
+    return mw
+
+
+def get_wikipedia_summary_function(query: str) -> str | None:
+    mw = _mediawiki()
     search_result = mw.search(query)
 
     if search_result:
@@ -17,8 +30,7 @@ def get_wikipedia_summary_function(query: str) -> str | None:
 
 
 def get_wikipedia_page_content_function(query: str) -> str | None:
-    mw = MediaWikiAPI()
-    mw.config.language = "ja"
+    mw = _mediawiki()
     search_result = mw.search(query)
 
     if search_result:
@@ -0,0 +1,172 @@
+"""Registry of the runs in progress, to cancel the runs whose answer is no longer wanted.
+
+The active run of each OpenAI thread is kept in the shared store, so a run
+can be cancelled by any process: the gateway receives the Discord events,
+while the run may be polled by a worker. The poller then sees the run as
+cancelled and sends nothing.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Any
+
+from src.constants import (
+    RUN_IN_PROGRESS_TIMEOUT_SECONDS,
+    RUN_QUEUED_TIMEOUT_SECONDS,
+    RUN_TOOL_TIMEOUT_SECONDS,
+    RUN_TOTAL_TIMEOUT_SECONDS,
+)
+from src.metrics import RUN_TOKENS_SAVED, RUNS_CANCELLED
+from src.openai_api._client import get_client
+from src.run_journal import JournalEntry, get_run_journal
+from src.store import store
+
+if TYPE_CHECKING:
+    from openai.types.beta.threads import Run
+
+logger = logging.getLogger(__name__)
+
+# a run is forgotten after this long, even if the process polling it died
+ACTIVE_RUN_TTL_SECONDS = 3600
+TERMINAL_STATUSES = ("completed", "incomplete", "cancelled", "expired", "failed")
+
+
+def _key(thread_id: str) -> str:
+    return f"run_state:{thread_id}"
+
+
+async def register_run(
+    thread_id: str, run_id: str, assistant_id: str, metadata: dict[str, str] | None = None
+) -> None:
+    """Register the run as the active run of the thread. A run answering a Discord
+    message is also recorded in the run journal, to be resumed after a restart.
+    """
+    if metadata and "discord_message_id" in metadata:
+        await get_run_journal().record(JournalEntry.from_metadata(thread_id, run_id, assistant_id, metadata))
+    state = await store.get(_key(thread_id)) or {}
+    await store.set(
+        _key(thread_id),
+        {
+            "run_id": run_id,
+            "metadata": metadata or {},
+            "started_at": time.time(),
+            # tokens used by the previous run of the thread, to estimate the tokens saved by a cancel
+            "last_tokens": state.get("last_tokens", 0),
+        },
+        ttl=ACTIVE_RUN_TTL_SECONDS,
+    )
+
+
+async def unregister_run(thread_id: str, run_id: str, total_tokens: int | None = None) -> None:
+    state = await store.get(_key(thread_id)) or {}
+    if state.get("run_id") not in (None, run_id):
+        # a newer run of the thread is registered
+        return
+    await store.set(
+        _key(thread_id),
+        {"run_id": None, "last_tokens": total_tokens if total_tokens is not None else state.get("last_tokens", 0)},
+        ttl=ACTIVE_RUN_TTL_SECONDS,
+    )
+
+
+async def get_active_run(thread_id: str) -> dict[str, Any] | None:
+    """The run in progress in the thread: run_id, metadata, started_at and last_tokens"""
+    state = await store.get(_key(thread_id))
+    if state is None or state.get("run_id") is None:
+        return None
+    return state
+
+
+async def cancel_run(thread_id: str, run_id: str) -> Run | None:
+    """Cancel a run, return None if it already ended"""
+    from openai import BadRequestError, NotFoundError
+
+    try:
+        return await get_client().beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+    except (BadRequestError, NotFoundError) as e:
+        # the run finished in the meantime
+        logger.debug(f"Run {run_id} not cancelled: {e}")
+        return None
+
+
+async def cancel_active_run(
+    thread_id: str, reason: str, message_id: int | None = None, wait: bool = False, timeout: float = 10.0
+) -> bool:
+    """Cancel the run in progress in the thread, return True if one was cancelled.
+    With `message_id`, only the run answering this Discord message is cancelled.
+    With `wait`, return once the run has stopped, so that messages can be added to the thread.
+    """
+    active = await get_active_run(thread_id)
+    if active is None:
+        return False
+    if message_id is not None and active["metadata"].get("discord_message_id") != str(message_id):
+        return False
+
+    run_id = active["run_id"]
+    run = await cancel_run(thread_id, run_id)
+    if run is None:
+        return False
+    RUNS_CANCELLED.labels(reason=reason).inc()
+    RUN_TOKENS_SAVED.inc(active.get("last_tokens", 0))
+    logger.info(f"Cancelled run {run_id} of thread {thread_id} ({reason})")
+
+    deadline = time.monotonic() + timeout
+    while wait and run.status not in TERMINAL_STATUSES and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+        run = await get_client().beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    return True
+
+
+class RunTimeout(Exception):
+    """A run went over the deadline of one of its phases"""
+
+    def __init__(self, phase: str, deadline: float):
+        super().__init__(f"{phase} took longer than {deadline:g}s")
+        self.phase = phase
+        self.deadline = deadline
+
+
+class RunWatchdog:
+    """Deadlines of the phases of a run.
+
+    The status of the run is observed at each poll, and the time spent in
+    each status is measured from the first poll that saw it. The function
+    tools are timed by the caller with `tool_timeout`, and a run left in
+    requires_action, e.g. without tool outputs submitted, gets the same
+    deadline.
+    """
+
+    def __init__(
+        self,
+        queued: float = RUN_QUEUED_TIMEOUT_SECONDS,
+        in_progress: float = RUN_IN_PROGRESS_TIMEOUT_SECONDS,
+        tool: float = RUN_TOOL_TIMEOUT_SECONDS,
+        total: float = RUN_TOTAL_TIMEOUT_SECONDS,
+        started_at: float | None = None,
+    ):
+        self.deadlines = {"queued": queued, "in_progress": in_progress, "requires_action": tool, "total": total}
+        self.tool = tool
+        # a monotonic time, earlier than now for a run resumed after a restart
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self.status: str | None = None
+        self.status_since = self.started_at
+
+    @property
+    def tool_timeout(self) -> float | None:
+        """Seconds left to run the function tools, None for no deadline"""
+        timeouts = [self.tool] if self.tool else []
+        if self.deadlines["total"]:
+            timeouts.append(max(self.deadlines["total"] - (time.monotonic() - self.started_at), 0))
+        return min(timeouts) if timeouts else None
+
+    def check(self, status: str) -> None:
+        """Raise RunTimeout if the run went over a deadline"""
+        now = time.monotonic()
+        if status != self.status:
+            self.status, self.status_since = status, now
+        for phase, elapsed in ((status, now - self.status_since), ("total", now - self.started_at)):
+            deadline = self.deadlines.get(phase)
+            if deadline and elapsed > deadline:
+                raise RunTimeout(phase, deadline)
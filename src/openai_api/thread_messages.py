@@ -1,37 +1,91 @@
+from __future__ import annotations
+
 import asyncio
 import logging
-
-from openai import AsyncOpenAI
-from openai.types.beta.thread import Thread as OpenAIThread
+import time
+from typing import TYPE_CHECKING, AsyncIterator
 
 from src.models.api_response import ResponseData, ResponseStatus
+from src.metrics import ACTIVE_RUNS, RUN_LATENCY, RUN_POLLS, RUN_TIMEOUTS, RUN_TOKENS
+from src.models.assistant import RunSettings
 from src.models.message import Message, MessageCreate
+from src.openai_api._client import get_client
+from src.openai_api.runs import (
+    TERMINAL_STATUSES,
+    RunTimeout,
+    RunWatchdog,
+    cancel_run,
+    register_run,
+    unregister_run,
+)
+from src.retry import with_retries
+from src.tracing import set_attribute, span
+
+if TYPE_CHECKING:
+    from openai.types.beta.thread import Thread as OpenAIThread
 
 logger = logging.getLogger(__name__)
-client = AsyncOpenAI()
 
 from src.openai_api.function_tools import get_function_tool_outputs
 
 async def create_thread() -> OpenAIThread:
-    thread = await client.beta.threads.create()
+    thread = await get_client().beta.threads.create()
     return thread
 
 
 # TODO: only support 1 message to add. If we want to add multiple messages, we need change input to list
 async def add_user_message_to_thread(cfg: MessageCreate) -> Message:
-    response = await client.beta.threads.messages.create(**cfg.input_to_api_create())
-    return Message.from_api_output(response)
+    with span("openai.add_message", thread_id=cfg.thread_id):
+        response = await get_client().beta.threads.messages.create(**cfg.input_to_api_create())
+        return Message.from_api_output(response)
 
 
-async def generate_assistant_message_in_thread(thread_id: str, assistant_id: str) -> ResponseData:
+async def generate_assistant_message_in_thread(
+    thread_id: str,
+    assistant_id: str,
+    run_settings: RunSettings | None = None,
+    instructions: str | None = None,
+    metadata: dict[str, str] | None = None,
+    run_id: str | None = None,
+    run_age: float = 0.0,
+) -> ResponseData:
+    """Run the assistant on the thread and return its answer.
+    `instructions` replace the instructions of the assistant for this run only.
+    `metadata` is attached to the run, and to its entry in the registry of the active runs.
+    With `run_id`, wait for this run, created `run_age` seconds ago, instead of creating one.
+    """
+    run_settings = run_settings or RunSettings()
+    run_options = run_settings.input_to_api_create()
+    if instructions is not None:
+        run_options["instructions"] = instructions
+    if metadata:
+        run_options["metadata"] = metadata
+    run = None
+    failed = False
+    polls = 0
+    started_at = time.monotonic()
+    watchdog = RunWatchdog(started_at=started_at - run_age)
+    ACTIVE_RUNS.inc()
     try:
-        run = await client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
-        # TODO: check the run status periodically
-        while run.status != "completed":
+        if run_id is None:
+            with span("openai.run.create", thread_id=thread_id, assistant_id=assistant_id) as create_span:
+                run = await get_client().beta.threads.runs.create(
+                    thread_id=thread_id, assistant_id=assistant_id, **run_options
+                )
+                create_span.set_attribute("run_id", run.id)
+        else:
+            with span("openai.run.resume", thread_id=thread_id, assistant_id=assistant_id, run_id=run_id):
+                run = await with_retries(
+                    "openai.run.retrieve",
+                    lambda: get_client().beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id),
+                )
+        await register_run(thread_id, run.id, assistant_id, metadata)
+        # an incomplete run stopped at max_prompt_tokens or max_completion_tokens, its partial answer is sent
+        while run.status not in ("completed", "incomplete"):
             if run.status == "cancelled":  # ending states (not error)
                 logger.info(f"Run {run.status}")
                 return ResponseData(
-                    status=ResponseStatus.OK,
+                    status=ResponseStatus.CANCELLED,
                     message=None,
                     status_text=f"Run {run.status}",
                 )
@@ -41,57 +95,234 @@ async def generate_assistant_message_in_thread(thread_id: str, assistant_id: str
                     status=ResponseStatus.ERROR,
                     message=None,
                     status_text=f"Run {run.status}",
+                    error_code=run.last_error.code if run.last_error else None,
                 )
+            # after the ending states, so that a run stopped or failed just after a deadline is not a timeout
+            watchdog.check(run.status)
 
             await asyncio.sleep(1)
-            run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+            polls += 1
+            with span("openai.run.poll", thread_id=thread_id, assistant_id=assistant_id,
+                      run_id=run.id) as poll_span:
+                # a poll is idempotent: a transient failure does not fail the run, which goes on at OpenAI
+                run = await with_retries(
+                    "openai.run.retrieve",
+                    lambda: get_client().beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id),
+                )
+                poll_span.set_attribute("run_status", run.status)
 
             # Check if there are tool outputs to submit
-            if run.required_action and run.required_action.submit_tool_outputs:
-                tool_outputs = get_function_tool_outputs(
-                    run.required_action.submit_tool_outputs.tool_calls
-                )
-                if tool_outputs:
-                    run = await client.beta.threads.runs.submit_tool_outputs(
+            if run.status == "requires_action" and run.required_action and run.required_action.submit_tool_outputs:
+                # the tools block on HTTP requests, so they run in a thread of the default executor
+                tool_timeout = watchdog.tool_timeout
+                try:
+                    tool_outputs = await asyncio.wait_for(
+                        asyncio.to_thread(
+                            get_function_tool_outputs, run.required_action.submit_tool_outputs.tool_calls
+                        ),
+                        timeout=tool_timeout,
+                    )
+                except asyncio.TimeoutError:
+                    raise RunTimeout("tool", tool_timeout) from None
+                if not tool_outputs:
+                    # the run would wait for the outputs until it expires, so it is cancelled below
+                    raise RuntimeError("The function tools returned no output")
+                with span("openai.run.submit_tool_outputs", run_id=run.id):
+                    run = await get_client().beta.threads.runs.submit_tool_outputs(
                         thread_id=thread_id,
                         run_id=run.id,
                         tool_outputs=tool_outputs,
                     )
 
+        if run.status == "incomplete":
+            reason = run.incomplete_details.reason if run.incomplete_details else None
+            logger.info(f"Run {run.id} incomplete: {reason}")
+        if run.usage:
+            report_usage(run.id, run.usage.prompt_tokens, run.usage.completion_tokens, run_settings)
+
         # If the run is completed, retreive the last message the assistant sent
-        desc_thread_messages = await client.beta.threads.messages.list(thread_id)
+        with span("openai.messages.list", thread_id=thread_id):
+            desc_thread_messages = await with_retries(
+                "openai.messages.list", lambda: get_client().beta.threads.messages.list(thread_id)
+            )
         last_message = desc_thread_messages.data[0]
         last_message = Message.from_api_output(last_message)
 
+        usage = run.usage.model_dump() if run.usage else None
         if last_message.role == "assistant":
             return ResponseData(
                 status=ResponseStatus.OK,
                 message=last_message,
                 status_text=None,
+                usage=usage,
             )
         else:
             return ResponseData(
                 status=ResponseStatus.ERROR,
                 message=None,
                 status_text=f"No response from assistant",
+                usage=usage,
             )
 
+    except RunTimeout as e:
+        failed = True
+        logger.warning(f"Run {run.id} of thread {thread_id} cancelled: {e}")
+        RUN_TIMEOUTS.labels(phase=e.phase).inc()
+        set_attribute("run_timeout", e.phase)
+        await cancel_run(thread_id, run.id)
+        return ResponseData(
+            status=ResponseStatus.ERROR,
+            message=None,
+            status_text=f"The assistant did not answer in time ({e}), please try again",
+        )
     # TODO: need error handling?: https://platform.openai.com/docs/guides/error-codes/python-library-error-types
     except Exception as e:
+        failed = True
         logger.exception(e)
+        if run is not None and run.status not in TERMINAL_STATUSES:
+            # e.g. a function tool failed: the run would keep the thread locked until it expires
+            try:
+                await cancel_run(thread_id, run.id)
+            except Exception as cancel_error:
+                logger.warning(f"Failed to cancel run {run.id} of thread {thread_id}: {cancel_error}")
         return ResponseData(
             status=ResponseStatus.ERROR, 
             message=None, 
-            status_text=str(e)
+            status_text=str(e),
+            error_code="rate_limit_exceeded" if getattr(e, "status_code", None) == 429 else None,
+        )
+    finally:
+        if run is not None:
+            await unregister_run(thread_id, run.id, total_tokens=run.usage.total_tokens if run.usage else None)
+        ACTIVE_RUNS.dec()
+        status = "error" if failed or run is None else run.status
+        RUN_LATENCY.labels(status=status).observe(time.monotonic() - started_at)
+        RUN_POLLS.observe(polls)
+
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below, so that you can continue it from the summary alone. "
+    "Keep the names of the users, the facts, decisions and open questions, and anything you were asked to "
+    "remember. Answer with the summary only."
+)
+# the transcript sent for the summary keeps the most recent characters of the conversation
+MAX_TRANSCRIPT_CHARS = 200_000
+
+
+async def iter_thread_messages(thread_id: str, page_size: int = 100) -> AsyncIterator[Message]:
+    """The messages of a thread in chronological order, one page in memory at a time.
+    The next page is requested while the messages of the current one are processed.
+    """
+    with span("openai.messages.list", thread_id=thread_id):
+        page = await get_client().beta.threads.messages.list(thread_id, order="asc", limit=page_size)
+    next_page: asyncio.Task | None = None
+    try:
+        while True:
+            next_page = asyncio.create_task(page.get_next_page()) if page.has_next_page() else None
+            for message in page.data:
+                yield Message.from_api_output(message)
+            if next_page is None:
+                return
+            page = await next_page
+    finally:
+        # the consumer stopped early
+        if next_page is not None and not next_page.done():
+            next_page.cancel()
+
+
+async def _text_messages(thread_id: str, after: str | None = None) -> list[tuple[str, str, str]]:
+    """(id, role, text) of the messages of a thread in chronological order, images left out"""
+    messages = []
+    kwargs = {"after": after} if after is not None else {}
+    async for message in get_client().beta.threads.messages.list(thread_id, order="asc", limit=100, **kwargs):
+        text = Message.from_api_output(message).text
+        if text:
+            messages.append((message.id, message.role, text))
+    return messages
+
+
+async def compact_thread(thread_id: str, assistant_id: str) -> str | None:
+    """Summarize the conversation of a thread and create a new thread starting with the summary.
+    Return the id of the new thread, None if the summary failed.
+
+    The summary is written in a separate thread from a transcript of the conversation, so the
+    thread stays usable meanwhile. The messages added during the summary are copied to the new thread.
+    """
+    with span("openai.compact_thread", thread_id=thread_id, assistant_id=assistant_id) as compact_span:
+        messages = await _text_messages(thread_id)
+        if not messages:
+            return None
+        transcript = "\n\n".join(f"{role}: {text}" for _, role, text in messages)[-MAX_TRANSCRIPT_CHARS:]
+        summary_thread = await get_client().beta.threads.create(messages=[{"role": "user", "content": transcript}])
+        try:
+            response_data = await generate_assistant_message_in_thread(
+                thread_id=summary_thread.id, assistant_id=assistant_id, instructions=SUMMARY_INSTRUCTIONS
+            )
+        finally:
+            await get_client().beta.threads.delete(summary_thread.id)
+        if response_data.status is not ResponseStatus.OK or response_data.message is None \
+                or not response_data.message.text:
+            logger.warning(f"Failed to summarize thread {thread_id}: {response_data.status_text}")
+            return None
+
+        seed = [{"role": "user", "content": f"Summary of our conversation so far:\n\n{response_data.message.text}"}]
+        for _, role, text in await _text_messages(thread_id, after=messages[-1][0]):
+            seed.append({"role": role, "content": text})
+        thread = await get_client().beta.threads.create(messages=seed)
+        compact_span.set_attribute("n_messages", len(messages))
+        compact_span.set_attribute("new_thread_id", thread.id)
+        return thread.id
+
+
+def report_usage(run_id: str, prompt_tokens: int, completion_tokens: int, run_settings: RunSettings) -> None:
+    """Record the tokens used by a run, to tune the run settings"""
+    set_attribute("prompt_tokens", prompt_tokens)
+    set_attribute("completion_tokens", completion_tokens)
+    RUN_TOKENS.labels(kind="prompt").observe(prompt_tokens)
+    RUN_TOKENS.labels(kind="completion").observe(completion_tokens)
+    logger.info(
+        f"Run {run_id} used {prompt_tokens} prompt tokens and {completion_tokens} completion tokens"
+        f" ({run_settings.render()})"
+    )
+
+
+async def add_cached_answer(new_message: MessageCreate, answer: str) -> ResponseData:
+    """Add the user message and a cached answer to the thread, without running the assistant"""
+    with span("openai.add_cached_answer", thread_id=new_message.thread_id):
+        _ = await add_user_message_to_thread(new_message)
+        response = await get_client().beta.threads.messages.create(
+            thread_id=new_message.thread_id, role="assistant", content=answer
         )
+    return ResponseData(status=ResponseStatus.OK, message=Message.from_api_output(response), status_text=None)
 
 
 async def generate_response(
-    thread_id: str, assistant_id: str, new_message: MessageCreate
+    thread_id: str,
+    assistant_id: str,
+    new_message: MessageCreate,
+    run_settings: RunSettings | None = None,
+    metadata: dict[str, str] | None = None,
 ) -> ResponseData:
     assert thread_id == new_message.thread_id
-    _ = await add_user_message_to_thread(new_message)
-    response_data = await generate_assistant_message_in_thread(
-        thread_id=thread_id, assistant_id=assistant_id
-    )
+    with span("openai.generate_response", thread_id=thread_id, assistant_id=assistant_id):
+        _ = await add_user_message_to_thread(new_message)
+        response_data = await generate_assistant_message_in_thread(
+            thread_id=thread_id, assistant_id=assistant_id, run_settings=run_settings, metadata=metadata
+        )
     return response_data
+
+
+async def generate_response_in_new_thread(
+    assistant_id: str, author_name: str, prompt: str, run_settings: RunSettings | None = None
+) -> ResponseData:
+    """Answer a text message in a throwaway thread, deleted afterwards"""
+    thread = await create_thread()
+    try:
+        new_message = MessageCreate.from_discord_message(
+            thread_id=thread.id, author_name=author_name, message=prompt, image_ids=[]
+        )
+        return await generate_response(
+            thread_id=thread.id, assistant_id=assistant_id, new_message=new_message, run_settings=run_settings
+        )
+    finally:
+        await get_client().beta.threads.delete(thread.id)
@@ -0,0 +1,116 @@
+"""Retries of the calls to the OpenAI and Discord APIs failing transiently.
+
+A call that fails with a connection error, a timeout, a 429 or a 5xx is
+tried again after an exponential backoff with full jitter: the n-th retry
+waits a random delay between 0 and RETRY_INITIAL_DELAY_SECONDS * 2**n
+(capped at RETRY_MAX_DELAY_SECONDS), so the processes hit by the same
+outage do not retry all at once. The clients retry some errors themselves,
+briefly; this layer rides out longer outages. Only the calls that can be
+repeated safely are retried: polling a run, listing messages and
+downloading a file. Sending a message is not idempotent: a timeout or a 5xx
+can come back after Discord posted it, so a send is only retried when it
+surely did not reach Discord (is_unsent), i.e. rate limited or without a
+connection.
+
+Gateway events replayed after a reconnect are ignored with RecentIds, a
+bounded LRU of the ids of the messages already processed.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+import aiohttp
+
+from src.constants import RETRY_INITIAL_DELAY_SECONDS, RETRY_MAX_ATTEMPTS, RETRY_MAX_DELAY_SECONDS
+from src.metrics import RETRIES
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# request timeout, rate limited, and the server errors of the APIs and of Cloudflare
+TRANSIENT_STATUSES = frozenset({408, 429, 500, 502, 503, 504, 520, 522, 524})
+
+
+def is_transient(e: BaseException) -> bool:
+    """Whether the error may not happen again, e.g. during a short outage"""
+    if isinstance(e, (asyncio.TimeoutError, ConnectionError, aiohttp.ClientConnectionError)):
+        return True
+    # discord.HTTPException has a status, openai.APIStatusError a status_code
+    status = getattr(e, "status_code", None) or getattr(e, "status", None)
+    if isinstance(status, int):
+        return status in TRANSIENT_STATUSES
+    # imported late, as in the clients: the error came from the openai package if it is not loaded yet
+    from openai import APIConnectionError
+
+    return isinstance(e, APIConnectionError)
+
+
+def is_unsent(e: BaseException) -> bool:
+    """Whether the request failed before it was processed, so sending it again does not repeat it"""
+    if isinstance(e, (aiohttp.ClientConnectorError, ConnectionRefusedError)):
+        return True
+    status = getattr(e, "status_code", None) or getattr(e, "status", None)
+    return status == 429
+
+
+def backoff_delay(
+    attempt: int, initial: float = RETRY_INITIAL_DELAY_SECONDS, maximum: float = RETRY_MAX_DELAY_SECONDS
+) -> float:
+    """Delay before the retry after the attempt (from 1), with full jitter"""
+    return random.uniform(0, min(maximum, initial * 2 ** (attempt - 1)))
+
+
+async def with_retries(
+    operation: str,
+    call: Callable[[], Awaitable[T]],
+    attempts: int = RETRY_MAX_ATTEMPTS,
+    retry_if: Callable[[BaseException], bool] = is_transient,
+) -> T:
+    """Await call() until it succeeds, retrying the errors accepted by `retry_if` (the transient
+    errors by default) up to `attempts` times in all. The last error is raised.
+    """
+    attempt = 1
+    while True:
+        try:
+            result = await call()
+        except Exception as e:
+            if not retry_if(e):
+                raise
+            if attempt >= attempts:
+                RETRIES.labels(operation=operation, result="exhausted").inc()
+                raise
+            delay = backoff_delay(attempt)
+            RETRIES.labels(operation=operation, result="retried").inc()
+            logger.warning(f"{operation} failed ({e!r}), retrying in {delay:.1f}s ({attempt}/{attempts})")
+            await asyncio.sleep(delay)
+            attempt += 1
+        else:
+            if attempt > 1:
+                RETRIES.labels(operation=operation, result="recovered").inc()
+            return result
+
+
+class RecentIds:
+    """The most recent ids, the oldest forgotten first"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._ids: OrderedDict[Hashable, None] = OrderedDict()
+
+    def add(self, id: Hashable) -> bool:
+        """Remember the id, return False if it was already there"""
+        if id in self._ids:
+            self._ids.move_to_end(id)
+            return False
+        self._ids[id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._ids)
@@ -0,0 +1,153 @@
+"""Journal of the runs whose answer is not delivered yet.
+
+A run is recorded when it is created for a Discord message, and removed
+once its answer is sent, or it failed. If the process stops in between, the
+run goes on at OpenAI with nobody polling it: on the next start, the runs
+left in the journal are reattached and their answer is sent, or they are
+cancelled when they are too old.
+
+Runs are rows of a SQLite database shared by the processes of one host,
+like the job queue.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+from src.constants import RUN_JOURNAL_PATH
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class JournalEntry:
+    # the Discord message the run answers
+    message_id: int
+    guild_id: int
+    parent_id: int
+    discord_thread_id: int
+    thread_id: str
+    run_id: str
+    assistant_id: str
+    # wall-clock time the run was created
+    started_at: float
+
+    @classmethod
+    def from_metadata(cls, thread_id: str, run_id: str, assistant_id: str, metadata: dict[str, str]) -> JournalEntry:
+        return cls(
+            message_id=int(metadata["discord_message_id"]),
+            guild_id=int(metadata["guild_id"]),
+            parent_id=int(metadata["parent_id"]),
+            discord_thread_id=int(metadata["discord_thread_id"]),
+            thread_id=thread_id,
+            run_id=run_id,
+            assistant_id=assistant_id,
+            started_at=time.time(),
+        )
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.started_at
+
+
+class RunJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                message_id INTEGER PRIMARY KEY,
+                guild_id INTEGER NOT NULL,
+                parent_id INTEGER NOT NULL,
+                discord_thread_id INTEGER NOT NULL,
+                thread_id TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                assistant_id TEXT NOT NULL,
+                started_at REAL NOT NULL
+            )
+        """)
+        self._lock = threading.Lock()
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, parameters)
+
+    def _record(self, entry: JournalEntry) -> None:
+        # a retried message replaces the run of its previous attempt, a resumed run keeps its start time
+        self._execute(
+            "INSERT INTO runs (message_id, guild_id, parent_id, discord_thread_id, thread_id, run_id,"
+            " assistant_id, started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (message_id) DO UPDATE SET thread_id = excluded.thread_id, run_id = excluded.run_id,"
+            " assistant_id = excluded.assistant_id, started_at = excluded.started_at"
+            " WHERE run_id != excluded.run_id",
+            (entry.message_id, entry.guild_id, entry.parent_id, entry.discord_thread_id, entry.thread_id,
+             entry.run_id, entry.assistant_id, entry.started_at),
+        )
+
+    def _get(self, message_id: int) -> JournalEntry | None:
+        row = self._execute(
+            "SELECT message_id, guild_id, parent_id, discord_thread_id, thread_id, run_id, assistant_id, started_at"
+            " FROM runs WHERE message_id = ?",
+            (message_id,),
+        ).fetchone()
+        return JournalEntry(*row) if row is not None else None
+
+    def _unfinished(self) -> list[JournalEntry]:
+        rows = self._execute(
+            "SELECT message_id, guild_id, parent_id, discord_thread_id, thread_id, run_id, assistant_id, started_at"
+            " FROM runs ORDER BY started_at"
+        ).fetchall()
+        return [JournalEntry(*row) for row in rows]
+
+    def _finish(self, message_id: int) -> None:
+        self._execute("DELETE FROM runs WHERE message_id = ?", (message_id,))
+
+    async def record(self, entry: JournalEntry) -> None:
+        await asyncio.to_thread(self._record, entry)
+
+    async def get(self, message_id: int) -> JournalEntry | None:
+        """The unfinished run answering the message, if any"""
+        return await asyncio.to_thread(self._get, message_id)
+
+    async def unfinished(self) -> list[JournalEntry]:
+        """The runs whose answer was not delivered, oldest first"""
+        return await asyncio.to_thread(self._unfinished)
+
+    async def finish(self, message_id: int) -> None:
+        await asyncio.to_thread(self._finish, message_id)
+
+    @asynccontextmanager
+    async def answering(self, message_id: int) -> AsyncIterator[None]:
+        """Remove the run answering the message when the block ends, unless the block is
+        cancelled, e.g. when the bot shuts down: the run is then resumed on the next start.
+        """
+        try:
+            yield
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            await self.finish(message_id)
+            raise
+        else:
+            await self.finish(message_id)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+_run_journal: RunJournal | None = None
+
+
+def get_run_journal() -> RunJournal:
+    """Return the journal at RUN_JOURNAL_PATH, opened on first use"""
+    global _run_journal
+    if _run_journal is None:
+        _run_journal = RunJournal(RUN_JOURNAL_PATH)
+    return _run_journal
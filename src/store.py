@@ -0,0 +1,353 @@
+"""Key-value store for the state shared between bot processes.
+
+With a single process the in-memory store is enough. When several processes
+each own a range of shards, point them all at the same store: SQLite for
+processes on one host, or the HTTP store for processes on several hosts. The
+HTTP store talks to `python -m src.store`, a small stand-in for a networked
+store such as Redis, which keeps the values in memory or in SQLite.
+
+Values are anything JSON serializable. Keys expire after their ttl (seconds):
+they are no longer returned once expired, and deleted by purge_expired_keys,
+which the bot, the workers and the store server run in the background, so
+that the keys never read again (e.g. the token counters of past windows)
+do not pile up.
+
+    python -m src.store --port 8765 --sqlite store.db
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any
+from urllib.parse import quote
+
+from aiohttp import ClientSession, web
+
+from src.constants import STORE_URL
+
+logger = logging.getLogger(__name__)
+
+PURGE_INTERVAL = 300
+
+
+class Store:
+    async def get(self, key: str) -> Any | None:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        """Atomically add `amount` to an integer value and return the result.
+        The ttl is only applied when the key is created.
+        """
+        raise NotImplementedError
+
+    async def scan(self, prefix: str) -> list[str]:
+        """Keys starting with `prefix`"""
+        raise NotImplementedError
+
+    async def purge(self) -> int:
+        """Delete the expired keys, return their number"""
+        return 0
+
+    async def close(self) -> None:
+        pass
+
+
+def _expires_at(ttl: float | None) -> float | None:
+    return time.time() + ttl if ttl is not None else None
+
+
+class MemoryStore(Store):
+    def __init__(self):
+        self._data: dict[str, tuple[Any, float | None]] = {}
+
+    def _get(self, key: str) -> Any | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.time():
+            del self._data[key]
+            return None
+        return value
+
+    async def get(self, key: str) -> Any | None:
+        return self._get(key)
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        self._data[key] = (value, _expires_at(ttl))
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        value = self._get(key)
+        if value is None:
+            self._data[key] = (amount, _expires_at(ttl))
+            return amount
+        value += amount
+        self._data[key] = (value, self._data[key][1])
+        return value
+
+    async def scan(self, prefix: str) -> list[str]:
+        return [key for key in list(self._data) if key.startswith(prefix) and self._get(key) is not None]
+
+    async def purge(self) -> int:
+        now = time.time()
+        expired = [key for key, (_, expires_at) in self._data.items() if expires_at is not None and expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+
+class SQLiteStore(Store):
+    """Store in a SQLite database, shared by the processes of one host.
+    Queries run in a worker thread so that they do not block the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Any | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _set(self, key: str, value: Any, ttl: float | None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), _expires_at(ttl)),
+            )
+
+    def _delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def _incr(self, key: str, amount: int, ttl: float | None) -> int:
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock, so other processes cannot interleave
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT value, expires_at FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                    (key, now),
+                ).fetchone()
+                if row is None:
+                    value, expires_at = amount, _expires_at(ttl)
+                else:
+                    value, expires_at = json.loads(row[0]) + amount, row[1]
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), expires_at),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return value
+
+    def _scan(self, prefix: str) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key FROM kv WHERE substr(key, 1, ?) = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (len(prefix), prefix, time.time()),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def _purge(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+            )
+        return cursor.rowcount
+
+    async def get(self, key: str) -> Any | None:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self._delete, key)
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        return await asyncio.to_thread(self._incr, key, amount, ttl)
+
+    async def scan(self, prefix: str) -> list[str]:
+        return await asyncio.to_thread(self._scan, prefix)
+
+    async def purge(self) -> int:
+        return await asyncio.to_thread(self._purge)
+
+    async def close(self) -> None:
+        self._conn.close()
+
+
+class HttpStore(Store):
+    """Client of the store server started by `python -m src.store`"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self._session: ClientSession | None = None
+
+    @property
+    def session(self) -> ClientSession:
+        # created on first use, inside the running event loop
+        if self._session is None or self._session.closed:
+            self._session = ClientSession()
+        return self._session
+
+    def _url(self, key: str) -> str:
+        return f"{self.base_url}/kv/{quote(key, safe='')}"
+
+    async def get(self, key: str) -> Any | None:
+        async with self.session.get(self._url(key)) as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            return (await response.json())["value"]
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        async with self.session.put(self._url(key), json={"value": value, "ttl": ttl}) as response:
+            response.raise_for_status()
+
+    async def delete(self, key: str) -> None:
+        async with self.session.delete(self._url(key)) as response:
+            response.raise_for_status()
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        async with self.session.post(self._url(key) + "/incr", json={"amount": amount, "ttl": ttl}) as response:
+            response.raise_for_status()
+            return (await response.json())["value"]
+
+    async def scan(self, prefix: str) -> list[str]:
+        async with self.session.get(f"{self.base_url}/kv", params={"prefix": prefix}) as response:
+            response.raise_for_status()
+            return (await response.json())["keys"]
+
+    async def purge(self) -> int:
+        # the server purges its backend itself
+        return 0
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+def open_store(url: str) -> Store:
+    """Open the store for `url`: memory://, sqlite:///path/to/file.db or http://host:port"""
+    if url == "memory://":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    if url.startswith(("http://", "https://")):
+        return HttpStore(url)
+    raise ValueError(f"Unsupported store url: {url}")
+
+
+store = open_store(STORE_URL)
+
+
+def require_shared_store(run_mode: str) -> None:
+    """Exit if the gateway and the workers would each keep their own store.
+    The gateway would not see the runs and threads of the workers, so /stop would do nothing.
+    """
+    if run_mode in ("gateway", "worker") and STORE_URL == "memory://":
+        raise SystemExit(
+            f"RUN_MODE={run_mode} needs a STORE_URL shared by the gateway and the workers "
+            "(sqlite:///path/to/store.db or http://host:port), not memory://"
+        )
+
+
+async def purge_expired_keys(backend: Store = store, interval: float = PURGE_INTERVAL) -> None:
+    """Delete the expired keys of the store every `interval` seconds"""
+    while True:
+        try:
+            purged = await backend.purge()
+            if purged:
+                logger.info(f"Purged {purged} expired keys")
+        except Exception:
+            logger.exception("Failed to purge the expired keys")
+        await asyncio.sleep(interval)
+
+
+def make_store_app(backend: Store) -> web.Application:
+    """HTTP interface of a store, used by HttpStore"""
+
+    async def get(request: web.Request) -> web.Response:
+        value = await backend.get(request.match_info["key"])
+        if value is None:
+            return web.json_response({"error": "not found"}, status=404)
+        return web.json_response({"value": value})
+
+    async def put(request: web.Request) -> web.Response:
+        body = await request.json()
+        await backend.set(request.match_info["key"], body["value"], ttl=body.get("ttl"))
+        return web.json_response({})
+
+    async def delete(request: web.Request) -> web.Response:
+        await backend.delete(request.match_info["key"])
+        return web.json_response({})
+
+    async def incr(request: web.Request) -> web.Response:
+        body = await request.json()
+        value = await backend.incr(request.match_info["key"], body.get("amount", 1), ttl=body.get("ttl"))
+        return web.json_response({"value": value})
+
+    async def scan(request: web.Request) -> web.Response:
+        return web.json_response({"keys": await backend.scan(request.query.get("prefix", ""))})
+
+    app = web.Application()
+    app.router.add_get("/kv", scan)
+    app.router.add_get("/kv/{key}", get)
+    app.router.add_put("/kv/{key}", put)
+    app.router.add_delete("/kv/{key}", delete)
+    app.router.add_post("/kv/{key}/incr", incr)
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--sqlite", help="keep the values in this SQLite database instead of in memory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    backend = SQLiteStore(args.sqlite) if args.sqlite else MemoryStore()
+    app = make_store_app(backend)
+
+    async def start_purge(app: web.Application) -> None:
+        app["purge"] = asyncio.create_task(purge_expired_keys(backend))
+
+    async def stop_purge(app: web.Application) -> None:
+        app["purge"].cancel()
+
+    app.on_startup.append(start_purge)
+    app.on_cleanup.append(stop_purge)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Export of the conversation of a chat thread as a single Markdown or HTML file.
+
+The messages of the OpenAI threads of a chat (the threads it was compacted
+from, then the current one) are read page by page and rendered as they are
+sent to Discord, with Message.render, so the formulas are converted and the
+files made by the code interpreter are downloaded and fitted to the image
+budgets. Images and files are embedded in the export as data URIs, so the
+export stays one self-contained attachment.
+
+The export is written to a spooled file: it is kept in memory up to
+EXPORT_SPOOL_MAX_BYTES and moved to a temporary file on disk beyond, so the
+memory used does not grow with the length of the thread.
+"""
+from __future__ import annotations
+
+import base64
+import html
+import logging
+import mimetypes
+import tempfile
+from datetime import datetime, timezone
+from typing import IO, Literal
+
+from discord import File
+
+from src.metrics import THREAD_EXPORTS
+from src.models.message import Message
+from src.openai_api.thread_messages import iter_thread_messages
+from src.tracing import span
+
+logger = logging.getLogger(__name__)
+
+EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+# base64 is written by chunks of this many bytes of the file, a multiple of 3
+BASE64_CHUNK_BYTES = 3 * 64 * 1024
+
+ExportFormat = Literal["markdown", "html"]
+
+HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 48rem; margin: 2rem auto; padding: 0 1rem; }}
+.message {{ border-bottom: 1px solid #ddd; padding: 0.5rem 0; }}
+.role {{ font-weight: bold; }}
+.time {{ color: #888; font-size: 0.8rem; }}
+.content {{ white-space: pre-wrap; }}
+img {{ max-width: 100%; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+"""
+HTML_TAIL = "</body>\n</html>\n"
+
+
+class ExportWriter:
+    """Writes the rendered messages to a binary file, in Markdown"""
+
+    extension = "md"
+
+    def __init__(self, fp: IO[bytes], include_files: bool = True):
+        self.fp = fp
+        self.include_files = include_files
+
+    def write(self, text: str) -> None:
+        self.fp.write(text.encode("utf-8"))
+
+    def write_data_uri(self, file: File) -> None:
+        """Write the file as a data URI, by chunks"""
+        mime_type = mimetypes.guess_type(file.filename)[0] or "application/octet-stream"
+        self.write(f"data:{mime_type};base64,")
+        while chunk := file.fp.read(BASE64_CHUNK_BYTES):
+            self.fp.write(base64.b64encode(chunk))
+
+    def begin(self, title: str) -> None:
+        self.write(f"# {title}\n\n")
+
+    def begin_message(self, message: Message) -> None:
+        self.write(f"## {(message.role or 'unknown').capitalize()} · {_format_time(message.created_at)}\n\n")
+
+    def write_content(self, content: str) -> None:
+        self.write(f"{content}\n\n")
+
+    def write_file(self, file: File) -> None:
+        if not self.include_files:
+            self.write(f"*[{file.filename}]*\n\n")
+            return
+        self.write(f"![{file.filename}](" if _is_image(file) else f"[{file.filename}](")
+        self.write_data_uri(file)
+        self.write(")\n\n")
+
+    def write_separator(self, title: str) -> None:
+        self.write(f"---\n\n*{title}*\n\n")
+
+    def end_message(self) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+class HtmlExportWriter(ExportWriter):
+    extension = "html"
+
+    def begin(self, title: str) -> None:
+        self.write(HTML_HEAD.format(title=html.escape(title)))
+
+    def begin_message(self, message: Message) -> None:
+        self.write(
+            f'<div class="message {html.escape(message.role or "")}">'
+            f'<span class="role">{html.escape((message.role or "unknown").capitalize())}</span> '
+            f'<span class="time">{_format_time(message.created_at)}</span>\n'
+        )
+
+    def write_content(self, content: str) -> None:
+        self.write(f'<div class="content">{html.escape(content)}</div>\n')
+
+    def write_file(self, file: File) -> None:
+        name = html.escape(file.filename)
+        if not self.include_files:
+            self.write(f"<p><em>[{name}]</em></p>\n")
+            return
+        self.write(f'<p><img alt="{name}" src="' if _is_image(file) else f'<p><a download="{name}" href="')
+        self.write_data_uri(file)
+        self.write('"></p>\n' if _is_image(file) else f'">{name}</a></p>\n')
+
+    def write_separator(self, title: str) -> None:
+        self.write(f"<hr>\n<p><em>{html.escape(title)}</em></p>\n")
+
+    def end_message(self) -> None:
+        self.write("</div>\n")
+
+    def end(self) -> None:
+        self.write(HTML_TAIL)
+
+
+WRITERS: dict[str, type[ExportWriter]] = {"markdown": ExportWriter, "html": HtmlExportWriter}
+
+
+def _format_time(created_at: int | None) -> str:
+    if created_at is None:
+        return ""
+    return datetime.fromtimestamp(created_at, tz=timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+
+def _is_image(file: File) -> bool:
+    return (mimetypes.guess_type(file.filename)[0] or "").startswith("image/")
+
+
+async def write_message(writer: ExportWriter, message: Message) -> None:
+    writer.begin_message(message)
+    if not writer.include_files:
+        # the files are not downloaded
+        if message.text:
+            writer.write_content(message.text)
+        writer.end_message()
+        return
+    try:
+        rendered = await message.render()
+    except Exception:
+        # e.g. an image uploaded for vision, which cannot be downloaded
+        logger.warning(f"Failed to render message {message.id}, exporting its text only", exc_info=True)
+        writer.write_content(message.text)
+    else:
+        for discord_message in rendered:
+            if discord_message.content:
+                writer.write_content(discord_message.content)
+            for file in discord_message.files or []:
+                writer.write_file(file)
+    writer.end_message()
+
+
+async def export_threads(
+    thread_ids: list[str], title: str, export_format: ExportFormat = "markdown", include_files: bool = True
+) -> tuple[tempfile.SpooledTemporaryFile, int]:
+    """Write the messages of the threads, oldest first, to a spooled file rewound to its start.
+    Return the file and the number of messages.
+    """
+    fp = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES, mode="w+b")
+    writer = WRITERS[export_format](fp, include_files=include_files)
+    n_messages = 0
+    with span("export.threads", n_threads=len(thread_ids), format=export_format) as export_span:
+        try:
+            writer.begin(title)
+            for i, thread_id in enumerate(thread_ids):
+                if i:
+                    writer.write_separator("The conversation continues in a new thread, starting from a summary")
+                async for message in iter_thread_messages(thread_id):
+                    await write_message(writer, message)
+                    n_messages += 1
+            writer.end()
+        except BaseException:
+            fp.close()
+            raise
+        export_span.set_attribute("n_messages", n_messages)
+        export_span.set_attribute("size", fp.tell())
+    THREAD_EXPORTS.labels(format=export_format).inc()
+    fp.seek(0)
+    return fp, n_messages
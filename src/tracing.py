@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Attributes copied from a parent span to its children, so that every span
+# in a request can be filtered by the Discord/OpenAI thread and assistant.
+INHERITED_ATTRIBUTES = ("guild_id", "discord_thread_id", "thread_id", "assistant_id")
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+_span_processors: list[Callable[[Span], None]] = []
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start_ns: int
+    end_ns: int | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    status: str = "ok"
+    error: str | None = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> float:
+        """Duration of the span in seconds (0 while the span is still open)"""
+        if self.end_ns is None:
+            return 0.0
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def set_attribute(key: str, value: Any) -> None:
+    """Set an attribute on the current span, if any"""
+    span_ = _current_span.get()
+    if span_ is not None:
+        span_.set_attribute(key, value)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """Open a span as a child of the current one.
+
+    Works in both sync and async code since the current span is kept in a
+    ContextVar, which asyncio copies per task.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        trace_id = uuid.uuid4().hex
+        inherited = {}
+    else:
+        trace_id = parent.trace_id
+        inherited = {
+            k: parent.attributes[k] for k in INHERITED_ATTRIBUTES if k in parent.attributes
+        }
+    span_ = Span(
+        name=name,
+        trace_id=trace_id,
+        span_id=uuid.uuid4().hex[:16],
+        parent_id=parent.span_id if parent else None,
+        start_ns=time.time_ns(),
+        attributes={**inherited, **attributes},
+    )
+    token = _current_span.set(span_)
+    try:
+        yield span_
+    except BaseException as e:
+        span_.status = "error"
+        span_.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span_.end_ns = time.time_ns()
+        _current_span.reset(token)
+        for processor in _span_processors:
+            try:
+                processor(span_)
+            except Exception as e:
+                logger.warning(f"Span processor failed: {e}")
+
+
+def add_span_processor(processor: Callable[[Span], None]) -> None:
+    """Register a callback invoked with every finished span"""
+    _span_processors.append(processor)
+
+
+class JsonlSpanExporter:
+    """Append finished spans to a local JSONL file, one span per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list[Span]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span_ in spans:
+                f.write(json.dumps(span_.to_dict(), default=str) + "\n")
+
+
+class OtlpHttpSpanExporter:
+    """Post finished spans to an OTLP/HTTP (JSON encoding) collector"""
+
+    def __init__(self, endpoint: str, service_name: str = "gpt-discord-bot"):
+        self.endpoint = endpoint.rstrip("/")
+        if not self.endpoint.endswith("/v1/traces"):
+            self.endpoint += "/v1/traces"
+        self.service_name = service_name
+
+    @staticmethod
+    def _attribute(key: str, value: Any) -> dict[str, Any]:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _to_otlp(self, span_: Span) -> dict[str, Any]:
+        otlp_span = {
+            "traceId": span_.trace_id,
+            "spanId": span_.span_id,
+            "name": span_.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span_.start_ns),
+            "endTimeUnixNano": str(span_.end_ns),
+            "attributes": [self._attribute(k, v) for k, v in span_.attributes.items()],
+            "status": {"code": 2, "message": span_.error} if span_.status == "error" else {"code": 1},
+        }
+        if span_.parent_id:
+            otlp_span["parentSpanId"] = span_.parent_id
+        return otlp_span
+
+    def export(self, spans: list[Span]) -> None:
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "src.tracing"},
+                            "spans": [self._to_otlp(s) for s in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            response.read()
+
+
+class BatchSpanProcessor:
+    """Hand finished spans to an exporter from a background thread.
+
+    Exporting never runs on the event loop; spans are dropped (and counted)
+    when the buffer is full rather than blocking the bot.
+    """
+
+    def __init__(self, exporter, max_queue_size: int = 2048, batch_size: int = 64,
+                 flush_interval: float = 2.0):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: queue.Queue[Span | None] = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._worker, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def __call__(self, span_: Span) -> None:
+        try:
+            self._queue.put_nowait(span_)
+        except queue.Full:
+            self.dropped += 1
+
+    def _worker(self) -> None:
+        batch: list[Span] = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            else:
+                if item is None:
+                    self._export(batch)
+                    return
+                batch.append(item)
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._export(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _export(self, batch: list[Span]) -> None:
+        if not batch:
+            return
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            logger.warning(f"Failed to export {len(batch)} spans: {e}")
+
+    def shutdown(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class TraceContextFilter(logging.Filter):
+    """Add the current trace and span ids to every log record"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        span_ = _current_span.get()
+        record.trace_id = span_.trace_id if span_ else "-"
+        record.span_id = span_.span_id if span_ else "-"
+        return True
+
+
+def setup_logging(level: str) -> None:
+    """Log to stderr with the trace id of the current span on every line"""
+    logging.basicConfig(
+        format="[%(asctime)s] [%(levelname)s] [%(filename)s:%(lineno)d] [trace=%(trace_id)s] %(message)s",
+        level=level,
+    )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceContextFilter())
+
+
+def setup_tracing(jsonl_path: str | None = None, otlp_endpoint: str | None = None) -> list[BatchSpanProcessor]:
+    """Register exporters for the configured destinations"""
+    processors = []
+    if jsonl_path:
+        os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+        processors.append(BatchSpanProcessor(JsonlSpanExporter(jsonl_path)))
+        logger.info(f"Exporting spans to {jsonl_path}")
+    if otlp_endpoint:
+        processors.append(BatchSpanProcessor(OtlpHttpSpanExporter(otlp_endpoint)))
+        logger.info(f"Exporting spans to {otlp_endpoint}")
+    for processor in processors:
+        add_span_processor(processor)
+    return processors
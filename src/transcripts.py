@@ -0,0 +1,238 @@
+"""Local full-text index of the chat transcripts.
+
+Each user message and each answer of a chat thread is a row of a SQLite
+database, indexed with FTS5, so /history search finds past conversations
+of a guild without paging the Discord threads or the OpenAI threads. The
+index uses the trigram tokenizer, which matches any part of a word and
+also works for Japanese, without word boundaries; terms shorter than three
+characters are matched with LIKE instead.
+
+Turns are added to an in-memory batch and written by a background task,
+in one transaction every TRANSCRIPT_FLUSH_INTERVAL seconds or once the
+batch is full, so indexing never delays an answer. Rows are keyed by the
+Discord message id: a message indexed twice, e.g. by a retried job, is
+kept once.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+import threading
+from dataclasses import astuple, dataclass
+
+from src.constants import TRANSCRIPT_INDEX_PATH
+from src.metrics import TRANSCRIPT_TURNS
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIPT_FLUSH_INTERVAL = 2.0
+TRANSCRIPT_BATCH_SIZE = 200
+# shortest term matched by the trigram index
+MIN_INDEXED_TERM = 3
+SNIPPET_TOKENS = 24
+
+
+@dataclass
+class Turn:
+    # the Discord message of the turn: the user message, or the first message of the answer
+    message_id: int
+    guild_id: int
+    discord_thread_id: int
+    assistant_id: str
+    author_id: int
+    author: str
+    # user or assistant
+    role: str
+    content: str
+    created_at: float
+
+
+@dataclass
+class SearchResult:
+    turn: Turn
+    # the content around the matched terms, in bold
+    snippet: str
+
+    @property
+    def jump_url(self) -> str:
+        return (
+            f"https://discord.com/channels/{self.turn.guild_id}/{self.turn.discord_thread_id}/{self.turn.message_id}"
+        )
+
+
+def _phrase(term: str) -> str:
+    """The term as an FTS5 string, so that its characters are not read as operators"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like(term: str) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+class TranscriptIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS turns (
+                message_id INTEGER PRIMARY KEY,
+                guild_id INTEGER NOT NULL,
+                discord_thread_id INTEGER NOT NULL,
+                assistant_id TEXT NOT NULL,
+                author_id INTEGER NOT NULL,
+                author TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS turns_guild ON turns (guild_id, created_at)")
+        # external content table: the text is only stored in turns
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5("
+            "content, content='turns', content_rowid='message_id', tokenize='trigram')"
+        )
+        # not fired for the turns ignored as already indexed
+        self._conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS turns_insert AFTER INSERT ON turns BEGIN
+                INSERT INTO turns_fts (rowid, content) VALUES (new.message_id, new.content);
+            END
+        """)
+        self._lock = threading.Lock()
+        self._pending: list[Turn] = []
+        self._full = asyncio.Event()
+        self._flusher: asyncio.Task | None = None
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, parameters)
+
+    def _insert(self, turns: list[Turn]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO turns (message_id, guild_id, discord_thread_id, assistant_id, author_id,"
+                    " author, role, content, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [astuple(turn) for turn in turns],
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _search(
+        self,
+        query: str,
+        guild_id: int,
+        discord_thread_id: int | None,
+        assistant_id: str | None,
+        author_id: int | None,
+        limit: int,
+    ) -> list[SearchResult]:
+        terms = query.split()
+        indexed = [term for term in terms if len(term) >= MIN_INDEXED_TERM]
+        conditions = ["turns.guild_id = ?"]
+        parameters: list = [guild_id]
+        for name, value in (
+            ("discord_thread_id", discord_thread_id), ("assistant_id", assistant_id), ("author_id", author_id)
+        ):
+            if value is not None:
+                conditions.append(f"turns.{name} = ?")
+                parameters.append(value)
+        for term in terms:
+            if len(term) < MIN_INDEXED_TERM:
+                conditions.append("turns.content LIKE ? ESCAPE '\\'")
+                parameters.append(_like(term))
+
+        columns = (
+            "turns.message_id, turns.guild_id, turns.discord_thread_id, turns.assistant_id, turns.author_id,"
+            " turns.author, turns.role, turns.content, turns.created_at"
+        )
+        if indexed:
+            # best matches first
+            sql = (
+                f"SELECT {columns}, snippet(turns_fts, 0, '**', '**', '…', {SNIPPET_TOKENS}) FROM turns_fts"
+                " JOIN turns ON turns.message_id = turns_fts.rowid"
+                f" WHERE turns_fts MATCH ? AND {' AND '.join(conditions)} ORDER BY turns_fts.rank LIMIT ?"
+            )
+            parameters = [" ".join(_phrase(term) for term in indexed), *parameters, limit]
+        else:
+            # only short terms: the turns of the guild are scanned, latest first
+            sql = (
+                f"SELECT {columns}, substr(turns.content, 1, 200) FROM turns"
+                f" WHERE {' AND '.join(conditions)} ORDER BY turns.created_at DESC LIMIT ?"
+            )
+            parameters.append(limit)
+        rows = self._execute(sql, tuple(parameters)).fetchall()
+        return [SearchResult(turn=Turn(*row[:-1]), snippet=row[-1]) for row in rows]
+
+    def add(self, turn: Turn) -> None:
+        """Queue the turn to be indexed, without waiting"""
+        if not turn.content.strip():
+            return
+        self._pending.append(turn)
+        TRANSCRIPT_TURNS.labels(role=turn.role).inc()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_periodically())
+        if len(self._pending) >= TRANSCRIPT_BATCH_SIZE:
+            self._full.set()
+
+    async def _flush_periodically(self) -> None:
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=TRANSCRIPT_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Write the queued turns"""
+        self._full.clear()
+        turns, self._pending = self._pending, []
+        if not turns:
+            return
+        try:
+            await asyncio.to_thread(self._insert, turns)
+        except Exception:
+            logger.exception(f"Failed to index {len(turns)} transcript turns")
+
+    async def search(
+        self,
+        query: str,
+        guild_id: int,
+        discord_thread_id: int | None = None,
+        assistant_id: str | None = None,
+        author_id: int | None = None,
+        limit: int = 10,
+    ) -> list[SearchResult]:
+        """The turns of the guild containing every term of the query"""
+        return await asyncio.to_thread(
+            self._search, query, guild_id, discord_thread_id, assistant_id, author_id, limit
+        )
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await self.flush()
+        self._conn.close()
+
+
+_transcript_index: TranscriptIndex | None = None
+
+
+def get_transcript_index() -> TranscriptIndex | None:
+    """Return the index at TRANSCRIPT_INDEX_PATH, opened on first use, None if it is disabled"""
+    global _transcript_index
+    if _transcript_index is None and TRANSCRIPT_INDEX_PATH:
+        _transcript_index = TranscriptIndex(TRANSCRIPT_INDEX_PATH)
+    return _transcript_index
+
+
+async def close_transcript_index() -> None:
+    global _transcript_index
+    if _transcript_index is not None:
+        await _transcript_index.close()
+        _transcript_index = None
@@ -0,0 +1,243 @@
+"""Run workers: answer the thread messages queued by the gateway process.
+
+With RUN_MODE=gateway the bot only validates the messages and adds a job
+per message to the durable job queue. Each worker process logs in to the
+Discord REST API only (no gateway connection), claims jobs from the queue
+and runs the same steps as the bot in RUN_MODE=all: upload the attachments,
+run the assistant, render the answer and send it to the thread. Several
+jobs run at once per process, and processes can be added to use more cores.
+
+    python -m src.worker --processes 4 --concurrency 8
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import time
+
+import discord
+
+from src import media
+from src.admission import AdmissionRejected, admission
+from src.config import watch_config
+from src.constants import (
+    DISCORD_BOT_TOKEN,
+    JOB_LEASE_SECONDS,
+    LOG_LEVEL,
+    MAX_CONCURRENT_RUNS_PER_CHANNEL,
+    MAX_CONCURRENT_RUNS_PER_GUILD,
+    MAX_CONCURRENT_RUNS_PER_USER,
+    TRACE_EXPORT_PATH,
+    TRACE_OTLP_ENDPOINT,
+    WORKER_CONCURRENCY,
+    WORKER_PROCESSES,
+)
+from src.discord_cogs._utils import is_last_message_stale
+from src.discord_cogs.chat import (
+    compact_thread_if_needed,
+    generate_reply,
+    process_response,
+    redeliver_dead_letters,
+    resume_run,
+    send_to_thread,
+)
+from src.job_queue import Job, JobQueue, get_job_queue
+from src.run_journal import get_run_journal
+from src.store import purge_expired_keys, require_shared_store
+from src.tracing import setup_logging, setup_tracing, span
+from src.transcripts import close_transcript_index
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.5  # seconds between claims when the queue is empty
+MAX_RETRY_DELAY = 60
+PURGE_INTERVAL = 3600
+PURGE_OLDER_THAN = 24 * 3600
+# concurrent runs per guild, channel and user, across all the workers
+JOB_LIMITS = {
+    "guild_id": MAX_CONCURRENT_RUNS_PER_GUILD,
+    "parent_id": MAX_CONCURRENT_RUNS_PER_CHANNEL,
+    "author_id": MAX_CONCURRENT_RUNS_PER_USER,
+}
+
+
+async def run_job(client: discord.Client, job: Job) -> None:
+    payload = job.payload
+    guild_id = payload["guild_id"]
+    thread = client.get_partial_messageable(
+        payload["discord_thread_id"], guild_id=guild_id, type=discord.ChannelType.public_thread
+    )
+    parent = client.get_partial_messageable(payload["parent_id"], guild_id=guild_id, type=discord.ChannelType.text)
+
+    with span(
+        "worker.job",
+        guild_id=guild_id,
+        discord_thread_id=thread.id,
+        message_id=payload["message_id"],
+        attempt=job.attempts,
+    ):
+        # a job retried after its worker died resumes the run of the previous attempt
+        entry = await get_run_journal().get(payload["message_id"])
+        if entry is not None:
+            await resume_run(client, entry)
+            return
+
+        message = await thread.fetch_message(payload["message_id"])
+        async with get_run_journal().answering(message.id):
+            await answer_message(client, job, message, thread, parent)
+
+
+async def answer_message(
+    client: discord.Client,
+    job: Job,
+    message: discord.Message,
+    thread: discord.PartialMessageable,
+    parent: discord.PartialMessageable,
+) -> None:
+    """Run the assistant on the message and send its answer"""
+    payload = job.payload
+    guild_id = payload["guild_id"]
+    try:
+        async with admission.admit(
+            guild_id=guild_id,
+            channel_id=payload["parent_id"],
+            user_id=payload["author_id"],
+        ) as ticket:
+            response_data = await generate_reply(message=message, thread=thread, parent=parent)
+            if response_data is not None and response_data.usage:
+                ticket.tokens = response_data.usage["total_tokens"]
+    except AdmissionRejected as e:
+        await send_to_thread(
+            thread,
+            embed=discord.Embed(
+                description=f"**Busy** - {e}",
+                color=discord.Color.red(),
+            )
+        )
+        return
+
+    if response_data is None:
+        return
+
+    # the worker has no message cache, so the last message is fetched
+    last_message = None
+    async for last_message in thread.history(limit=1):
+        pass
+    if is_last_message_stale(
+        interaction_message=message,
+        last_message=last_message,
+        bot_id=client.user.id,
+    ):
+        # there is another message and its not from us, so ignore this response
+        return
+
+    # received_at is a wall-clock time from the gateway process
+    received_at = time.monotonic() - (time.time() - payload["received_at"])
+    try:
+        await process_response(thread=thread, response_data=response_data, received_at=received_at)
+        await compact_thread_if_needed(thread=thread, parent=parent, response_data=response_data)
+    except Exception:
+        # part of the answer may already be in the thread, so the job is not retried
+        logger.exception(f"Failed to send the answer to message {payload['message_id']}")
+
+
+async def keep_lease(job_queue: JobQueue, job: Job, worker: str) -> None:
+    """Extend the lease of a running job so that no other worker claims it"""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        await job_queue.extend_lease(job.id, worker, JOB_LEASE_SECONDS)
+
+
+async def work(client: discord.Client, job_queue: JobQueue, worker: str) -> None:
+    while True:
+        job = await job_queue.claim(worker, JOB_LEASE_SECONDS, limits=JOB_LIMITS)
+        if job is None:
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+
+        lease = asyncio.create_task(keep_lease(job_queue, job, worker))
+        try:
+            await run_job(client, job)
+        except Exception as e:
+            retry = await job_queue.fail(job, error=repr(e), retry_delay=min(MAX_RETRY_DELAY, 2 ** job.attempts))
+            logger.exception(
+                f"Job {job.id} (message {job.idempotency_key}) failed on attempt {job.attempts}/{job.max_attempts}"
+                + (", retrying" if retry else "")
+            )
+        else:
+            await job_queue.complete(job.id)
+        finally:
+            lease.cancel()
+
+
+async def purge_finished_jobs(job_queue: JobQueue) -> None:
+    while True:
+        purged = await job_queue.purge(older_than=PURGE_OLDER_THAN)
+        if purged:
+            logger.info(f"Purged {purged} finished jobs")
+        await asyncio.sleep(PURGE_INTERVAL)
+
+
+async def run_worker(concurrency: int) -> None:
+    # REST only: the worker never connects to the gateway, so the intents are not used
+    client = discord.Client(intents=discord.Intents.default())
+    await client.login(DISCORD_BOT_TOKEN)
+    job_queue = get_job_queue()
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"Worker {worker} started with concurrency {concurrency}")
+    try:
+        await asyncio.gather(
+            purge_finished_jobs(job_queue),
+            purge_expired_keys(),
+            watch_config(),
+            redeliver_dead_letters(client),
+            *(work(client, job_queue, worker) for _ in range(concurrency)),
+        )
+    finally:
+        await client.close()
+        await close_transcript_index()
+        media.shutdown()
+
+
+def _worker_process(concurrency: int) -> None:
+    setup_logging(LOG_LEVEL)
+    setup_tracing(jsonl_path=TRACE_EXPORT_PATH, otlp_endpoint=TRACE_OTLP_ENDPOINT)
+    try:
+        asyncio.run(run_worker(concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(processes: int = WORKER_PROCESSES, concurrency: int = WORKER_CONCURRENCY) -> None:
+    """Run `processes` worker processes, each running up to `concurrency` jobs at once"""
+    if processes <= 1:
+        _worker_process(concurrency)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=_worker_process, args=(concurrency,)) for _ in range(processes)]
+    for process in workers:
+        process.start()
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        for process in workers:
+            process.terminate()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES)
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="jobs run at once per process")
+    args = parser.parse_args()
+    require_shared_store("worker")
+    run_workers(args.processes, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
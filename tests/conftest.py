@@ -0,0 +1,26 @@
+import asyncio
+import inspect
+import os
+
+# src.constants reads these at import time
+for name, value in {
+    "OPENAI_API_KEY": "test",
+    "DISCORD_BOT_TOKEN": "test",
+    "DISCORD_CLIENT_ID": "1",
+    "ALLOWED_SERVER_IDS": "1",
+    "DEFAULT_MODEL": "gpt-4",
+    "TRANSCRIPT_INDEX_PATH": "",
+}.items():
+    os.environ.setdefault(name, value)
+
+import pytest  # noqa: E402
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Run the async tests in a new event loop, without a plugin"""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(pyfuncitem.obj(**arguments))
+    return True
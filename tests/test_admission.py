@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from src.admission import AdmissionController, AdmissionRejected, Limits
+from src.store import MemoryStore
+
+
+def make_controller(concurrent=(0, 0, 0), budgets=(0, 0, 0), max_queued=0) -> AdmissionController:
+    return AdmissionController(
+        limits={
+            scope: Limits(max_concurrent_runs, token_budget)
+            for scope, max_concurrent_runs, token_budget in zip(("guild", "channel", "user"), concurrent, budgets)
+        },
+        max_queued=max_queued,
+        window=60,
+        store=MemoryStore(),
+    )
+
+
+def request(channel_id=1, user_id=1, guild_id=1):
+    return dict(guild_id=guild_id, channel_id=channel_id, user_id=user_id)
+
+
+async def test_unlimited_by_default():
+    admission = make_controller()
+    tickets = [await admission.acquire(**request()) for _ in range(100)]
+    assert all(ticket.admitted.done() for ticket in tickets)
+
+
+async def test_waiting_requests_are_admitted_in_order():
+    admission = make_controller(concurrent=(0, 0, 1))
+    first = await admission.acquire(**request())
+    admitted = []
+
+    async def wait(n):
+        ticket = await admission.acquire(**request())
+        admitted.append(n)
+        return ticket
+
+    waiters = [asyncio.create_task(wait(n)) for n in range(3)]
+    await asyncio.sleep(0)
+    assert admitted == []
+    admission.release(first)
+    for n in range(3):
+        ticket = await waiters[n]
+        assert admitted == list(range(n + 1))
+        admission.release(ticket)
+
+
+async def test_busy_channel_does_not_hold_back_others():
+    admission = make_controller(concurrent=(0, 1, 0))
+    busy = await admission.acquire(**request(channel_id=1))
+    waiting = asyncio.create_task(admission.acquire(**request(channel_id=1)))
+    await asyncio.sleep(0)
+    other = await asyncio.wait_for(admission.acquire(**request(channel_id=2)), timeout=1)
+    assert not waiting.done()
+    admission.release(busy)
+    admission.release(await waiting)
+    admission.release(other)
+
+
+async def test_queued_position_is_reported():
+    admission = make_controller(concurrent=(1, 0, 0))
+    await admission.acquire(**request())
+    positions = []
+
+    async def on_queued(position):
+        positions.append(position)
+
+    waiters = [asyncio.create_task(admission.acquire(**request(), on_queued=on_queued)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    assert positions == [1, 2]
+    for waiter in waiters:
+        waiter.cancel()
+
+
+async def test_requests_are_shed_when_the_queue_is_full():
+    admission = make_controller(concurrent=(1, 0, 0), max_queued=1)
+    await admission.acquire(**request())
+    waiting = asyncio.create_task(admission.acquire(**request()))
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejected):
+        await admission.acquire(**request())
+    waiting.cancel()
+
+
+async def test_cancelled_waiter_leaves_the_queue():
+    admission = make_controller(concurrent=(1, 0, 0), max_queued=1)
+    first = await admission.acquire(**request())
+    waiting = asyncio.create_task(admission.acquire(**request()))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    # the place in the queue is free again, and the slot is not leaked
+    queued = asyncio.create_task(admission.acquire(**request()))
+    await asyncio.sleep(0)
+    admission.release(first)
+    admission.release(await asyncio.wait_for(queued, timeout=1))
+    assert admission._running == {}
+
+
+async def test_token_budget():
+    admission = make_controller(budgets=(0, 0, 100))
+    async with admission.admit(**request(user_id=1)) as ticket:
+        ticket.tokens = 60
+    assert await admission.tokens_used(("user", 1)) == 60
+    async with admission.admit(**request(user_id=1)) as ticket:
+        ticket.tokens = 50
+    with pytest.raises(AdmissionRejected):
+        await admission.acquire(**request(user_id=1))
+    # the budget is per user
+    await admission.acquire(**request(user_id=2))
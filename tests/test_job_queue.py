@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from src.job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.db"))
+
+
+async def test_enqueue_is_idempotent(queue):
+    assert await queue.enqueue("message-1", {"n": 1})
+    assert not await queue.enqueue("message-1", {"n": 2})
+    assert await queue.depth() == 1
+    job = await queue.claim("worker", lease=60)
+    assert job.payload == {"n": 1}
+    # a message already answered is not queued again either
+    await queue.complete(job.id)
+    assert not await queue.enqueue("message-1", {"n": 3})
+
+
+async def test_claim_oldest_first_and_only_once(queue):
+    for i in range(3):
+        await queue.enqueue(str(i), {"n": i})
+    claimed = [await queue.claim("worker", lease=60) for _ in range(4)]
+    assert [job.idempotency_key for job in claimed[:3]] == ["0", "1", "2"]
+    assert claimed[3] is None
+    assert [job.attempts for job in claimed[:3]] == [1, 1, 1]
+
+
+async def test_concurrent_claims_take_different_jobs(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    queue = JobQueue(path)
+    for i in range(20):
+        await queue.enqueue(str(i), {})
+    # one connection per worker, as in separate processes
+    workers = [JobQueue(path) for _ in range(4)]
+    jobs = await asyncio.gather(*(worker.claim(f"w{i}", lease=60) for i, worker in enumerate(workers * 5)))
+    assert sorted(int(job.idempotency_key) for job in jobs) == list(range(20))
+
+
+async def test_expired_lease_is_claimed_again(queue):
+    await queue.enqueue("a", {})
+    first = await queue.claim("dead worker", lease=0.05)
+    assert await queue.claim("other", lease=60) is None
+    await asyncio.sleep(0.1)
+    second = await queue.claim("other", lease=60)
+    assert second.id == first.id
+    assert second.attempts == 2
+
+
+async def test_extended_lease_is_kept(queue):
+    await queue.enqueue("a", {})
+    job = await queue.claim("worker", lease=0.05)
+    await queue.extend_lease(job.id, "worker", lease=60)
+    # only the worker holding the job can extend its lease
+    await queue.extend_lease(job.id, "other", lease=0)
+    await asyncio.sleep(0.1)
+    assert await queue.claim("other", lease=60) is None
+
+
+async def test_failed_job_is_retried_until_its_attempts_run_out(queue):
+    await queue.enqueue("a", {}, max_attempts=2)
+    job = await queue.claim("worker", lease=60)
+    assert await queue.fail(job, error="boom", retry_delay=0.05)
+    # not available before its retry delay
+    assert await queue.claim("worker", lease=60) is None
+    await asyncio.sleep(0.1)
+    job = await queue.claim("worker", lease=60)
+    assert job.attempts == 2
+    assert not await queue.fail(job, error="boom", retry_delay=0)
+    assert await queue.claim("worker", lease=60) is None
+    assert await queue.depth() == 0
+
+
+async def test_purge_finished_jobs(queue):
+    for key in ("done", "failed", "queued"):
+        await queue.enqueue(key, {}, max_attempts=1)
+    done = await queue.claim("worker", lease=60)
+    await queue.complete(done.id)
+    failed = await queue.claim("worker", lease=60)
+    await queue.fail(failed, error="boom", retry_delay=0)
+    assert await queue.purge(older_than=60) == 0
+    assert await queue.purge(older_than=0) == 2
+    assert (await queue.claim("worker", lease=60)).idempotency_key == "queued"
+
+
+async def test_claim_within_limits(queue):
+    jobs = [("0", 1, 1), ("1", 1, 1), ("2", 1, 2), ("3", 2, 3), ("4", 1, 4)]
+    for key, guild_id, author_id in jobs:
+        await queue.enqueue(key, {"guild_id": guild_id, "author_id": author_id})
+    limits = {"guild_id": 2, "author_id": 1}
+    claimed = []
+    while (job := await queue.claim("worker", lease=60, limits=limits)) is not None:
+        claimed.append(job)
+    # job 1 waits for job 0 of the same author, job 4 for the guild, the other guild is not held back
+    assert [job.idempotency_key for job in claimed] == ["0", "2", "3"]
+
+    await queue.complete(claimed[0].id)
+    assert (await queue.claim("worker", lease=60, limits=limits)).idempotency_key == "1"
+
+
+async def test_claim_limits_of_zero_are_unlimited(queue):
+    for key in ("0", "1"):
+        await queue.enqueue(key, {"guild_id": 1})
+    assert await queue.claim("worker", lease=60, limits={"guild_id": 0}) is not None
+    assert await queue.claim("worker", lease=60, limits={"guild_id": 0}) is not None
+
+
+async def test_claim_limits_ignore_expired_leases(queue):
+    for key in ("0", "1"):
+        await queue.enqueue(key, {"guild_id": 1})
+    await queue.claim("dead worker", lease=0.05, limits={"guild_id": 1})
+    await asyncio.sleep(0.1)
+    # the job of the dead worker no longer counts, it is claimed again first
+    job = await queue.claim("worker", lease=60, limits={"guild_id": 1})
+    assert job.idempotency_key == "0"
+    assert await queue.claim("worker", lease=60, limits={"guild_id": 1}) is None
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+from src.run_journal import JournalEntry, RunJournal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return RunJournal(str(tmp_path / "runs.db"))
+
+
+def entry(message_id=1, run_id="run_1", started_at=None) -> JournalEntry:
+    return JournalEntry(
+        message_id=message_id,
+        guild_id=10,
+        parent_id=20,
+        discord_thread_id=30,
+        thread_id="thread_1",
+        run_id=run_id,
+        assistant_id="asst_1",
+        started_at=started_at if started_at is not None else time.time(),
+    )
+
+
+async def test_record_and_finish(journal):
+    recorded = entry()
+    await journal.record(recorded)
+    assert await journal.get(1) == recorded
+    await journal.finish(1)
+    assert await journal.get(1) is None
+
+
+async def test_retry_replaces_the_run_of_the_previous_attempt(journal):
+    await journal.record(entry(run_id="run_1", started_at=100))
+    await journal.record(entry(run_id="run_2", started_at=200))
+    recorded = await journal.get(1)
+    assert (recorded.run_id, recorded.started_at) == ("run_2", 200)
+
+
+async def test_resumed_run_keeps_its_start_time(journal):
+    await journal.record(entry(run_id="run_1", started_at=100))
+    await journal.record(entry(run_id="run_1", started_at=200))
+    assert (await journal.get(1)).started_at == 100
+
+
+async def test_unfinished_oldest_first(journal):
+    await journal.record(entry(message_id=1, started_at=300))
+    await journal.record(entry(message_id=2, started_at=100))
+    await journal.record(entry(message_id=3, started_at=200))
+    assert [e.message_id for e in await journal.unfinished()] == [2, 3, 1]
+
+
+async def test_answering_removes_the_run_when_done_or_failed(journal):
+    await journal.record(entry(message_id=1))
+    async with journal.answering(1):
+        pass
+    assert await journal.get(1) is None
+
+    await journal.record(entry(message_id=2))
+    with pytest.raises(ValueError):
+        async with journal.answering(2):
+            raise ValueError
+    assert await journal.get(2) is None
+
+
+async def test_answering_keeps_the_run_when_cancelled(journal):
+    await journal.record(entry())
+
+    async def answer():
+        async with journal.answering(1):
+            await asyncio.sleep(60)
+
+    task = asyncio.create_task(answer())
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # resumed on the next start
+    assert await journal.get(1) is not None
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from src.store import MemoryStore, SQLiteStore, open_store, purge_expired_keys
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make():
+        return MemoryStore() if request.param == "memory" else SQLiteStore(str(tmp_path / "store.db"))
+    return make
+
+
+async def test_get_set_delete(make_store):
+    store = make_store()
+    assert await store.get("a") is None
+    await store.set("a", {"x": [1, 2]})
+    assert await store.get("a") == {"x": [1, 2]}
+    await store.delete("a")
+    assert await store.get("a") is None
+
+
+async def test_expired_keys_are_not_returned(make_store):
+    store = make_store()
+    await store.set("short", 1, ttl=0.05)
+    await store.set("long", 2, ttl=60)
+    await asyncio.sleep(0.1)
+    assert await store.get("short") is None
+    assert await store.get("long") == 2
+    assert await store.scan("") == ["long"]
+
+
+async def test_scan_prefix(make_store):
+    store = make_store()
+    for key in ("wizard:1", "wizard:2", "thread:1", "wizard"):
+        await store.set(key, key)
+    assert sorted(await store.scan("wizard:")) == ["wizard:1", "wizard:2"]
+
+
+async def test_incr_keeps_the_first_expiry(make_store):
+    store = make_store()
+    assert await store.incr("tokens", 10, ttl=0.1) == 10
+    await asyncio.sleep(0.05)
+    # incrementing does not extend the window
+    assert await store.incr("tokens", 5, ttl=60) == 15
+    await asyncio.sleep(0.1)
+    assert await store.get("tokens") is None
+    assert await store.incr("tokens", 1, ttl=60) == 1
+
+
+async def test_purge_deletes_expired_keys_only(make_store):
+    store = make_store()
+    await store.set("expired", 1, ttl=0.01)
+    await store.set("counter", 1, ttl=0.01)
+    await store.set("kept", 2)
+    await store.set("later", 3, ttl=60)
+    await asyncio.sleep(0.05)
+    assert await store.purge() == 2
+    assert await store.purge() == 0
+    assert sorted(await store.scan("")) == ["kept", "later"]
+
+
+async def test_purge_expired_keys_runs_periodically():
+    store = MemoryStore()
+    await store.set("a", 1, ttl=0.01)
+    purger = asyncio.create_task(purge_expired_keys(store, interval=0.01))
+    await asyncio.sleep(0.05)
+    purger.cancel()
+    assert store._data == {}
+
+
+def test_sqlite_incr_is_atomic_across_connections(tmp_path):
+    path = str(tmp_path / "store.db")
+    # one connection per thread, as in separate processes
+    stores = [SQLiteStore(path) for _ in range(4)]
+
+    async def main():
+        await asyncio.gather(*(store.incr("n", 1) for store in stores for _ in range(50)))
+        return await stores[0].get("n")
+
+    assert asyncio.run(main()) == 200
+
+
+async def test_sqlite_store_is_shared_by_connections(tmp_path):
+    path = str(tmp_path / "store.db")
+    await SQLiteStore(path).set("a", 1, ttl=60)
+    assert await SQLiteStore(path).get("a") == 1
+
+
+def test_open_store(tmp_path):
+    assert isinstance(open_store("memory://"), MemoryStore)
+    assert isinstance(open_store(f"sqlite:///{tmp_path}/store.db"), SQLiteStore)
+    with pytest.raises(ValueError):
+        open_store("redis://localhost")
@@ -0,0 +1,95 @@
+from src.transcripts import TranscriptIndex, Turn
+
+
+def turn(message_id, content, guild_id=1, discord_thread_id=10, role="user", author_id=100) -> Turn:
+    return Turn(
+        message_id=message_id,
+        guild_id=guild_id,
+        discord_thread_id=discord_thread_id,
+        assistant_id="asst_1",
+        author_id=author_id,
+        author="alice",
+        role=role,
+        content=content,
+        created_at=float(message_id),
+    )
+
+
+async def make_index(tmp_path, *turns) -> TranscriptIndex:
+    index = TranscriptIndex(str(tmp_path / "transcripts.db"))
+    for t in turns:
+        index.add(t)
+    await index.flush()
+    return index
+
+
+async def search_ids(index, query, **kwargs) -> list[int]:
+    return sorted(result.turn.message_id for result in await index.search(query, guild_id=1, **kwargs))
+
+
+async def test_search_matches_parts_of_words(tmp_path):
+    index = await make_index(
+        tmp_path,
+        turn(1, "How do I compute the eigenvalues of a matrix?"),
+        turn(2, "Use numpy.linalg.eig", role="assistant"),
+        turn(3, "What is a derivative?"),
+    )
+    assert await search_ids(index, "eigen") == [1]
+    assert await search_ids(index, "LINALG") == [2]
+    # every term must match
+    assert await search_ids(index, "eigenvalues derivative") == []
+
+
+async def test_search_japanese(tmp_path):
+    index = await make_index(tmp_path, turn(1, "行列の固有値の求め方を教えてください"), turn(2, "微分とは何ですか"))
+    assert await search_ids(index, "固有値") == [1]
+
+
+async def test_short_terms_are_matched_with_like(tmp_path):
+    index = await make_index(tmp_path, turn(1, "exercise 3 of chapter 2"), turn(2, "exercise 4"), turn(3, "行列"))
+    assert await search_ids(index, "3") == [1]
+    assert await search_ids(index, "exercise 4") == [2]
+    assert await search_ids(index, "行列") == [3]
+
+
+async def test_quotes_and_operators_are_literal(tmp_path):
+    index = await make_index(
+        tmp_path,
+        turn(1, 'the "quoted" word'),
+        turn(2, "NOT this one OR that"),
+        turn(3, "100% sure_thing"),
+        turn(4, "1000 surething"),
+    )
+    assert await search_ids(index, '"quoted"') == [1]
+    assert await search_ids(index, "NOT OR") == [2]
+    assert await search_ids(index, '"unbalanced') == []
+    # the LIKE wildcards of short terms are escaped
+    assert await search_ids(index, "0%") == [3]
+    assert await search_ids(index, "e_t") == [3]
+
+
+async def test_search_filters(tmp_path):
+    index = await make_index(
+        tmp_path,
+        turn(1, "matrix question", guild_id=1, discord_thread_id=10, author_id=100),
+        turn(2, "matrix question", guild_id=1, discord_thread_id=11, author_id=101),
+        turn(3, "matrix question", guild_id=2),
+    )
+    assert await search_ids(index, "matrix") == [1, 2]
+    assert await search_ids(index, "matrix", discord_thread_id=11) == [2]
+    assert await search_ids(index, "matrix", author_id=100) == [1]
+    assert await search_ids(index, "matrix", assistant_id="asst_2") == []
+
+
+async def test_turn_indexed_twice_is_kept_once(tmp_path):
+    index = await make_index(tmp_path, turn(1, "matrix question"))
+    index.add(turn(1, "matrix question"))
+    await index.flush()
+    results = await index.search("matrix", guild_id=1)
+    assert len(results) == 1
+    assert "**" in results[0].snippet
+
+
+async def test_empty_turns_are_not_indexed(tmp_path):
+    index = await make_index(tmp_path, turn(1, "   "))
+    assert await search_ids(index, "a") == []